@@ -14,6 +14,8 @@ import logging
 from typing import List, Tuple
 from pymodbus.client.sync import ModbusTcpClient
 import asyncio
+# next to the automation class, copy it with it
+import trace_context
 
 
 class AutomationClass():
@@ -30,6 +32,9 @@ class AutomationClass():
         # get custom configs defined in automation_class_def.json
         self.ip_address = args.get('ip_address', self.ip_address)
         self.port = args.get('port', self.port)
+        # the spans are exported to TRACE_EXPORT_PATH if it is set
+        self.tracer = trace_context.Tracer('automation')
+        self.trace_context = None
 
     def connect(self) -> None:
         """Connect to the PLC"""
@@ -63,14 +68,17 @@ class AutomationClass():
     
     def decision_mapping(self, msg: str) -> Tuple[str, List[str]]:
         """Map pipeline decision into PLC decision"""
-        try:
-            self.logger.info("decision_mapping")
-            # get the decision from the message
-            decision: str = msg['results']['decision']
-            # get the type from the message, type determines which register to write to
-            type: str = msg['results']['type']
-        except:
-            self.logger.exception("Error in decision_mapping")
+        # continue the trace of the pipeline, send_action is traced in the same trace
+        with self.tracer.span('decision_mapping', parent=trace_context.extract(msg.get('results'))) as span:
+            self.trace_context = span.context
+            try:
+                self.logger.info("decision_mapping")
+                # get the decision from the message
+                decision: str = msg['results']['decision']
+                # get the type from the message, type determines which register to write to
+                type: str = msg['results']['type']
+            except:
+                self.logger.exception("Error in decision_mapping")
 
         # Returns a tuple with the decision and a list of strings
         # The list contains any additional information used to send the inspection to the PLC
@@ -78,20 +86,21 @@ class AutomationClass():
 
     def send_action(self, action: str, aux_info: List[str]) -> List[str]:
         """Sends values to customer PLC"""
-        try:
-            decision_int = int(action == "PASS")
-            type = int(aux_info[0])
-            if type == 1:
-                self.client.write_register(1, decision_int)
-            elif type == 2:
-                self.client.write_register(2, decision_int)
-            else:
-                self.client.write_register(0, decision_int)
-        except:
-            self.logger.exception("Error in send_action")
-            self.client.close()
-            self.client = None
-            return []
+        with self.tracer.span('send_action', parent=self.trace_context, attributes={'action': action}):
+            try:
+                decision_int = int(action == "PASS")
+                type = int(aux_info[0])
+                if type == 1:
+                    self.client.write_register(1, decision_int)
+                elif type == 2:
+                    self.client.write_register(2, decision_int)
+                else:
+                    self.client.write_register(0, decision_int)
+            except:
+                self.logger.exception("Error in send_action")
+                self.client.close()
+                self.client = None
+                return []
         
         # returns a list of strings that are sent to GoFactory as inspection tags
         # in this case return the action (PASS/FAIL) and the PLC_STATUS (RUNNING/STOPPED)
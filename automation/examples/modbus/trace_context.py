@@ -0,0 +1,127 @@
+"""
+Description:
+continue the trace of a frame in the automation service. It is the part of pipeline_tools.tracing that automation
+needs, kept next to the automation class so the service doesn't depend on the pipeline folder.
+
+The pipeline adds the W3C traceparent of its predict span, "00-<32 hex trace id>-<16 hex span id>-01", to the results.
+The spans are appended to the TRACE_EXPORT_PATH file in the same OTLP/JSON lines format as the pipeline, one
+ExportTraceServiceRequest per span, and are not exported if it is not set.
+
+Example:
+    tracer = Tracer('automation')
+    with tracer.span('decision_mapping', parent=extract(msg.get('results'))) as span:
+        ...
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT = 'traceparent'
+
+
+def parse_traceparent(traceparent:str) -> tuple:
+    """parse a traceparent into the trace id and the span id, or None if it is invalid"""
+    parts = traceparent.split('-') if isinstance(traceparent, str) else []
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+def extract(carrier:dict) -> tuple:
+    """find the traceparent in the results, at its top level or in one of its dicts"""
+    if not isinstance(carrier, dict):
+        return None
+    if TRACEPARENT in carrier:
+        return parse_traceparent(carrier[TRACEPARENT])
+    for v in carrier.values():
+        if isinstance(v, dict) and TRACEPARENT in v:
+            return parse_traceparent(v[TRACEPARENT])
+    return None
+
+
+class Span:
+    """
+    a timed operation of a trace
+    """
+
+    def __init__(self, name:str, trace_id:str, parent_id:str=None, attributes:dict=None) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+
+    @property
+    def context(self) -> tuple:
+        return self.trace_id, self.span_id
+
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': k, 'value': {'stringValue': str(v)}} for k,v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class Tracer:
+    """
+    creates the spans of the automation service and appends them to the export file
+    """
+
+    def __init__(self, service_name:str, export_path:str=None) -> None:
+        self.service_name = service_name
+        self.export_path = export_path or os.environ.get('TRACE_EXPORT_PATH')
+        self.lock = threading.Lock()
+        if self.export_path:
+            os.makedirs(os.path.dirname(self.export_path) or '.', exist_ok=True)
+
+
+    @contextlib.contextmanager
+    def span(self, name:str, parent:tuple=None, attributes:dict=None):
+        """time a block as a span of the parent trace, or of a new trace if parent is None"""
+        trace_id, parent_id = parent if parent else (os.urandom(16).hex(), None)
+        span = Span(name, trace_id, parent_id, attributes)
+        try:
+            yield span
+        except Exception as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            self.export(span)
+
+
+    def export(self, span:Span) -> None:
+        if not self.export_path:
+            return
+        request = {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+                'scopeSpans': [{'scope': {'name': 'gadget'}, 'spans': [span.to_otlp()]}],
+            }]
+        }
+        try:
+            with self.lock, open(self.export_path, 'a') as f:
+                f.write(json.dumps(request) + '\n')
+        except OSError:
+            logger.exception('failed to export the span')
@@ -8,6 +8,11 @@ import torch
 
 # local imports
 from pipeline_base import PipelineBase as Base
+from pipeline_tools import cpu_backend
+from pipeline_tools.archiver import AsyncArchiver
+from pipeline_tools.dataset_collector import DatasetCollector
+from pipeline_tools.decision_stats import DecisionStats, StatsPublisher
+from pipeline_tools.patch_memory import PatchMemoryModel
 
 # functions from the LMI AI Solutions repo: https://github.com/lmitechnologies/LMI_AI_Solutions
 import gadget_utils.pipeline_utils as pipeline_utils
@@ -41,8 +46,53 @@ class ModelPipeline(Base):
             models (dict): model roles
             configs (dict): runtime configs
         """
-        self.load_models(models, configs, 'ad_model')
+        # export the role to a cpu format (onnx/openvino/int8) from its pt artifact
+        num_threads = configs.get('cpu_threads', 0)
+        models = cpu_backend.prepare_cpu_models(models, num_threads, configs.get('calib_dir'))
+        bank_configs = configs.get('memory_bank', {})
+        if models['ad_model'].get('format') == 'memory_bank':
+            # a coreset memory bank searched with an IVF index, nprobe trades speed for recall
+            self.models['ad_model'] = PatchMemoryModel.from_model_role(
+                models['ad_model'],
+                n_lists=bank_configs.get('n_lists', 64),
+                nprobe=bank_configs.get('nprobe', 4),
+                num_threads=num_threads,
+            )
+        elif models['ad_model'].get('format') in cpu_backend.CPU_FORMATS:
+            self.models['ad_model'] = cpu_backend.AnomalyCpuModel.from_model_role(models['ad_model'], num_threads)
+        else:
+            self.load_models(models, configs, 'ad_model')
         self.logger.info('models are loaded')
+        
+        # archive the frames in a background thread
+        self.archiver = None
+        archive_configs = configs.get('archive', {})
+        if archive_configs.get('enabled'):
+            self.archiver = AsyncArchiver(
+                pass_every_n=archive_configs.get('pass_every_n', 1),
+                fsync=archive_configs.get('fsync', 'batch'),
+                lossless=archive_configs.get('lossless', False),
+                capacity=archive_configs.get('capacity'),
+            )
+        
+        # collect a deduplicated dataset of PASS frames for the automated anomaly detection training
+        self.collector = None
+        dataset_configs = configs.get('ad_dataset', {})
+        if dataset_configs.get('enabled'):
+            self.collector = DatasetCollector.from_ad_config(
+                dataset_configs['config_file'], dataset_configs['model_role'], dataset_configs['out_dir'],
+            )
+        
+        # publish the aggregated decision stats for the GadgetApp charts
+        self.stats, self.stats_publisher = None, None
+        stats_configs = configs.get('decision_stats', {})
+        if stats_configs.get('enabled'):
+            self.stats = DecisionStats(stats_configs.get('windows', [60, 600]))
+            self.stats_publisher = StatsPublisher(
+                stats_configs.get('topic', 'pipeline/pipeline/stats'),
+                stats_configs.get('address') or None,
+                stats_configs.get('interval', 1.0),
+            )
     
     
     @Base.track_exception(logger)
@@ -87,6 +137,8 @@ class ModelPipeline(Base):
         err_threshold = confs['threshold_min']
         err_max = confs['threshold_max']
         err_size = confs['anomaly_size']
+        if isinstance(self.models['ad_model'], PatchMemoryModel):
+            self.models['ad_model'].nprobe = configs.get('memory_bank', {}).get('nprobe', 4)
         
         # run the object detection model
         err_map = self.models['ad_model'].predict(image)
@@ -107,10 +159,35 @@ class ModelPipeline(Base):
         tag = PASS if decision == PASS else FAIL
         self.update_results('tags', tag, to_factory=True)
         
+        # queue the PASS frames for the training dataset, near-duplicates are rejected in the background
+        if self.collector and decision == PASS:
+            self.collector.offer(image)
+        
+        # queue the frame and the annotated image for archiving, it never blocks
+        if self.archiver:
+            name = f'{time.time_ns()}_{decision}'
+            self.archiver.submit({name: image, name + '_annotated': annotated_image}, decision)
+            self.logger.debug(f'archiver stats: {self.archiver.stats()}')
+        
         total_proc_time = time.time()-start_time
         self.logger.info(f'total proc time: {total_proc_time:.4f}s\n')
         
+        if self.stats:
+            self.stats.add(decision, total_proc_time)
+            self.stats_publisher.maybe_publish(self.stats)
+        
         return self.results
+    
+    
+    def clean_up(self, *args, **kwargs):
+        """write the queued archive files and dataset frames, then clean up the models"""
+        if getattr(self, 'archiver', None):
+            self.archiver.close()
+        if getattr(self, 'collector', None):
+            self.collector.close()
+        if getattr(self, 'stats_publisher', None):
+            self.stats_publisher.close()
+        super().clean_up(*args, **kwargs)
 
 
 
@@ -0,0 +1,239 @@
+import time
+import os
+import sys
+import cv2
+import logging
+import torch
+import ultralytics # fix empty results issue for ARM
+
+# local imports
+from pipeline_base import PipelineBase as Base
+from pipeline_tools import cascade, cpu_backend, fan_in, lazy_outputs
+
+# functions from the LMI AI Solutions repo: https://github.com/lmitechnologies/LMI_AI_Solutions
+import gadget_utils.pipeline_utils as pipeline_utils
+from image_utils.img_resize import resize_and_pad
+
+
+PASS = 'PASS'
+FAIL = 'FAIL'
+MODEL_ROLES = ['cls_model', 'seg_model']
+
+
+class ModelPipeline(Base):
+    """
+    a classification model screens every frame, only the suspicious frames are sent to the segmentation model
+    """
+    
+    logger = logging.getLogger(__name__)
+    
+    
+    @Base.track_exception(logger)
+    def __init__(self, **kwargs) -> None:
+        """initialize the pipeline
+        
+        Args:
+            kwargs: configs defined in the pipeline_def.json
+        """
+        super().__init__(**kwargs)
+        self.logger.info(f'gadget version: {self.version}')
+        
+    
+    @Base.track_exception(logger)
+    def load(self, models, configs):
+        """load the model(s)
+
+        Args:
+            models (dict): model roles
+            configs (dict): runtime configs
+        """
+        # export the roles with a cpu format (onnx/openvino/int8) from their pt artifacts
+        models = cpu_backend.prepare_cpu_models(models, configs.get('cpu_threads', 0), configs.get('calib_dir'))
+        self.load_models(models, configs, 'cls_model')
+        self.load_models(models, configs, 'seg_model')
+        self.logger.info('models are loaded')
+        
+        # the pass classes must be classes of the gate model
+        classes = models['cls_model'].get('details', {}).get('object_class')
+        if classes:
+            cascade.check_pass_classes(configs.get('cascade', {}).get('pass_classes', []), classes)
+    
+    
+    @Base.track_exception(logger)
+    def warm_up(self, configs):
+        """warm up the models for the first time
+
+        Args:
+            configs (dict): runtime configs
+        """
+        t1 = time.time()
+        self.models['cls_model'].warmup()
+        self.models['seg_model'].warmup()
+        t2 = time.time()
+        self.logger.info(f'warm up time: {t2-t1:.4f}')
+    
+    
+    def run_gate(self, image):
+        """run the classification model
+
+        Args:
+            image (numpy): a RGB image
+
+        Returns:
+            str: the top class
+            float: its score
+        """
+        th,tw = self.models['cls_model'].image_size
+        processed_im = resize_and_pad(image, tw, th, maintain_aspect_ratio=True)
+        results_dict, time_info = self.models['cls_model'].predict(processed_im)
+        return results_dict['classes'][0], float(results_dict['scores'][0])
+    
+    
+    def run_seg(self, configs, image):
+        """run the segmentation model, the results are in the original image space"""
+        h0,w0 = image.shape[:2]
+        th,tw = self.models['seg_model'].image_size
+        processed_im = cv2.resize(image, (tw,th))
+        operators = [{'resize':[tw,th,w0,h0]}]
+        confs = configs['models']['seg_model']['configs']['confidence']
+        results_dict, time_info = self.models['seg_model'].predict(processed_im, confs, operators)
+        return results_dict
+    
+    
+    @torch.inference_mode()
+    @Base.track_exception(logger)
+    def predict(self, configs: dict, inputs:dict) -> dict:
+        """predict the result based on the inputs
+
+        Args:
+            configs (dict): runtime configs
+            inputs (dict): inputs
+
+        Raises:
+            Exception: failed to load pipeline model(s)
+
+        Returns:
+            dict: a result dictionary
+        """
+        start_time = time.time()
+        # init a result dict
+        self.init_results()
+        
+        image = inputs['image']['pixels']
+        
+        if not self.models:
+            raise Exception('failed to load pipeline model(s)')
+        
+        # the roles of the sensor topic of the frame, the models are shared by all the topics
+        roles = [r for r in fan_in.get_topic_roles(configs, inputs, MODEL_ROLES) if r in MODEL_ROLES]
+        if not roles:
+            raise Exception(f'the topic {inputs.get("topic")} has none of the roles {MODEL_ROLES}')
+        
+        # screen the frame with the classification model, the topics without the gate go to segmentation
+        cascade_configs = configs.get('cascade', {})
+        gate_cls, gate_score, suspicious = None, 0.0, True
+        if 'cls_model' in roles:
+            gate_cls, gate_score = self.run_gate(image)
+            suspicious = cascade.is_suspicious(
+                gate_cls, gate_score, cascade_configs.get('pass_classes', []), cascade_configs.get('threshold', 0.9),
+            )
+            self.update_results('gate_class', gate_cls)
+            self.update_results('gate_score', gate_score, to_factory=True)
+        self.update_results('suspicious', suspicious, to_factory=True)
+        
+        objects = []
+        if suspicious and 'seg_model' in roles:
+            # only the suspicious frames pay for the segmentation model
+            outputs = lazy_outputs.get_role_outputs(configs, 'seg_model')
+            results_dict = self.run_seg(configs, image)
+            annotated_image = self.models['seg_model'].annotate_image(results_dict, image)
+            objects = results_dict['classes']
+            h0,w0 = image.shape[:2]
+            for i,name in enumerate(objects):
+                score = results_dict['scores'][i]
+                if 'boxes' in outputs:
+                    self.add_prediction('boxes', results_dict['boxes'][i].astype(int), score, name, h0, w0)
+                if 'segments' in outputs:
+                    self.add_prediction('polygons', results_dict['segments'][i].astype(int), score, name, h0, w0)
+        else:
+            annotated_image = image.copy()
+            cv2.putText(annotated_image, f'{gate_cls}: {gate_score:.2f}', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        
+        # upload annotated image to GadgetAPP and GoFactory
+        self.update_results('outputs', annotated_image, sub_key='annotated')
+        
+        # upload decision to the Gadget automation service
+        decision = PASS if len(objects) == 0 else FAIL # assume no object is PASS
+        if 'seg_model' not in roles:
+            # the gate decides alone
+            decision = FAIL if suspicious else PASS
+        self.update_results('decision', decision, to_automation=True)
+        
+        # upload tags to GoFactory
+        tag = PASS if decision == PASS else FAIL
+        self.update_results('tags', tag, to_factory=True)
+        
+        total_proc_time = time.time()-start_time
+        
+        self.logger.info(f'gate: {gate_cls} ({gate_score:.2f}), suspicious: {suspicious}, found objects: {objects}')
+        self.logger.info(f'total proc time: {total_proc_time:.4f}s\n')
+        
+        return self.results
+
+
+
+if __name__ == '__main__':
+    import shutil
+    BATCH_SIZE = 1
+    pipeline_def_file = './pipeline/pipeline_def.json'
+    static_manifest_file = '/app/models/static/examples/cascade/yolo/manifest.json'
+    image_dir = './data'
+    gate_eval_dir = './data/gate_eval' # a labelled folder with one sub-folder per class
+    output_dir = './outputs/cascade/yolo'
+    fmts = ['jpg', 'png']
+    
+    logging.basicConfig()
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    
+    # delete contents in the output dir
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # load the pipeline definition
+    kwargs = pipeline_utils.load_pipeline_def(pipeline_def_file)
+    # create manifest for static models
+    manifest = pipeline_utils.get_models_from_static_manifest(static_manifest_file)
+    kwargs['models'] = manifest
+    
+    pipeline = ModelPipeline(**kwargs)
+    pipeline.load(manifest, kwargs)
+    pipeline.warm_up(kwargs)
+    
+    # measure the miss rate of the gate at several thresholds
+    if os.path.isdir(gate_eval_dir):
+        cascade.evaluate_gate(pipeline.run_gate, gate_eval_dir, kwargs['cascade']['pass_classes'])
+
+    image_path_batches = []
+    for fmt in fmts:
+        image_path_batches += pipeline_utils.get_img_path_batches(BATCH_SIZE, image_dir, fmt=fmt)
+        
+    for batch in image_path_batches:
+        for image_path in batch:
+            fname = os.path.basename(image_path)
+            logger.info(f'processing {fname}...')
+            im_bgr = cv2.imread(image_path)
+            im = cv2.cvtColor(im_bgr, cv2.COLOR_BGR2RGB)
+            
+            inputs = {
+                'image':{'pixels':im},
+            }
+            results = pipeline.predict(kwargs, inputs)
+            assert pipeline.check_return_types(), 'invalid return types'
+            
+            annotated_image = results['outputs']['annotated']
+            tmp = cv2.cvtColor(annotated_image,cv2.COLOR_RGB2BGR)
+            cv2.imwrite(os.path.join(output_dir, fname.replace(f'.{fmt}',f'_annotated.{fmt}')), tmp)
+    
+    pipeline.clean_up()
@@ -8,6 +8,7 @@ import ultralytics # fix empty results issue for ARM
 
 # local imports
 from pipeline_base import PipelineBase as Base
+from pipeline_tools import cpu_backend, image_io, warmup
 
 # functions from the LMI AI Solutions repo: https://github.com/lmitechnologies/LMI_AI_Solutions
 import gadget_utils.pipeline_utils as pipeline_utils
@@ -43,7 +44,11 @@ class ModelPipeline(Base):
             models (dict): model roles
             configs (dict): runtime configs
         """
+        # export the roles with a cpu format (onnx/openvino/int8) from their pt artifacts
+        models = cpu_backend.prepare_cpu_models(models, configs.get('cpu_threads', 0), configs.get('calib_dir'))
         self.load_models(models, configs, "cls_model")
+        self.model_format = models['cls_model'].get('format')
+        self.model_paths = [a['model_path'] for a in models['cls_model'].get('artifacts', {}).values() if 'model_path' in a]
         self.logger.info('models are loaded')
     
     
@@ -56,6 +61,21 @@ class ModelPipeline(Base):
         """
         t1 = time.time()
         self.models['cls_model'].warmup()
+        
+        # warm up on the model input size, and tune the cpu threads
+        warmup_configs = configs.get('warmup', {})
+        if warmup_configs.get('enabled'):
+            inputs = warmup.get_warmup_inputs(self.models['cls_model'].image_size, warmup_configs.get('image_dir'))
+            # the torch threads only apply to the pt models, the sessions of the cpu formats are created by the wrapper
+            tune = warmup_configs.get('tune_threads', False)
+            if tune and self.model_format in cpu_backend.CPU_FORMATS:
+                self.logger.warning(f'cannot tune the threads of the {self.model_format} session, only warm up')
+                tune = False
+            warmup.warm_up_role(
+                'cls_model', self.models['cls_model'].predict, inputs, self.model_paths,
+                tune=tune,
+                cache_file=warmup_configs.get('cache_file'),
+            )
         t2 = time.time()
         self.logger.info(f'warm up time: {t2-t1:.4f}')
         
@@ -94,14 +114,16 @@ class ModelPipeline(Base):
         # init a result dict
         self.init_results()
         
+        # the image is annotated in its channel order, only the model input is converted to RGB
         image = inputs['image']['pixels']
+        channel_order = inputs['image'].get('channel_order', image_io.RGB)
         
         if not self.models:
             raise Exception('failed to load pipeline model(s)')
         
         # run the object detection model
         hw = self.models['cls_model'].image_size
-        processed_im = self.preprocess(image, hw)
+        processed_im = image_io.to_rgb(self.preprocess(image, hw), channel_order)
         results_dict, time_info = self.models['cls_model'].predict(processed_im)
         
         # upload decision to the Gadget automation service
@@ -170,22 +192,21 @@ if __name__ == '__main__':
             # load a image
             fname = os.path.basename(image_path)
             logger.info(f'processing {fname}...')
-            im_bgr = cv2.imread(image_path)
-            im = cv2.cvtColor(im_bgr, cv2.COLOR_BGR2RGB)
+            # decode a jpg at the reduced resolution that the model needs, and keep it in BGR
+            im_bgr, factor = image_io.read_image(image_path, pipeline.models['cls_model'].image_size)
             
             # convert to the input format
             inputs = {
-                'image':{'pixels':im},
+                'image':{'pixels':im_bgr, 'channel_order':image_io.BGR},
             }
             
             # run the pipeline
             results = pipeline.predict(kwargs, inputs)
             assert pipeline.check_return_types(), 'invalid return types'
             
-            # save the annotated image
-            annotated_image = results['outputs']['annotated']
-            bgr = cv2.cvtColor(annotated_image,cv2.COLOR_RGB2BGR)
-            cv2.imwrite(os.path.join(output_dir, fname.replace(f'.{fmt}',f'_annotated.{fmt}')), bgr)
+            # save the annotated image, which is in BGR as the inputs, at the size of the source
+            annotated_image = image_io.upscale(results['outputs']['annotated'], factor)
+            cv2.imwrite(os.path.join(output_dir, fname.replace(f'.{fmt}',f'_annotated.{fmt}')), annotated_image)
     
     pipeline.clean_up()
     
\ No newline at end of file
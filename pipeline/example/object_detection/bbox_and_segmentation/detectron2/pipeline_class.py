@@ -9,6 +9,7 @@ import json
 
 # local imports
 from pipeline_base import PipelineBase as Base
+from pipeline_tools import lazy_outputs
 
 # functions from the LMI AI Solutions repo: https://github.com/lmitechnologies/LMI_AI_Solutions
 import gadget_utils.pipeline_utils as pipeline_utils
@@ -105,12 +106,14 @@ class ModelPipeline(Base):
         
         # load runtime config
         confs = configs['models']['od_model']['configs']['confidence'] # confidence thresholds
+        outputs = lazy_outputs.get_role_outputs(configs, 'od_model')   # the outputs to upload
     
         # run the object detection model
         hw = self.models['od_model'].image_size
         processed_im, operators = self.preprocess(image, hw)
         # the results are all in the original image space
-        results_dict = self.models['od_model'].predict(processed_im, confs=confs, operators=operators, return_segments=True)
+        # the polygons are only extracted from the masks if they are uploaded
+        results_dict = self.models['od_model'].predict(processed_im, confs=confs, operators=operators, return_segments='segments' in outputs)
         
         # annotate the image using bounding boxes
         results_dict = {k:v[0] for k,v in results_dict.items()}
@@ -124,16 +127,16 @@ class ModelPipeline(Base):
         boxes = results_dict['boxes']           # bounding boxes
         scores = results_dict['scores']         # scores for the bounding boxes
         masks = results_dict['masks']           # binary masks for instance segmentation
-        segments = results_dict['segments']     # polygons according to the masks
+        segments = results_dict.get('segments') # polygons according to the masks
         
         # upload predictions to GoFactory
         h0,w0 = image.shape[:2]
         for i,name in enumerate(objects):
-            box = boxes[i].astype(int)
-            seg = segments[i].astype(int)
             score = scores[i]
-            self.add_prediction('boxes', box, score, name, h0, w0)
-            self.add_prediction('polygons', seg, score, name, h0, w0)
+            if 'boxes' in outputs:
+                self.add_prediction('boxes', boxes[i].astype(int), score, name, h0, w0)
+            if 'segments' in outputs:
+                self.add_prediction('polygons', segments[i].astype(int), score, name, h0, w0)
         self.logger.info(f'predictions length: {len(self.results["outputs"]["labels"]["content"]["predictions"])}')
         
         # upload decision to the Gadget automation service
@@ -8,6 +8,8 @@ import ultralytics # fix empty results issue for ARM
 
 # local imports
 from pipeline_base import PipelineBase as Base
+from pipeline_tools import cpu_backend, lazy_outputs, quantization, tracing
+from pipeline_tools.preview_pyramid import TileStore
 
 # functions from LMI AI Solutions repo: https://github.com/lmitechnologies/LMI_AI_Solutions
 import gadget_utils.pipeline_utils as pipeline_utils
@@ -26,13 +28,29 @@ class ModelPipeline(Base):
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
         self.logger.info(f'gadget version: {self.version}')
+        # the spans are exported to TRACE_EXPORT_PATH if it is set
+        self.tracer = tracing.Tracer('pipeline')
         
     
     @Base.track_exception(logger)
     def load(self, models, configs):
         """load the models"""
+        # export the roles with a cpu format (onnx/openvino/int8) from their pt artifacts
+        models = cpu_backend.prepare_cpu_models(models, configs.get('cpu_threads', 0), configs.get('calib_dir'))
         self.load_models(models, configs, 'seg_model')
         self.logger.info('models are loaded')
+        
+        # upload a preview of the annotated image, its full resolution tiles are served on request
+        self.tiles = None
+        tile_configs = configs.get('preview_tiles', {})
+        if tile_configs.get('enabled'):
+            self.tiles = TileStore(
+                tile_configs.get('preview_size', 1024),
+                tile_configs.get('tile_size', 512),
+                tile_configs.get('max_frames', 20),
+                tile_configs.get('max_bytes', 256*1024**2),
+            )
+            self.tiles.serve(tile_configs.get('port', 8090))
     
     
     @Base.track_exception(logger)
@@ -63,6 +81,7 @@ class ModelPipeline(Base):
     
     @torch.inference_mode()
     @Base.track_exception(logger)
+    @tracing.traced('predict')  # continues the trace of the sensor if the inputs carry one
     def predict(self, configs: dict, inputs) -> dict:
         start_time = time.time()
         # init a result dict
@@ -78,12 +97,22 @@ class ModelPipeline(Base):
         model_configs = configs['models']['seg_model']['configs']
         iou = model_configs['iou']
         confs = model_configs['confidence']
+        outputs = lazy_outputs.get_role_outputs(configs, 'seg_model')   # the outputs to upload
         # run the object detection model
-        processed_im, operators = self.preprocess(image, hw)
-        results_dict, time_info = self.models['seg_model'].predict(processed_im, confs, operators)
+        with self.tracer.span('preprocess'):
+            processed_im, operators = self.preprocess(image, hw)
+        with self.tracer.span('seg_model'):
+            results_dict, time_info = self.models['seg_model'].predict(processed_im, confs, operators)
         
         # annotate the image using polygons
-        annotated_image = self.models['seg_model'].annotate_image(results_dict, image)
+        with self.tracer.span('annotate'):
+            annotated_image = self.models['seg_model'].annotate_image(results_dict, image)
+        if self.tiles:
+            with self.tracer.span('preview'):
+                frame_id = str(time.time_ns())
+                annotated_image, levels = self.tiles.add(frame_id, annotated_image)
+                # the client builds the tile urls from it
+                self.update_results('tiles', self.tiles.describe(frame_id, levels))
         
         # grab the results
         masks = results_dict['masks']   # binary masks for instance segmentation
@@ -93,13 +122,14 @@ class ModelPipeline(Base):
         objects = results_dict['classes']   # class labels
         
         # upload labels to Label Studio and GoFactory
-        h0,w0 = image.shape[:2]
-        for i,name in enumerate(objects):
-            box = boxes[i].astype(int)
-            seg = segs[i].astype(int)
-            score = scores[i]
-            self.add_prediction('boxes', box, score, name, h0, w0)
-            self.add_prediction('polygons', seg, score, name, h0, w0)
+        with self.tracer.span('postprocess'):
+            h0,w0 = image.shape[:2]
+            for i,name in enumerate(objects):
+                score = scores[i]
+                if 'boxes' in outputs:
+                    self.add_prediction('boxes', boxes[i].astype(int), score, name, h0, w0)
+                if 'segments' in outputs:
+                    self.add_prediction('polygons', segs[i].astype(int), score, name, h0, w0)
         self.logger.info(f'predictions length: {len(self.results["outputs"]["labels"]["content"]["predictions"])}')
         
         # upload annotated image to GadgetAPP and GoFactory
@@ -108,6 +138,11 @@ class ModelPipeline(Base):
         # upload decision to the Gadget automation service
         decision = PASS if len(objects) == 0 else FAIL # assume no object is PASS
         self.update_results('decision', decision, to_automation=True)
+        # forward the trace of predict to automation
+        root = self.tracer.current()
+        self.update_results('traceparent', root.traceparent, to_automation=True)
+        root.set_attribute('decision', decision)
+        root.set_attribute('num_objects', len(objects))
         
         # upload tags to GoFactory
         tag = PASS if decision == PASS else FAIL
@@ -119,12 +154,20 @@ class ModelPipeline(Base):
         self.logger.info(f'total proc time: {total_proc_time:.4f}s\n')
         
         return self.results
-
+    
+    
+    def clean_up(self, *args, **kwargs):
+        """stop the tile server, then clean up the models"""
+        if getattr(self, 'tiles', None):
+            self.tiles.close()
+        super().clean_up(*args, **kwargs)
 
 
 if __name__ == '__main__':
     import shutil
     BATCH_SIZE = 1
+    # run the images on several pipeline replicas in separate processes if NUM_WORKERS > 1
+    NUM_WORKERS = int(os.environ.get('NUM_WORKERS', 1))
     pipeline_def_file = './pipeline/pipeline_def.json'
     static_manifest_file = '/app/models/static/examples/object_detection/bbox_and_segmentation/yolo/manifest.json'
     image_dir = './data'
@@ -148,30 +191,59 @@ if __name__ == '__main__':
     
     pipeline = ModelPipeline(**kwargs)
     
-    logger.info('start loading the pipeline...')
-    pipeline.load(manifest, kwargs)
-    pipeline.warm_up(kwargs)
-
-    image_path_batches = []
+    if manifest['seg_model']['format'] == 'int8':
+        # the offline validation: compare the int8 model with the float onnx model, it is only activated by load
+        # if the accuracy is within tolerance
+        confs = kwargs['models']['seg_model']['configs']['confidence']
+        def run_model(model, im):
+            processed_im, operators = pipeline.preprocess(im, model.image_size)
+            return model.predict(processed_im, confs, operators)[0]
+        quantization.validate_int8_model(pipeline, manifest, kwargs, 'seg_model', image_dir, run_model)
+    
+    image_paths = []
     for fmt in fmts:
-        image_path_batches += pipeline_utils.get_img_path_batches(BATCH_SIZE, image_dir, fmt=fmt)
-        
-    for batch in image_path_batches:
-        for image_path in batch:
-            fname = os.path.basename(image_path)
-            logger.info(f'processing {fname}...')
+        for batch in pipeline_utils.get_img_path_batches(BATCH_SIZE, image_dir, fmt=fmt):
+            image_paths += batch
+    
+    def read_inputs():
+        for image_path in image_paths:
+            logger.info(f'processing {os.path.basename(image_path)}...')
             im_bgr = cv2.imread(image_path)
             im = cv2.cvtColor(im_bgr, cv2.COLOR_BGR2RGB)
-            
-            inputs = {
+            yield {
                 'image':{'pixels':im},
             }
-            results = pipeline.predict(kwargs, inputs)
-            assert pipeline.check_return_types(), 'invalid return types'
-            
-            annotated_image = results['outputs']['annotated']
-            tmp = cv2.cvtColor(annotated_image,cv2.COLOR_RGB2BGR)
-            cv2.imwrite(os.path.join(output_dir, fname.replace(f'.{fmt}',f'_annotated.{fmt}')), tmp)
-    
-    pipeline.clean_up()
+    
+    logger.info('start loading the pipeline...')
+    if NUM_WORKERS > 1:
+        # the replicas would bind the same tile server port
+        kwargs['preview_tiles']['enabled'] = False
+        from pipeline_tools.worker_pool import PipelineWorkerPool
+        pool = PipelineWorkerPool(ModelPipeline, kwargs, manifest, num_workers=NUM_WORKERS, dispatch='least_loaded', pin_cpus=True)
+        results_iter = pool.map(kwargs, read_inputs())
+    else:
+        pipeline.load(manifest, kwargs)
+        pipeline.warm_up(kwargs)
+        def run_pipeline():
+            for inputs in read_inputs():
+                results = pipeline.predict(kwargs, inputs)
+                assert pipeline.check_return_types(), 'invalid return types'
+                yield results
+        results_iter = run_pipeline()
+    
+    # the results come out in the order of the images
+    for image_path, results in zip(image_paths, results_iter):
+        if results is None:
+            logger.error(f'failed to process {image_path}')
+            continue
+        fname = os.path.basename(image_path)
+        name, ext = os.path.splitext(fname)
+        annotated_image = results['outputs']['annotated']
+        tmp = cv2.cvtColor(annotated_image,cv2.COLOR_RGB2BGR)
+        cv2.imwrite(os.path.join(output_dir, f'{name}_annotated{ext}'), tmp)
+    
+    if NUM_WORKERS > 1:
+        pool.close()
+    else:
+        pipeline.clean_up()
     
\ No newline at end of file
@@ -8,6 +8,8 @@ import ultralytics # fix empty results issue for ARM
 
 # local imports
 from pipeline_base import PipelineBase as Base
+from pipeline_tools import cpu_backend, deadline, keypoint_measure
+from pipeline_tools.affine import AffineChain
 
 # functions from LMI AI Solutions repo: https://github.com/lmitechnologies/LMI_AI_Solutions
 import gadget_utils.pipeline_utils as pipeline_utils
@@ -15,6 +17,7 @@ import gadget_utils.pipeline_utils as pipeline_utils
 
 PASS = 'PASS'
 FAIL = 'FAIL'
+DEGRADED = 'DEGRADED'
 MIN_PTS = 4
 
 
@@ -37,8 +40,24 @@ class ModelPipeline(Base):
                 models (dict): model roles
                 configs (dict): runtime configs
         """
+        # export the roles with a cpu format (onnx/openvino/int8) from their pt artifacts
+        models = cpu_backend.prepare_cpu_models(models, configs.get('cpu_threads', 0), configs.get('calib_dir'))
         self.load_models(models, configs, '_model')
         self.logger.info('models are loaded')
+        
+        # the per-frame latency budget and its fallbacks, an unlimited budget if it is disabled
+        deadline_configs = configs.get('deadline', {})
+        if deadline_configs.get('enabled'):
+            self.deadline_monitor = deadline.DeadlineMonitor(
+                deadline_configs['budget_ms'],
+                deadline_configs.get('fallbacks', deadline.DEFAULT_FALLBACKS),
+                events_file=deadline_configs.get('events_file') or None,
+            )
+            small_role = deadline_configs.get('small_role')
+            if self.deadline_monitor.allows(deadline.SMALL_ROLE) and small_role not in self.models:
+                self.logger.warning(f'the small role "{small_role}" is not loaded, the small_role fallback is unavailable')
+        else:
+            self.deadline_monitor = deadline.DeadlineMonitor(float('inf'), [])
     
     
     @Base.track_exception(logger)
@@ -50,27 +69,47 @@ class ModelPipeline(Base):
                 configs (dict): runtime configs
         """
         t1 = time.time()
-        self.models['pose_model'].warmup()
+        for role in self.models:
+            self.models[role].warmup()
         t2 = time.time()
         self.logger.info(f'warm up time: {t2-t1:.4f}')
         
         
-    def preprocess(self, image, hw):
+    def preprocess(self, image, hw, roi=None):
         """preprocess the image for object detection
 
         Args:
             image (numpy): a numpy array of image
             hw (list): a list of [height, width]
+            roi (list, optional): a region of interest of [x1,y1,x2,y2]. Defaults to the whole image.
 
         Returns:
             img (numpy): a resized image
-            operators (list): a list of operators used for converting back to original image size
+            chain (AffineChain): the chain of the operators, its inverse converts back to original image size
         """
         h0,w0 = image.shape[:2]
         th,tw = hw
-        img = cv2.resize(image, (tw,th))
-        operators = [{'resize':[tw,th,w0,h0]}]
-        return img, operators
+        chain = AffineChain(w0, h0)
+        if roi:
+            chain.crop(*roi)
+        # the crop and the resize in one resampling
+        img = chain.resize(tw, th).warp(image)
+        return img, chain
+    
+    
+    def get_measurement_specs(self, measurements):
+        """compile the keypoint measurements, only when they are changed
+
+        Args:
+            measurements (dict): a dict of class name to a list of measurements, see keypoint_measure.py
+
+        Returns:
+            dict: a dict of class name to MeasurementSpec
+        """
+        if measurements != getattr(self, 'measurements', None):
+            self.measurements = measurements
+            self.measurement_specs = keypoint_measure.compile_specs(measurements)
+        return self.measurement_specs
     
     
     @torch.inference_mode()
@@ -85,17 +124,42 @@ class ModelPipeline(Base):
         if not self.models:
             raise Exception('failed to load pipeline model(s)')
         
+        # start the deadline of the frame
+        deadline_configs = configs.get('deadline', {})
+        monitor = self.deadline_monitor
+        frame_deadline = monitor.start(start_time)
+        
+        # fall back to the smaller role if the main model doesn't fit in the remaining budget
+        role = 'pose_model'
+        small_role = deadline_configs.get('small_role')
+        if not monitor.affords(frame_deadline, role):
+            if monitor.allows(deadline.SMALL_ROLE) and small_role in self.models and monitor.affords(frame_deadline, small_role):
+                monitor.record(frame_deadline, role, deadline.SMALL_ROLE)
+                role = small_role
+            elif monitor.allows(deadline.PASS_THROUGH):
+                monitor.record(frame_deadline, role, deadline.PASS_THROUGH)
+                return self.pass_through(image, deadline_configs.get('pass_through_decision', FAIL), frame_deadline.events)
+        
         # load runtime config
-        hw = self.models['pose_model'].image_size
+        hw = self.models[role].image_size
         model_configs = configs['models']['pose_model']['configs']
         confs = model_configs['confidence']
                 
         # run the object detection model
-        processed_im, operators = self.preprocess(image, hw)
-        results_kp, time_info = self.models['pose_model'].predict(processed_im, confs, operators)
+        with monitor.stage(role):
+            processed_im, chain = self.preprocess(image, hw, configs.get('roi'))
+            # no operators, the outputs are converted back to original image size at once by the inverse chain
+            results_kp, time_info = self.models[role].predict(processed_im, confs, [])
+            results_kp['boxes'] = chain.inverse.apply_boxes(results_kp['boxes'])
+            results_kp['points'] = chain.inverse.apply_points(results_kp['points'])
         
-        # annotate the image using key points
-        annotated_image = self.models['pose_model'].annotate_image(results_kp, image)
+        # annotate the image using key points, unless it doesn't fit in the remaining budget, then send the raw image
+        annotated_image = image
+        if monitor.allows(deadline.SKIP_ANNOTATION) and not monitor.affords(frame_deadline, 'annotate'):
+            monitor.record(frame_deadline, 'annotate', deadline.SKIP_ANNOTATION)
+        else:
+            with monitor.stage('annotate'):
+                annotated_image = self.models[role].annotate_image(results_kp, image)
         
         # upload annotated image to GadgetAPP and GoFactory
         self.update_results('outputs', annotated_image, sub_key='annotated')
@@ -116,13 +180,32 @@ class ModelPipeline(Base):
                 self.add_prediction('keypoints', pt, score, c, h0, w0)
         self.logger.info(f'predictions length: {len(self.results["outputs"]["labels"]["content"]["predictions"])}')
         
+        # measure the keypoints of all the instances at once
+        specs = self.get_measurement_specs(configs.get('measurements', {}))
+        failed = []
+        if specs:
+            measures = keypoint_measure.measure_instances(
+                results_kp['points'], objects, specs, configs.get('pixel_size', 1.0), configs.get('keypoint_conf', 0.5),
+            )
+            # a frame without an instance of a measured class fails
+            failed = measures['failed'] + [f'missing_{c}' for c in measures['missing']]
+            decision = PASS if measures['ok'] else FAIL
+            self.logger.info(f'measurements: {measures["values"]}, missing: {measures["missing"]}')
+        else:
+            decision = PASS if len(pts)>MIN_PTS else FAIL 
+        
         # upload decision to the automation service
-        decision = PASS if len(pts)>MIN_PTS else FAIL 
         self.update_results('decision', decision, to_automation=True)
         
-        # upload tags to GoFactory
+        # record the fallbacks of the frame, and an overrun of the budget
+        degraded = monitor.finish(frame_deadline)
+        if degraded:
+            self.update_results('degraded', degraded, to_factory=True)
+        
+        # upload tags to GoFactory, including the measurements out of tolerance and the degraded mode
         tag = PASS if decision == PASS else FAIL
-        self.update_results('tags', tag, to_factory=True)
+        tags = [tag] + failed + ([DEGRADED] if degraded else [])
+        self.update_results('tags', tags, to_factory=True)
         
         total_proc_time = time.time()-start_time
         
@@ -131,6 +214,25 @@ class ModelPipeline(Base):
         self.logger.info(f'total proc time: {total_proc_time:.4f}s\n')
         
         return self.results
+    
+    
+    def pass_through(self, image, decision, degraded):
+        """return a marked pass-through result without running the model
+
+        Args:
+            image (numpy): the input image
+            decision (str): the pass-through decision
+            degraded (list): the fallbacks taken for the frame
+
+        Returns:
+            dict: a result dictionary
+        """
+        self.update_results('outputs', image, sub_key='annotated')
+        self.update_results('decision', decision, to_automation=True)
+        self.update_results('degraded', degraded, to_factory=True)
+        self.update_results('tags', [decision, DEGRADED], to_factory=True)
+        self.logger.warning(f'pass-through decision: {decision}')
+        return self.results
 
 
 
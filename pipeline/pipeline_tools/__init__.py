@@ -0,0 +1,7 @@
+"""
+Description:
+helper modules shared by the pipeline classes.
+
+Each module is independent and only imports its heavy dependencies (torch, onnxruntime, ...) when used,
+so a pipeline class only pays for the helpers it actually calls.
+"""
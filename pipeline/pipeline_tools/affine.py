@@ -0,0 +1,211 @@
+"""
+Description:
+compose the preprocessing operators (resize, pad, crop, tile offset, rotate) into a single affine transform.
+
+The preprocess of a pipeline maps the original image to the model input. Mapping the outputs back through a list of
+operators, one operator and one output type at a time, costs a python loop per frame. AffineChain keeps the chain as
+one 3x3 matrix instead, so the boxes, the polygons and the keypoints are mapped with one numpy call each, and its
+inverse maps the original coordinates to the model input, e.g. to crop a ROI.
+
+The operators lists of the LMI pipeline utils are converted by from_operators:
+    {'resize': [tw, th, w0, h0]}, {'stretch': [tw, th, w0, h0]}: from the size of (w0, h0) to (tw, th)
+    {'pad': [left, right, top, bottom]}
+    {'crop': [x1, y1, x2, y2]}, {'tile': [x, y, w, h]}
+    {'rotate': [angle]}: counter-clockwise in degrees around the center, the size is unchanged
+
+Example:
+    chain = AffineChain(w0, h0).crop(*roi).resize(tw, th)
+    im = chain.warp(image)                            # the crop and the resize in one resampling
+    ...
+    boxes = chain.inverse.apply_boxes(boxes)          # model input to the original image
+    points = chain.inverse.apply_points(points)
+"""
+
+import logging
+import numpy as np
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+
+class AffineChain:
+    """
+    a chain of affine operators, from the original image to the processed image
+    """
+
+    def __init__(self, w:int, h:int, matrix:np.ndarray=None, size:tuple=None) -> None:
+        """
+        Args:
+            w (int): the width of the original image
+            h (int): the height of the original image
+            matrix (np.ndarray, optional): the 3x3 matrix of the chain. Defaults to the identity.
+            size (tuple, optional): the (w, h) of the processed image. Defaults to (w, h).
+        """
+        self.input_size = (int(w), int(h))
+        self.matrix = np.eye(3) if matrix is None else np.asarray(matrix, dtype=np.float64)
+        self.size = tuple(size) if size is not None else self.input_size
+
+
+    def then(self, m:np.ndarray, size:tuple) -> 'AffineChain':
+        """append an operator to the chain
+
+        Args:
+            m (np.ndarray): the 3x3 matrix of the operator
+            size (tuple): the (w, h) of the image after the operator
+        """
+        self.matrix = m @ self.matrix
+        self.size = (int(size[0]), int(size[1]))
+        return self
+
+
+    def resize(self, tw:int, th:int) -> 'AffineChain':
+        w, h = self.size
+        return self.then(np.diag([tw / w, th / h, 1.0]), (tw, th))
+
+
+    def pad(self, left:int, right:int, top:int, bottom:int) -> 'AffineChain':
+        w, h = self.size
+        return self.then(translation(left, top), (w + left + right, h + top + bottom))
+
+
+    def crop(self, x1:int, y1:int, x2:int, y2:int) -> 'AffineChain':
+        return self.then(translation(-x1, -y1), (x2 - x1, y2 - y1))
+
+
+    def tile(self, x:int, y:int, w:int, h:int) -> 'AffineChain':
+        """the offset of a tile, the same as a crop"""
+        return self.crop(x, y, x + w, y + h)
+
+
+    def letterbox(self, tw:int, th:int) -> 'AffineChain':
+        """resize keeping the aspect ratio and pad to (tw, th) evenly"""
+        w, h = self.size
+        r = min(tw / w, th / h)
+        nw, nh = round(w * r), round(h * r)
+        left, top = (tw - nw) // 2, (th - nh) // 2
+        return self.resize(nw, nh).pad(left, tw - nw - left, top, th - nh - top)
+
+
+    def rotate(self, angle:float, expand:bool=False) -> 'AffineChain':
+        """rotate counter-clockwise around the center, as cv2.getRotationMatrix2D
+
+        Args:
+            angle (float): the angle in degrees
+            expand (bool, optional): grow the size to fit the whole rotated image. Defaults to False.
+        """
+        w, h = self.size
+        m = np.eye(3)
+        m[:2] = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        if expand:
+            cos, sin = abs(m[0,0]), abs(m[0,1])
+            nw, nh = int(np.ceil(round(w * cos + h * sin, 6))), int(np.ceil(round(w * sin + h * cos, 6)))
+            m = translation((nw - w) / 2, (nh - h) / 2) @ m
+            return self.then(m, (nw, nh))
+        return self.then(m, (w, h))
+
+
+    @property
+    def inverse(self) -> 'AffineChain':
+        """the chain from the processed image to the original image"""
+        return AffineChain(*self.size, np.linalg.inv(self.matrix), self.input_size)
+
+
+    @classmethod
+    def from_operators(cls, operators:list, w:int, h:int) -> 'AffineChain':
+        """compose an operators list
+
+        Args:
+            operators (list): a list of dicts of an operator name to its arguments, see the module description
+            w (int): the width of the original image
+            h (int): the height of the original image
+        """
+        chain = cls(w, h)
+        for op in operators:
+            for name, args in op.items():
+                if name in ('resize', 'stretch'):
+                    chain.resize(args[0], args[1])
+                elif name in ('pad', 'crop', 'tile', 'rotate'):
+                    getattr(chain, name)(*args)
+                else:
+                    raise Exception(f'unknown operator: {name}')
+        return chain
+
+
+    def warp(self, image:np.ndarray, interpolation:int=cv2.INTER_LINEAR, border_value=0) -> np.ndarray:
+        """transform an image through the whole chain in one resampling"""
+        m = self.matrix
+        if m[0,1] == 0 and m[1,0] == 0 and m[0,0] > 0 and m[1,1] > 0:
+            # no rotation: crop the source region and resize it, which is faster than warpAffine
+            w, h = self.input_size
+            x1, y1 = np.floor(self.inverse.apply_points(np.array([0.0, 0.0]))).astype(int)
+            x2, y2 = np.ceil(self.inverse.apply_points(np.array(self.size, dtype=np.float64))).astype(int)
+            if x1 >= 0 and y1 >= 0 and x2 <= w and y2 <= h and np.allclose(m[:2,2], -m[:2,:2].diagonal() * (x1, y1)):
+                im = image[y1:y2, x1:x2]
+                if im.shape[1::-1] == self.size:
+                    return im
+                return cv2.resize(im, self.size, interpolation=interpolation)
+        return cv2.warpAffine(image, m[:2], self.size, flags=interpolation, borderMode=cv2.BORDER_CONSTANT,
+                              borderValue=border_value)
+
+
+    def apply_points(self, points:np.ndarray) -> np.ndarray:
+        """transform the points in one call
+
+        Args:
+            points (np.ndarray): a [...,2] array of (x,y), extra columns such as the visibility are kept
+
+        Returns:
+            np.ndarray: a float array of the same shape, or [0,2] if there are no points
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim == 1 and not points.size:
+            # no detections, e.g. np.array([])
+            points = points.reshape(0, 2)
+        out = points.copy()
+        out[..., :2] = points[..., :2] @ self.matrix[:2,:2].T + self.matrix[:2,2]
+        return out
+
+
+    def apply_boxes(self, boxes:np.ndarray) -> np.ndarray:
+        """transform the boxes in one call, the boxes of a rotation are the bounds of their corners
+
+        Args:
+            boxes (np.ndarray): a [N,4] array of (x1,y1,x2,y2), extra columns are kept
+
+        Returns:
+            np.ndarray: a float array of the same shape, or [0,4] if there are no boxes
+        """
+        boxes = np.asarray(boxes, dtype=np.float64)
+        if boxes.ndim == 1 and not boxes.size:
+            # no detections, e.g. np.array([])
+            boxes = boxes.reshape(0, 4)
+        x1, y1, x2, y2 = (boxes[..., i] for i in range(4))
+        corners = np.stack([np.stack(c, axis=-1) for c in ((x1,y1), (x2,y1), (x2,y2), (x1,y2))], axis=-2)
+        corners = self.apply_points(corners)
+        out = boxes.copy()
+        out[..., :2] = corners.min(axis=-2)
+        out[..., 2:4] = corners.max(axis=-2)
+        return out
+
+
+    def apply_polygons(self, polygons:list) -> list:
+        """transform a list of polygons of different lengths in one call
+
+        Args:
+            polygons (list): a list of [M,2] arrays
+
+        Returns:
+            list: a list of float arrays
+        """
+        if not len(polygons):
+            return []
+        lengths = [len(p) for p in polygons]
+        pts = self.apply_points(np.concatenate([np.asarray(p).reshape(-1,2) for p in polygons]))
+        return np.split(pts, np.cumsum(lengths)[:-1])
+
+
+def translation(x:float, y:float) -> np.ndarray:
+    m = np.eye(3)
+    m[:2,2] = x, y
+    return m
@@ -0,0 +1,238 @@
+"""
+Description:
+archive frames into the inline storage from a background thread, so that the writes never stall predict.
+
+Frames are sampled once per frame (all FAILs, 1 in N PASSes), so all the images of a sampled frame, e.g. the
+original and the annotated one, are archived together. A sampled frame is queued as one unit, so it is archived
+whole or dropped whole if the queue is full, then its images are encoded and written in batches by a writer thread.
+The fsync policy is one of:
+    always: fsync every file
+    batch: fsync the files and the folder once per batch
+    never: leave it to the OS
+The writer deletes its own oldest files to stay within the capacity, INLINE_CAPACITY_THRESHOLD by default.
+
+Example:
+    archiver = AsyncArchiver(pass_every_n=10, capacity='0.5 GB')
+    archiver.submit({'frame_0001': image, 'frame_0001_annotated': annotated}, decision)
+    archiver.stats()
+    archiver.close()
+"""
+
+import os
+import re
+import time
+import queue
+import logging
+import threading
+import collections
+import numpy as np
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ('always', 'batch', 'never')
+UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+FAIL = 'FAIL'
+
+
+def parse_capacity(capacity:str) -> int:
+    """parse a capacity such as '0.5 GB' into bytes"""
+    m = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B)?\s*', capacity.upper())
+    if not m:
+        raise Exception(f'invalid capacity: {capacity}')
+    return int(float(m.group(1)) * UNITS[m.group(2) or 'B'])
+
+
+class AsyncArchiver:
+    """
+    a background writer of the archived frames
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, root_dir:str=None, sub_dir:str='pipeline_archive', batch_size:int=4, max_queue:int=32,
+                 fsync:str='batch', lossless:bool=False, pass_every_n:int=1, capacity:str=None,
+                 jpeg_quality:int=95) -> None:
+        """
+        Args:
+            root_dir (str, optional): the storage root. Defaults to DATA_STORAGE_ROOT or /app/data.
+            sub_dir (str, optional): the folder in the root to write to. Defaults to pipeline_archive.
+            batch_size (int, optional): the max number of frames written per batch. Defaults to 4.
+            max_queue (int, optional): the max number of queued frames, new frames are dropped when it is full. Defaults to 32.
+            fsync (str, optional): the fsync policy, always, batch or never. Defaults to batch.
+            lossless (bool, optional): write lossless png, which is larger, instead of jpg. Defaults to False.
+            pass_every_n (int, optional): archive 1 in N PASS frames, 0 archives none. Defaults to 1.
+            capacity (str, optional): the max size of the folder, e.g. '0.5 GB'. Defaults to INLINE_CAPACITY_THRESHOLD.
+            jpeg_quality (int, optional): the jpg quality. Defaults to 95.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise Exception(f'unknown fsync policy: {fsync}, must be one of {FSYNC_POLICIES}')
+        root_dir = root_dir or os.environ.get('DATA_STORAGE_ROOT', '/app/data')
+        capacity = capacity or os.environ.get('INLINE_CAPACITY_THRESHOLD')
+        self.out_dir = os.path.join(root_dir, sub_dir)
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.lossless = lossless
+        self.pass_every_n = pass_every_n
+        self.capacity = parse_capacity(capacity) if capacity else None
+        self.jpeg_quality = jpeg_quality
+        self.queue = queue.Queue(maxsize=max_queue)
+
+        # the archived files from oldest to newest, for keeping within the capacity
+        self.files = collections.deque()
+        self.total_size = 0
+        for name in sorted(os.listdir(self.out_dir), key=lambda f: os.path.getmtime(os.path.join(self.out_dir, f))):
+            path = os.path.join(self.out_dir, name)
+            if os.path.isfile(path):
+                size = os.path.getsize(path)
+                self.files.append((path, size))
+                self.total_size += size
+
+        self.num_pass = 0
+        self.counts = collections.Counter()
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.start_time = time.time()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='archiver', daemon=True)
+        self.thread.start()
+
+
+    def should_archive(self, decision:str) -> bool:
+        """sample the frames: all the FAILs, and 1 in pass_every_n PASSes"""
+        if decision == FAIL:
+            return True
+        self.num_pass += 1
+        return self.pass_every_n > 0 and (self.num_pass - 1) % self.pass_every_n == 0
+
+
+    def submit(self, images:dict, decision:str=FAIL) -> bool:
+        """queue the RGB images of a frame to archive, it never blocks
+
+        Args:
+            images (dict): a dict of the file name without extension to a RGB image
+            decision (str, optional): the decision of the frame for sampling. Defaults to FAIL.
+
+        Returns:
+            bool: True if the frame is sampled, its images are dropped together if the queue is full
+        """
+        if not self.should_archive(decision):
+            self.counts['sampled_out'] += len(images)
+            return False
+        try:
+            self.queue.put_nowait(list(images.items()))
+        except queue.Full:
+            self.counts['dropped'] += len(images)
+            return True
+        self.counts['queued'] += len(images)
+        return True
+
+
+    def encode(self, image:np.ndarray) -> tuple:
+        bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if image.ndim == 3 else image
+        if self.lossless:
+            ext, params = '.png', [cv2.IMWRITE_PNG_COMPRESSION, 3]
+        else:
+            ext, params = '.jpg', [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        ok, buf = cv2.imencode(ext, bgr, params)
+        if not ok:
+            raise Exception(f'failed to encode an image of shape {image.shape} and dtype {image.dtype} to {ext}')
+        return buf, ext
+
+
+    def write_batch(self, batch:list) -> None:
+        """write the images of a batch of frames"""
+        t1 = time.time()
+        fds = []
+        written = 0
+        for name, image in (item for frame in batch for item in frame):
+            try:
+                buf, ext = self.encode(image)
+            except Exception:
+                self.counts['failed'] += 1
+                self.logger.exception(f'failed to archive {name}')
+                continue
+            path = os.path.join(self.out_dir, name + ext)
+            tmp = path + '.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.write(fd, buf.tobytes())
+            if self.fsync == 'always':
+                os.fsync(fd)
+            if self.fsync == 'batch':
+                fds.append(fd)
+            else:
+                os.close(fd)
+            # the file only appears under its name once it is complete
+            os.replace(tmp, path)
+            self.files.append((path, buf.nbytes))
+            self.total_size += buf.nbytes
+            self.bytes_written += buf.nbytes
+            written += 1
+        for fd in fds:
+            os.fsync(fd)
+            os.close(fd)
+        if self.fsync == 'batch':
+            dir_fd = os.open(self.out_dir, os.O_RDONLY)
+            os.fsync(dir_fd)
+            os.close(dir_fd)
+        self.counts['written'] += written
+        self.enforce_capacity()
+        self.write_time += time.time() - t1
+
+
+    def enforce_capacity(self) -> None:
+        """delete the oldest archived files until the folder is within the capacity"""
+        if self.capacity is None:
+            return
+        while self.files and self.total_size > self.capacity:
+            path, size = self.files.popleft()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_size -= size
+            self.counts['evicted'] += 1
+
+
+    def run(self) -> None:
+        """the loop of the writer thread"""
+        while not (self.stop_event.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except Exception:
+                self.counts['failed'] += sum(len(frame) for frame in batch)
+                self.logger.exception('failed to archive a batch')
+
+
+    def stats(self) -> dict:
+        """get the writer statistics
+
+        Returns:
+            dict: the queue depth, bytes/sec since start and while writing, the folder size and the file counts
+        """
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return {
+            'queue_depth': self.queue.qsize(),   # in frames
+            'bytes_per_sec': self.bytes_written / elapsed,
+            'write_bytes_per_sec': self.bytes_written / max(self.write_time, 1e-9),
+            'total_size': self.total_size,
+            **self.counts,
+        }
+
+
+    def close(self, timeout:float=10) -> None:
+        """write the queued files and stop the writer thread"""
+        self.stop_event.set()
+        self.thread.join(timeout)
+        self.logger.info(f'archiver stats: {self.stats()}')
@@ -0,0 +1,95 @@
+"""
+Description:
+a cheap gate in front of an expensive model: a classifier screens every frame, and only the suspicious frames are
+sent to the segmentation or detection model.
+
+A frame is cleared by the gate if its top class is one of the `pass_classes` with a score of at least `threshold`,
+otherwise it is suspicious. The cost of the gate is its miss rate: the defective frames it clears are never seen by
+the expensive model. evaluate_gate measures it offline on a labelled folder, one sub-folder per class:
+    gate_eval/
+        good/
+        scratch/
+        dent/
+Frames in the folders of the pass classes are good, the others are defective. The pass classes must be classes of
+the gate model, see check_pass_classes.
+"""
+
+import os
+import logging
+import numpy as np
+
+from pipeline_tools.image_io import load_images
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_suspicious(cls:str, score:float, pass_classes:list, threshold:float) -> bool:
+    """whether a frame is sent to the expensive model
+
+    Args:
+        cls (str): the top class of the gate
+        score (float): the score of the top class
+        pass_classes (list): the classes of good frames
+        threshold (float): the min score to clear a frame
+
+    Returns:
+        bool: False if the gate clears the frame
+    """
+    return not (cls in pass_classes and score >= threshold)
+
+
+def check_pass_classes(pass_classes:list, classes:list) -> None:
+    """raise if a pass class is not a class of the gate model, as no frame would ever be cleared by it
+
+    Args:
+        pass_classes (list): the classes of good frames
+        classes (list): the classes of the gate model, e.g. the object_class of its manifest details
+    """
+    unknown = [c for c in pass_classes if c not in classes]
+    if unknown:
+        raise Exception(f'the pass classes {unknown} are not classes of the gate model: {classes}')
+
+
+def evaluate_gate(run_gate, image_dir:str, pass_classes:list, thresholds:list=(0.5, 0.7, 0.8, 0.9, 0.95, 0.99),
+                  max_images:int=1000) -> dict:
+    """measure the miss rate and the screen rate of the gate at each threshold
+
+    Args:
+        run_gate (callable): a function of a RGB image to the top class and its score
+        image_dir (str): the labelled folder, with one sub-folder per class
+        pass_classes (list): the classes of good frames
+        thresholds (list, optional): the thresholds to evaluate. Defaults to (0.5, 0.7, 0.8, 0.9, 0.95, 0.99).
+        max_images (int, optional): the max number of images per class. Defaults to 1000.
+
+    Returns:
+        dict: a dict of threshold to
+            miss_rate: the fraction of the defective frames cleared by the gate
+            screen_rate: the fraction of all the frames sent to the expensive model
+            false_alarm_rate: the fraction of the good frames sent to the expensive model
+    """
+    good, classes, scores = [], [], []
+    for label in sorted(os.listdir(image_dir)):
+        folder = os.path.join(image_dir, label)
+        if not os.path.isdir(folder):
+            continue
+        for im in load_images(folder, max_images):
+            cls, score = run_gate(im)
+            good.append(label in pass_classes)
+            classes.append(cls)
+            scores.append(float(score))
+    good = np.array(good)
+    cleared_cls = np.isin(np.array(classes), list(pass_classes))
+    scores = np.array(scores)
+    logger.info(f'evaluated the gate on {good.sum()} good and {(~good).sum()} defective frames')
+
+    report = {}
+    for t in thresholds:
+        suspicious = ~(cleared_cls & (scores >= t))
+        report[t] = {
+            'miss_rate': float((~suspicious[~good]).mean()) if (~good).any() else None,
+            'screen_rate': float(suspicious.mean()),
+            'false_alarm_rate': float(suspicious[good].mean()) if good.any() else None,
+        }
+        logger.info(f'threshold {t}: {report[t]}')
+    return report
@@ -0,0 +1,354 @@
+"""
+Description:
+CPU inference backends (ONNX Runtime / OpenVINO) selected by the `format` field of a model role.
+
+A model role whose manifest `format` is `onnx` or `openvino` is exported from its `pt` artifact the first time it is
+loaded, and the exported artifact is added to the role's `artifacts` so the usual loaders can pick it up. The models
+are often mounted read-only, so the artifacts are exported into a folder per pt file under EXPORT_DIR:
+    - ultralytics roles (detection, segmentation, classification, keypoint) are exported with ultralytics and
+      loaded by the LMI wrappers through the ultralytics AutoBackend, so pre/postprocessing and the result dicts
+      are unchanged.
+    - anomalib roles (torchscript) are exported with torch.onnx and served by the AnomalyCpuModel below, which
+      keeps the predict/annotate/warmup API of the LMI anomaly wrapper.
+The `int8` format is an onnx model quantized from the `onnx` artifact, see quantization.py.
+
+The runtimes read their thread counts when a session is created, so the threads of the AnomalyCpuModel are set in its
+session options (get_ort_options, get_openvino_config). The sessions of the ultralytics roles are created by the
+AutoBackend with the runtime defaults, i.e. one thread per physical core.
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import numpy as np
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+CPU_FORMATS = ('onnx', 'openvino', 'int8')
+ONNX_OPSET = 17
+# a writable folder of the exported artifacts
+EXPORT_DIR = os.path.join(os.environ.get('DATA_STORAGE_ROOT', '/app/data'), 'cpu_models')
+
+# the input normalization of the anomalib transforms
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def get_num_threads(num_threads:int=0) -> int:
+    return num_threads if num_threads > 0 else (os.cpu_count() or 1)
+
+
+def set_cpu_threads(num_threads:int=0) -> int:
+    """set the number of intra-op threads of torch.
+    The onnxruntime and openvino sessions take their threads from their options, see get_ort_options.
+
+    Args:
+        num_threads (int, optional): number of threads. Defaults to 0, which uses all the cpu cores.
+
+    Returns:
+        int: the number of threads applied
+    """
+    import torch
+
+    num_threads = get_num_threads(num_threads)
+    torch.set_num_threads(num_threads)
+    logger.info(f'torch cpu threads: {num_threads}')
+    return num_threads
+
+
+def get_ort_options(num_threads:int=0):
+    """the onnxruntime session options with num_threads intra-op threads"""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = get_num_threads(num_threads)
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+
+def get_openvino_config(num_threads:int=0) -> dict:
+    """the openvino compile config with num_threads inference threads"""
+    return {
+        'INFERENCE_NUM_THREADS': get_num_threads(num_threads),
+        'PERFORMANCE_HINT': 'LATENCY',
+    }
+
+
+def get_normalization(model:dict) -> tuple:
+    """get the input normalization of an anomalib model role
+
+    The role can set `normalization` in the manifest to {"mean": [...], "std": [...]}, or to "none" if the
+    normalization is part of the exported model. Defaults to the imagenet mean and std of the anomalib transforms.
+
+    Returns:
+        tuple: the mean and the std, or None and None
+    """
+    norm = model.get('normalization', {})
+    if norm == 'none':
+        return None, None
+    return tuple(norm.get('mean', IMAGENET_MEAN)), tuple(norm.get('std', IMAGENET_STD))
+
+
+def to_nchw(image:np.ndarray, hw:list, mean:tuple=None, std:tuple=None) -> np.ndarray:
+    """resize a RGB image to a float NCHW model input in [0,1], normalized by mean and std if they are given"""
+    h,w = hw
+    img = cv2.resize(image, (w,h)).astype(np.float32) / 255.0
+    if mean is not None:
+        img = (img - np.array(mean, dtype=np.float32)) / np.array(std, dtype=np.float32)
+    return np.ascontiguousarray(img.transpose(2,0,1)[None])
+
+
+def get_export_dir(pt_path:str, export_dir:str=None) -> str:
+    """get the folder of the artifacts exported from a pt file, one per pt file as they are often all named best.pt
+
+    Args:
+        pt_path (str): the path to the pt file
+        export_dir (str, optional): the writable root folder. Defaults to EXPORT_DIR.
+
+    Returns:
+        str: the path to the folder
+    """
+    pt_path = os.path.abspath(pt_path)
+    key = hashlib.md5(pt_path.encode()).hexdigest()[:8]
+    return os.path.join(export_dir or EXPORT_DIR, f'{os.path.basename(os.path.dirname(pt_path))}_{key}')
+
+
+def get_export_path(pt_path:str, fmt:str, export_dir:str=None) -> str:
+    """get the path of the artifact exported from a pt file
+
+    Args:
+        pt_path (str): the path to the pt file
+        fmt (str): the export format, onnx or openvino
+        export_dir (str, optional): the writable root folder. Defaults to EXPORT_DIR.
+
+    Returns:
+        str: the path to an onnx file or an openvino model folder
+    """
+    stem = os.path.join(get_export_dir(pt_path, export_dir), os.path.splitext(os.path.basename(pt_path))[0])
+    if fmt == 'onnx':
+        return stem + '.onnx'
+    if fmt == 'openvino':
+        return stem + '_openvino_model'
+    raise Exception(f'unsupported cpu format: {fmt}')
+
+
+def is_ultralytics(model:dict) -> bool:
+    return model['details'].get('training_package', '').lower().startswith('ultralytics')
+
+
+def is_anomalib(model:dict) -> bool:
+    return model['details'].get('training_package', '').lower().startswith('anomalib')
+
+
+def export_model(model:dict, fmt:str, export_dir:str=None) -> str:
+    """export the pt artifact of a model role to a cpu format
+
+    Args:
+        model (dict): a model role in the models dictionary
+        fmt (str): the export format, onnx or openvino
+        export_dir (str, optional): the writable root folder. Defaults to EXPORT_DIR.
+
+    Returns:
+        str: the path to the exported artifact
+    """
+    pt_path = model['artifacts']['pt']['model_path']
+    hw = list(model['artifacts']['pt']['image_size'])
+    os.makedirs(get_export_dir(pt_path, export_dir), exist_ok=True)
+
+    if is_ultralytics(model):
+        from ultralytics import YOLO
+        # ultralytics exports next to the model file, so export from a link to the pt file in the export folder
+        link = os.path.join(get_export_dir(pt_path, export_dir), os.path.basename(pt_path))
+        if os.path.lexists(link):
+            os.remove(link)
+        try:
+            os.symlink(os.path.abspath(pt_path), link)
+        except OSError:
+            shutil.copy2(pt_path, link)
+        return YOLO(link).export(format=fmt, imgsz=hw, device='cpu')
+
+    if not is_anomalib(model):
+        raise Exception(f"cannot export the training package {model['details'].get('training_package')} to {fmt}")
+
+    import torch
+    onnx_path = get_export_path(pt_path, 'onnx', export_dir)
+    ts_model = torch.jit.load(pt_path, map_location='cpu').eval()
+    dummy = torch.zeros((1,3,*hw), dtype=torch.float32)
+    torch.onnx.export(ts_model, dummy, onnx_path, input_names=['input'], opset_version=ONNX_OPSET)
+    if fmt == 'onnx':
+        return onnx_path
+
+    import openvino as ov
+    ov_dir = get_export_path(pt_path, 'openvino', export_dir)
+    os.makedirs(ov_dir, exist_ok=True)
+    xml_path = os.path.join(ov_dir, os.path.basename(os.path.splitext(pt_path)[0]) + '.xml')
+    ov.save_model(ov.convert_model(onnx_path), xml_path)
+    return ov_dir
+
+
+def prepare_artifact(role:str, model:dict, fmt:str, export_dir:str=None) -> str:
+    """export the pt artifact of a model role, if the artifact of the fmt is missing or older than the pt file
+
+    Args:
+        role (str): the model role
+        model (dict): the model role in the models dictionary
+        fmt (str): the export format, onnx or openvino
+        export_dir (str, optional): the writable root folder of the exports. Defaults to EXPORT_DIR.
+
+    Returns:
+        str: the path to the artifact
+    """
+    artifact = model['artifacts'].get(fmt)
+    if artifact and os.path.exists(artifact['model_path']):
+        return artifact['model_path']
+
+    if 'pt' not in model['artifacts']:
+        raise Exception(f'{role} has neither a {fmt} nor a pt artifact')
+    pt_path = model['artifacts']['pt']['model_path']
+    path = get_export_path(pt_path, fmt, export_dir)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(pt_path):
+        logger.info(f'exporting {role} to {fmt} in {os.path.dirname(path)}...')
+        path = export_model(model, fmt, export_dir)
+    model['artifacts'][fmt] = {
+        'model_path': path,
+        'image_size': model['artifacts']['pt']['image_size'],
+    }
+    return path
+
+
+def prepare_cpu_models(models:dict, num_threads:int=0, calib_dir:str=None, export_dir:str=None) -> dict:
+    """prepare the artifacts of the model roles with a cpu format
+
+    Args:
+        models (dict): model roles
+        num_threads (int, optional): number of cpu threads. Defaults to 0, which uses all the cpu cores.
+        calib_dir (str, optional): a folder of calibration images for the int8 roles. Defaults to None.
+        export_dir (str, optional): the writable root folder of the exports. Defaults to EXPORT_DIR.
+
+    Returns:
+        dict: the model roles whose artifacts include the exported cpu artifacts
+    """
+    cpu_roles = [role for role,model in models.items() if model.get('format') in CPU_FORMATS]
+    if not cpu_roles:
+        return models
+
+    set_cpu_threads(num_threads)
+    for role in cpu_roles:
+        model = models[role]
+        fmt = model['format']
+        if fmt == 'int8':
+            from pipeline_tools import quantization
+            quantization.prepare_int8_model(role, model, calib_dir, export_dir)
+            fmt = model['format']
+        else:
+            prepare_artifact(role, model, fmt, export_dir)
+        logger.info(f"{role} uses the {fmt} artifact: {model['artifacts'][fmt]['model_path']}")
+    return models
+
+
+class AnomalyCpuModel:
+    """
+    an anomalib model served by ONNX Runtime or OpenVINO on the cpu.
+    It has the same predict, annotate and warmup methods as the LMI anomaly model wrapper.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, model_path:str, image_size:list, num_threads:int=0, mean:tuple=IMAGENET_MEAN,
+                 std:tuple=IMAGENET_STD) -> None:
+        """
+        Args:
+            model_path (str): the path to an onnx file or an openvino model folder
+            image_size (list): a list of [height, width]
+            num_threads (int, optional): number of cpu threads. Defaults to 0, which uses all the cpu cores.
+            mean (tuple, optional): the normalization mean, None if the model normalizes. Defaults to IMAGENET_MEAN.
+            std (tuple, optional): the normalization std. Defaults to IMAGENET_STD.
+        """
+        self.model_path = model_path
+        self.image_size = list(image_size)
+        self.mean, self.std = mean, std
+        self.load_session(num_threads)
+
+
+    def load_session(self, num_threads:int=0) -> None:
+        """create the runtime session with num_threads threads"""
+        num_threads = get_num_threads(num_threads)
+        if self.model_path.endswith('.onnx'):
+            import onnxruntime as ort
+            self.session = ort.InferenceSession(self.model_path, get_ort_options(num_threads), providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+            self._forward = lambda x: self.session.run(None, {self.input_name: x})
+        else:
+            import openvino as ov
+            xml_path = self.model_path
+            if os.path.isdir(xml_path):
+                xml_path = [os.path.join(xml_path,f) for f in os.listdir(xml_path) if f.endswith('.xml')][0]
+            self.compiled = ov.Core().compile_model(xml_path, 'CPU', get_openvino_config(num_threads))
+            self._forward = lambda x: list(self.compiled(x).values())
+        self.num_threads = num_threads
+        self.logger.info(f'loaded {self.model_path} with {num_threads} threads')
+
+
+    @classmethod
+    def from_model_role(cls, model:dict, num_threads:int=0):
+        """create the model from a model role prepared by prepare_cpu_models"""
+        artifact = model['artifacts'][model['format']]
+        mean, std = get_normalization(model)
+        return cls(artifact['model_path'], artifact['image_size'], num_threads, mean, std)
+
+
+    def preprocess(self, image:np.ndarray) -> np.ndarray:
+        return to_nchw(image, self.image_size, self.mean, self.std)
+
+
+    def predict(self, image:np.ndarray) -> np.ndarray:
+        """predict the anomaly map of an image
+
+        Args:
+            image (np.ndarray): a RGB image
+
+        Returns:
+            np.ndarray: the anomaly map in the original image size
+        """
+        h0,w0 = image.shape[:2]
+        outputs = self._forward(self.preprocess(image))
+        # the anomaly map is the first output with spatial dimensions
+        err_map = next(o for o in outputs if np.ndim(o) >= 3)
+        err_map = np.asarray(err_map, dtype=np.float32).reshape(err_map.shape[-2:])
+        return cv2.resize(err_map, (w0,h0))
+
+
+    def warmup(self):
+        h,w = self.image_size
+        self.predict(np.zeros((h,w,3), dtype=np.uint8))
+
+
+    def annotate(self, image:np.ndarray, err_map:np.ndarray, err_threshold:float, err_max:float) -> np.ndarray:
+        return annotate_anomaly(image, err_map, err_threshold, err_max)
+
+
+def annotate_anomaly(image:np.ndarray, err_map:np.ndarray, err_threshold:float, err_max:float) -> np.ndarray:
+    """overlay the anomalies above the err_threshold on the image
+
+    Args:
+        image (np.ndarray): a RGB image
+        err_map (np.ndarray): the anomaly map in the image size
+        err_threshold (float): the anomaly threshold
+        err_max (float): the anomaly score mapped to the hottest color
+
+    Returns:
+        np.ndarray: the annotated image
+    """
+    norm = np.clip((err_map - err_threshold) / max(err_max - err_threshold, 1e-6), 0, 1)
+    heat = cv2.applyColorMap((norm * 255).astype(np.uint8), cv2.COLORMAP_JET)
+    heat = cv2.cvtColor(heat, cv2.COLOR_BGR2RGB)
+    blend = cv2.addWeighted(image, 0.5, heat, 0.5, 0)
+    mask = err_map > err_threshold
+    annotated = image.copy()
+    annotated[mask] = blend[mask]
+    return annotated
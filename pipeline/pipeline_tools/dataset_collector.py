@@ -0,0 +1,310 @@
+"""
+Description:
+collect a bounded and diverse dataset for the automated anomaly detection training from a stream of frames.
+
+Each frame is reduced to a 64-bit difference hash and a small thumbnail embedding:
+    - a frame within `dup_distance` bits of a stored frame is rejected as a near-duplicate.
+    - once the reservoir is full, a new frame replaces the most redundant stored frame (the one closest to its
+      nearest neighbour) only if it is further from the reservoir than that frame, so the dataset keeps covering
+      the variation on the line.
+The hashes and embeddings are saved with the images, so restarting the collector doesn't rescan the stored images.
+
+offer() only queues a frame, a background thread hashes it, writes the image and saves the state every `save_every`
+stored images, so predict never waits for the disk. The nearest neighbour of each stored image is kept, so replacing
+an image only recomputes the distances of the images whose nearest neighbour it was.
+
+The dataset size follows the configs of a model role in automated_ad_config.json: training starts at
+`min_dataset_size` images, and each next iteration needs `dataset_increment` more new images, up to `max_iterations`.
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import numpy as np
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+EMBED_SIZE = 16
+STATE_FILE = 'collector_state.npz'
+META_FILE = 'collector_state.json'
+
+
+def dhash(gray:np.ndarray) -> np.uint64:
+    """the 64-bit difference hash of a grayscale image"""
+    small = cv2.resize(gray, (HASH_SIZE+1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+
+def embed(gray:np.ndarray) -> np.ndarray:
+    """a zero-mean unit-norm thumbnail of a grayscale image"""
+    small = cv2.resize(gray, (EMBED_SIZE, EMBED_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+    small -= small.mean()
+    return small / max(float(np.linalg.norm(small)), 1e-6)
+
+
+def hamming(hashes:np.ndarray, h:np.uint64) -> np.ndarray:
+    """the hamming distances between an array of uint64 hashes and a hash"""
+    x = np.bitwise_xor(hashes, h)
+    return np.unpackbits(x.view(np.uint8).reshape(-1,8), axis=1).sum(axis=1)
+
+
+class DatasetCollector:
+    """
+    a streaming, deduplicating reservoir of training images
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, out_dir:str, min_dataset_size:int, dataset_increment:int, max_iterations:int,
+                 dup_distance:int=4, image_format:str='png', max_queue:int=16, save_every:int=10, **kwargs) -> None:
+        """
+        Args:
+            out_dir (str): the folder to save the images to
+            min_dataset_size (int): the number of images to start the first training iteration
+            dataset_increment (int): the number of new images to start each next training iteration
+            max_iterations (int): the max number of training iterations
+            dup_distance (int, optional): the max hamming distance of near-duplicates. Defaults to 4.
+            image_format (str, optional): the image file format. Defaults to png.
+            max_queue (int, optional): the max number of queued frames, new frames are dropped when it is full. Defaults to 16.
+            save_every (int, optional): save the state every N stored images, and on close. Defaults to 10.
+            kwargs: the other configs of automated_ad_config.json, which are ignored
+        """
+        self.out_dir = out_dir
+        self.min_dataset_size = min_dataset_size
+        self.dataset_increment = dataset_increment
+        self.max_iterations = max_iterations
+        self.dup_distance = dup_distance
+        self.image_format = image_format
+        self.save_every = save_every
+        self.capacity = min_dataset_size + dataset_increment * max(max_iterations - 1, 0)
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.names = []
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.embeddings = np.zeros((0, EMBED_SIZE*EMBED_SIZE), dtype=np.float32)
+        self.nn_dist = np.zeros(0, dtype=np.float32)   # the distance of each stored image to its nearest neighbour
+        self.nn_idx = np.zeros(0, dtype=np.int64)       # the index of the nearest neighbour of each stored image
+        self.counts = {'seen': 0, 'duplicates': 0, 'redundant': 0, 'added': 0, 'replaced': 0, 'dropped': 0}
+        self.iteration = 0
+        self.new_since_iteration = 0
+        self.unsaved = 0
+        self.load_state()
+
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.run, name='dataset_collector', daemon=True)
+        self.thread.start()
+
+
+    @classmethod
+    def from_ad_config(cls, config_file:str, model_role:str, out_dir:str, **kwargs):
+        """create a collector with the configs of a model role in automated_ad_config.json"""
+        with open(config_file) as f:
+            roles = {r['model_role']: r for r in json.load(f)}
+        if model_role not in roles:
+            raise Exception(f'{model_role} is not defined in {config_file}')
+        return cls(out_dir, **roles[model_role]['configs'], **kwargs)
+
+
+    def load_state(self) -> None:
+        path = os.path.join(self.out_dir, STATE_FILE)
+        if not os.path.exists(path):
+            return
+        state = np.load(path)
+        with open(os.path.join(self.out_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self.names = meta['names']
+        self.counts.update(meta['counts'])
+        self.iteration = meta['iteration']
+        self.new_since_iteration = meta['new_since_iteration']
+        self.hashes = state['hashes']
+        self.embeddings = state['embeddings']
+        self.refresh_nn()
+        self.logger.info(f'loaded {len(self.names)} images from {self.out_dir}')
+
+
+    def save_state(self) -> None:
+        np.savez(os.path.join(self.out_dir, STATE_FILE), hashes=self.hashes, embeddings=self.embeddings)
+        meta = {
+            'names': self.names,
+            'counts': self.counts,
+            'iteration': self.iteration,
+            'new_since_iteration': self.new_since_iteration,
+        }
+        with open(os.path.join(self.out_dir, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        self.unsaved = 0
+
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+    def distances(self, e:np.ndarray) -> np.ndarray:
+        """the cosine distances of an embedding to the stored embeddings"""
+        return 1.0 - self.embeddings @ e
+
+
+    def offer(self, image:np.ndarray) -> bool:
+        """queue a RGB frame to be added to the dataset, it never blocks
+
+        Args:
+            image (np.ndarray): a RGB image
+
+        Returns:
+            bool: True if the frame is queued
+        """
+        try:
+            self.queue.put_nowait(image)
+        except queue.Full:
+            self.counts['dropped'] += 1
+            return False
+        return True
+
+
+    def run(self) -> None:
+        """the loop of the collector thread"""
+        while True:
+            image = self.queue.get()
+            if image is None:
+                break
+            try:
+                with self.lock:
+                    self.add(image)
+            except Exception:
+                self.logger.exception('failed to add a frame to the dataset')
+
+
+    def add(self, image:np.ndarray) -> bool:
+        """add a RGB frame to the dataset now, see offer() for the queued version
+
+        Args:
+            image (np.ndarray): a RGB image
+
+        Returns:
+            bool: True if the frame is stored
+        """
+        self.counts['seen'] += 1
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+        h = dhash(gray)
+        if len(self.names) and hamming(self.hashes, h).min() <= self.dup_distance:
+            self.counts['duplicates'] += 1
+            return False
+
+        e = embed(gray)
+        d = self.distances(e) if len(self.names) else np.zeros(0, dtype=np.float32)
+        new_nn = float(d.min()) if len(d) else np.inf
+        if len(self.names) < self.capacity:
+            idx = len(self.names)
+            self.names.append(None)
+            self.hashes = np.append(self.hashes, h)
+            self.embeddings = np.vstack([self.embeddings, e[None]])
+            self.nn_dist = np.append(self.nn_dist, np.float32(np.inf))
+            self.nn_idx = np.append(self.nn_idx, -1)
+            self.counts['added'] += 1
+        else:
+            # replace the most redundant image, if the new one is further from the reservoir
+            idx = int(self.nn_dist.argmin())
+            if new_nn <= self.nn_dist[idx]:
+                self.counts['redundant'] += 1
+                return False
+            os.remove(os.path.join(self.out_dir, self.names[idx]))
+            self.hashes[idx] = h
+            self.embeddings[idx] = e
+            d = 1.0 - self.embeddings @ e
+            # the images whose nearest neighbour was replaced search again
+            for j in np.flatnonzero(self.nn_idx == idx):
+                self.update_nn(j)
+            self.counts['replaced'] += 1
+        self.insert_nn(idx, d)
+
+        name = f'{time.time_ns()}.{self.image_format}'
+        cv2.imwrite(os.path.join(self.out_dir, name), cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if image.ndim == 3 else image)
+        self.names[idx] = name
+        self.new_since_iteration += 1
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save_state()
+        return True
+
+
+    def insert_nn(self, idx:int, d:np.ndarray) -> None:
+        """update the nearest neighbours with a new image at idx
+
+        Args:
+            idx (int): the index of the new image
+            d (np.ndarray): the distances of the new image to the stored images
+        """
+        d = np.asarray(d, dtype=np.float32).copy()
+        if len(d) < len(self.names):
+            d = np.append(d, np.inf)
+        d[idx] = np.inf
+        # the new image may be the nearest neighbour of the others
+        closer = d < self.nn_dist
+        self.nn_dist[closer] = d[closer]
+        self.nn_idx[closer] = idx
+        self.nn_idx[idx] = int(d.argmin()) if len(d) > 1 else -1
+        self.nn_dist[idx] = d[self.nn_idx[idx]] if len(d) > 1 else np.inf
+
+
+    def update_nn(self, j:int) -> None:
+        """recompute the nearest neighbour of the stored image j"""
+        d = 1.0 - self.embeddings @ self.embeddings[j]
+        d[j] = np.inf
+        self.nn_idx[j] = int(d.argmin())
+        self.nn_dist[j] = d[self.nn_idx[j]]
+
+
+    def refresh_nn(self) -> None:
+        """recompute the nearest neighbours of all the stored images"""
+        d = 1.0 - self.embeddings @ self.embeddings.T
+        np.fill_diagonal(d, np.inf)
+        if len(d) > 1:
+            self.nn_idx = d.argmin(axis=1)
+            self.nn_dist = d.min(axis=1).astype(np.float32)
+        else:
+            self.nn_idx = np.full(len(d), -1, dtype=np.int64)
+            self.nn_dist = np.full(len(d), np.inf, dtype=np.float32)
+
+
+    def ready(self) -> bool:
+        """whether the dataset has enough new images for the next training iteration"""
+        if self.iteration >= self.max_iterations:
+            return False
+        if self.iteration == 0:
+            return len(self.names) >= self.min_dataset_size
+        return self.new_since_iteration >= self.dataset_increment
+
+
+    def start_iteration(self) -> list:
+        """mark the start of a training iteration
+
+        Returns:
+            list: the paths to the images of the dataset
+        """
+        with self.lock:
+            self.iteration += 1
+            self.new_since_iteration = 0
+            self.save_state()
+            return [os.path.join(self.out_dir, n) for n in self.names]
+
+
+    def stats(self) -> dict:
+        return {'size': len(self.names), 'capacity': self.capacity, 'iteration': self.iteration,
+                'queue_depth': self.queue.qsize(), **self.counts}
+
+
+    def close(self, timeout:float=10) -> None:
+        """add the queued frames, save the state and stop the collector thread"""
+        self.queue.put(None)
+        self.thread.join(timeout)
+        with self.lock:
+            self.save_state()
+        self.logger.info(f'dataset collector stats: {self.stats()}')
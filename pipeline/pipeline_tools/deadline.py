@@ -0,0 +1,191 @@
+"""
+Description:
+a per-frame latency budget with degraded-mode fallbacks, so a worst-case frame doesn't blow the cycle time of the line.
+
+The monitor keeps a running estimate of the time of each stage of predict. Before a stage, the pipeline asks whether the
+remaining budget of the frame affords it, and if not, it takes one of the configured fallbacks:
+    small_role: run a smaller model role instead of the main one
+    skip_annotation: return the raw image as the annotated image, without drawing on it
+    pass_through: skip the model and return a marked pass-through decision, opt-in as it hides the frame from the model
+The estimate of a stage is a high percentile of its recent times, so a single slow frame doesn't make the next frames
+fall back, while a stage that is slow on most frames does.
+Every fallback, and every frame that overruns its budget anyway, is recorded as an event: logged, counted, and
+optionally appended to a json lines file.
+
+Example:
+    monitor = DeadlineMonitor(budget_ms=100, fallbacks=['skip_annotation'])
+    deadline = monitor.start()
+    with monitor.stage('model'):
+        ...
+    if monitor.affords(deadline, 'annotate'):
+        with monitor.stage('annotate'):
+            ...
+    else:
+        monitor.record(deadline, 'annotate', 'skip_annotation')
+"""
+
+import os
+import json
+import time
+import logging
+import contextlib
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+SMALL_ROLE = 'small_role'
+SKIP_ANNOTATION = 'skip_annotation'
+PASS_THROUGH = 'pass_through'
+FALLBACKS = (SMALL_ROLE, SKIP_ANNOTATION, PASS_THROUGH)
+# the fallbacks that still run a model on every frame
+DEFAULT_FALLBACKS = (SMALL_ROLE, SKIP_ANNOTATION)
+
+
+class FrameDeadline:
+    """
+    the time budget of a frame
+    """
+
+    __slots__ = ('start', 'budget', 'events')
+
+    def __init__(self, budget_ms:float, start:float=None) -> None:
+        self.start = time.time() if start is None else start
+        self.budget = budget_ms / 1000
+        self.events = []   # the fallbacks taken for this frame
+
+
+    def elapsed_ms(self) -> float:
+        return (time.time() - self.start) * 1000
+
+
+    def remaining_ms(self) -> float:
+        return self.budget * 1000 - self.elapsed_ms()
+
+
+    def expired(self) -> bool:
+        return self.remaining_ms() <= 0
+
+
+class DeadlineMonitor:
+    """
+    the stage time estimates and the degraded-mode events of a pipeline
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, budget_ms:float, fallbacks:list=DEFAULT_FALLBACKS, history:int=20, percentile:float=90,
+                 margin:float=1.2, max_events:int=1000, events_file:str=None) -> None:
+        """
+        Args:
+            budget_ms (float): the latency budget of a frame in ms
+            fallbacks (list, optional): the allowed fallbacks. Defaults to DEFAULT_FALLBACKS, without pass_through.
+            history (int, optional): the number of recent times kept per stage. Defaults to 20.
+            percentile (float, optional): the percentile of the recent times used as the estimate. Defaults to 90.
+            margin (float, optional): the safety factor on the estimates. Defaults to 1.2.
+            max_events (int, optional): the number of recent events kept in memory. Defaults to 1000.
+            events_file (str, optional): a json lines file to append the events to. Defaults to None.
+        """
+        unknown = set(fallbacks) - set(FALLBACKS)
+        if unknown:
+            raise Exception(f'unknown fallbacks: {unknown}, must be in {FALLBACKS}')
+        self.budget_ms = budget_ms
+        self.fallbacks = list(fallbacks)
+        self.history = history
+        self.percentile = percentile
+        self.margin = margin
+        self.samples = {}     # stage name to its recent times in ms
+        self.events = collections.deque(maxlen=max_events)
+        self.counts = collections.Counter()
+        self.events_file = events_file
+        if events_file:
+            os.makedirs(os.path.dirname(events_file) or '.', exist_ok=True)
+
+
+    def start(self, start:float=None) -> FrameDeadline:
+        """start the deadline of a frame"""
+        self.counts['frames'] += 1
+        return FrameDeadline(self.budget_ms, start)
+
+
+    @contextlib.contextmanager
+    def stage(self, name:str):
+        """time a stage and add the time to its recent times"""
+        t1 = time.time()
+        yield
+        self.add_sample(name, (time.time() - t1) * 1000)
+
+
+    def add_sample(self, stage:str, ms:float) -> None:
+        if stage not in self.samples:
+            self.samples[stage] = collections.deque(maxlen=self.history)
+        self.samples[stage].append(ms)
+
+
+    def estimate(self, stage:str) -> float:
+        """the percentile of the recent times of a stage in ms, or None if it has no times"""
+        samples = self.samples.get(stage)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        # linear interpolation between the closest ranks
+        rank = (len(ordered) - 1) * self.percentile / 100
+        lo = int(rank)
+        hi = min(lo + 1, len(ordered) - 1)
+        return ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+
+
+    @property
+    def estimates(self) -> dict:
+        """stage name to its estimate in ms"""
+        return {stage: self.estimate(stage) for stage,samples in self.samples.items() if samples}
+
+
+    def affords(self, deadline:FrameDeadline, stage:str) -> bool:
+        """whether the remaining budget of the frame affords the estimated time of a stage"""
+        estimate = self.estimate(stage)
+        if estimate is None:
+            return not deadline.expired()
+        return deadline.remaining_ms() >= estimate * self.margin
+
+
+    def allows(self, fallback:str) -> bool:
+        return fallback in self.fallbacks
+
+
+    def record(self, deadline:FrameDeadline, stage:str, fallback:str=None) -> dict:
+        """record a fallback taken before a stage, or an overrun if fallback is None"""
+        event = {
+            'time': time.time(),
+            'stage': stage,
+            'fallback': fallback or 'overrun',
+            'elapsed_ms': round(deadline.elapsed_ms(), 2),
+            'budget_ms': self.budget_ms,
+            'estimate_ms': round(self.estimate(stage) or 0.0, 2),
+        }
+        deadline.events.append(event['fallback'])
+        if fallback and self.samples.get(stage):
+            # a skipped stage gets no new times, drop its slowest one so it is retried instead of being skipped for good
+            self.samples[stage].remove(max(self.samples[stage]))
+        self.events.append(event)
+        self.counts[event['fallback']] += 1
+        self.logger.warning(f'deadline event: {event}')
+        if self.events_file:
+            with open(self.events_file, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+        return event
+
+
+    def finish(self, deadline:FrameDeadline) -> list:
+        """record an overrun if the frame exceeded its budget
+
+        Returns:
+            list: the fallbacks taken for the frame, and overrun
+        """
+        if deadline.expired():
+            self.record(deadline, 'total')
+        return deadline.events
+
+
+    def stats(self) -> dict:
+        return {'estimates_ms': {k: round(v, 2) for k,v in self.estimates.items()}, **self.counts}
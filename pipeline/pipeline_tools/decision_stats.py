@@ -0,0 +1,163 @@
+"""
+Description:
+aggregate the decisions and latencies of the pipeline, and publish them as a small rate-limited message on its own topic.
+
+The GadgetApp charts subscribed to the pipeline topic receive every full result message. Charts subscribed to the
+stats topic instead receive at most one message per `interval` seconds, e.g.
+    {
+        "frames": 1200,
+        "decision_counts": [[1180, "PASS", "green"], [20, "FAIL", "red"]],
+        "yield": 98.3,
+        "frames_60s": 60, "yield_60s": 96.7, "latency_p50_60s": 45.1, "latency_p90_60s": 52.0, "latency_p99_60s": 61.3,
+        "frames_600s": 600, ...
+    }
+decision_counts is in the format of the PieChart. yield is the percentage of PASS, and the latencies are in ms.
+The keys are flat, so that each one can be the decisionKey of a chart.
+
+StatsPublisher connects to the input of the data broker, as the other publishers of the gadget, so the GadgetApp
+receives the stats topic through the broker like the pipeline topic. The broker address is DATA_BROKER_HOST and
+DATA_BROKER_PUB_PORT (data-broker and 5000 by default, the IN_PORT of the data-broker service).
+
+Example:
+    stats = DecisionStats(windows=[60, 600])
+    publisher = StatsPublisher('pipeline/pipeline/stats', interval=1.0)
+    stats.add(decision, proc_time)
+    publisher.maybe_publish(stats)
+"""
+
+import os
+import time
+import json
+import logging
+import collections
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+PASS = 'PASS'
+COLORS = {'PASS': 'green', 'FAIL': 'red'}
+PERCENTILES = (50, 90, 99)
+
+
+def get_broker_address() -> str:
+    """the zmq address of the data broker input"""
+    host = os.environ.get('DATA_BROKER_HOST', 'data-broker')
+    port = os.environ.get('DATA_BROKER_PUB_PORT', '5000')
+    return f'tcp://{host}:{port}'
+
+
+class DecisionStats:
+    """
+    the decision counts since start, and the yield and latency percentiles over sliding time windows
+    """
+
+    def __init__(self, windows:list=(60, 600), percentiles:list=PERCENTILES, max_samples:int=100000) -> None:
+        """
+        Args:
+            windows (list, optional): the window lengths in seconds. Defaults to (60, 600).
+            percentiles (list, optional): the latency percentiles. Defaults to (50, 90, 99).
+            max_samples (int, optional): the max number of frames kept for the windows. Defaults to 100000.
+        """
+        self.windows = sorted(int(w) for w in windows)
+        self.percentiles = list(percentiles)
+        self.counts = collections.Counter()
+        self.samples = collections.deque(maxlen=max_samples)   # (time, passed, latency in ms)
+
+
+    def add(self, decision, latency:float, t:float=None) -> None:
+        """record a frame
+
+        Args:
+            decision (str | list): the decision of the frame, a list is counted per element
+            latency (float): the processing time in seconds
+            t (float, optional): the time of the frame. Defaults to now.
+        """
+        t = time.time() if t is None else t
+        decisions = decision if isinstance(decision, (list, tuple)) else [decision]
+        self.counts.update(str(d) for d in decisions)
+        passed = all(str(d) == PASS for d in decisions)
+        self.samples.append((t, passed, latency * 1000))
+        # drop the frames older than the longest window
+        if self.windows:
+            while self.samples and self.samples[0][0] < t - self.windows[-1]:
+                self.samples.popleft()
+
+
+    def window(self, seconds:int, now:float=None) -> dict:
+        """the yield and latency percentiles of the frames in the last `seconds`"""
+        now = time.time() if now is None else now
+        recent = [s for s in self.samples if s[0] >= now - seconds]
+        out = {'frames': len(recent)}
+        if not recent:
+            return out
+        arr = np.array(recent, dtype=np.float64)
+        out['yield'] = round(100 * float(arr[:,1].mean()), 2)
+        for p,v in zip(self.percentiles, np.percentile(arr[:,2], self.percentiles)):
+            out[f'latency_p{p}'] = round(float(v), 2)
+        return out
+
+
+    def snapshot(self, now:float=None) -> dict:
+        """the aggregated stats message"""
+        total = sum(self.counts.values())
+        msg = {
+            'frames': total,
+            'decision_counts': [[n, d, COLORS.get(d, 'gray')] for d,n in sorted(self.counts.items())],
+            'yield': round(100 * self.counts[PASS] / total, 2) if total else None,
+        }
+        for w in self.windows:
+            msg.update({f'{k}_{w}s': v for k,v in self.window(w, now).items()})
+        return msg
+
+
+class StatsPublisher:
+    """
+    a rate-limited zmq publisher of the aggregated stats through the data broker
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, topic:str='pipeline/pipeline/stats', address:str=None, interval:float=1.0) -> None:
+        """
+        Args:
+            topic (str, optional): the topic of the stats messages. Defaults to pipeline/pipeline/stats.
+            address (str, optional): the zmq address of the data broker input. Defaults to get_broker_address().
+            interval (float, optional): the min seconds between two messages. Defaults to 1.0.
+        """
+        import zmq
+
+        self.topic = topic
+        self.interval = interval
+        self.last_time = 0.0
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        # a slow subscriber must not grow the memory of the pipeline
+        self.socket.setsockopt(zmq.SNDHWM, 10)
+        address = address or get_broker_address()
+        self.socket.connect(address)
+        self.logger.info(f'publishing the stats on {topic} at {address}')
+
+
+    def maybe_publish(self, stats:DecisionStats) -> bool:
+        """publish the stats if `interval` seconds have passed since the last message, it never blocks
+
+        Returns:
+            bool: True if a message is sent
+        """
+        import zmq
+
+        now = time.time()
+        if now - self.last_time < self.interval:
+            return False
+        self.last_time = now
+        msg = json.dumps(stats.snapshot(now)).encode()
+        try:
+            self.socket.send_multipart([self.topic.encode(), msg], flags=zmq.NOBLOCK)
+        except zmq.Again:
+            return False
+        return True
+
+
+    def close(self) -> None:
+        self.socket.close(linger=0)
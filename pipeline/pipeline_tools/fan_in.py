@@ -0,0 +1,329 @@
+"""
+Description:
+run one pipeline on the frames of several sensor topics, with shared models and fair scheduling.
+
+Each topic has its own bounded queue, so a fast camera can only fill its own queue, and the frames are taken from the
+queues by smooth weighted round-robin. The topics are configured as:
+    {
+        "sensor/cam1": {"weight": 2, "max_queue": 4, "roles": ["cls_model", "seg_model"]},
+        "sensor/cam2": {"weight": 1, "max_queue": 2, "roles": ["seg_model"]}
+    }
+The pipeline loads the models once. The topic and its roles are passed in the inputs, as inputs['topic'] and
+inputs['roles'], and the pipeline runs only those roles (see get_topic_roles). Throughput, drops, queueing delay and
+processing time are reported per topic.
+
+It is a standalone tool, it doesn't replace the gadget pipeline server: use it offline on recordings of the topics,
+or as a process of its own that publishes its results with --publish.
+
+Usage:
+    python -m pipeline_tools.fan_in --topics ./topics.json --address tcp://localhost:5001 \\
+        --pipeline_def ./pipeline/pipeline_def.json --manifest /app/models/static/manifest.json
+    python -m pipeline_tools.fan_in --topics ./topics.json --recordings sensor/cam1=./cam1.rec sensor/cam2=./cam2.rec ...
+The results can be published with --publish, in the binary format of result_codec.
+"""
+
+import time
+import json
+import logging
+import threading
+import collections
+import numpy as np
+
+from pipeline_tools.stream_replay import decode_frame, read_recording
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOPIC = {'weight': 1, 'max_queue': 2, 'roles': None}
+
+
+def get_topic_roles(configs:dict, inputs:dict, all_roles:list) -> list:
+    """get the model roles of the topic of a frame
+
+    Args:
+        configs (dict): runtime configs, with the optional `topic_roles` config of topic to roles
+        inputs (dict): the inputs of predict, with the optional `roles` or `topic` key
+        all_roles (list): the roles of the pipeline, used if the topic has no roles
+
+    Returns:
+        list: the model roles to run
+    """
+    if inputs.get('roles'):
+        return list(inputs['roles'])
+    topic_roles = configs.get('topic_roles') or {}
+    return list(topic_roles.get(inputs.get('topic'), all_roles))
+
+
+class TopicStats:
+    """
+    the counts and the recent latencies of a topic
+    """
+
+    def __init__(self, history:int=1000) -> None:
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.delays = collections.deque(maxlen=history)
+        self.proc_times = collections.deque(maxlen=history)
+
+
+    def report(self, elapsed:float) -> dict:
+        out = {
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'errors': self.errors,
+            'fps': round(self.processed / max(elapsed, 1e-9), 2),
+        }
+        for name, values in (('queue_delay_ms', self.delays), ('proc_time_ms', self.proc_times)):
+            if values:
+                p50, p90, p99 = np.percentile(np.array(values) * 1000, [50, 90, 99])
+                out[name] = {'p50': round(float(p50), 2), 'p90': round(float(p90), 2), 'p99': round(float(p99), 2)}
+        return out
+
+
+class TopicScheduler:
+    """
+    per-topic bounded queues served by smooth weighted round-robin
+    """
+
+    def __init__(self, topics:dict) -> None:
+        """
+        Args:
+            topics (dict): a dict of topic to a dict of weight, max_queue and roles
+        """
+        self.topics = {t: {**DEFAULT_TOPIC, **(c or {})} for t,c in topics.items()}
+        self.queues = {t: collections.deque() for t in self.topics}
+        self.current = {t: 0 for t in self.topics}
+        self.stats = {t: TopicStats() for t in self.topics}
+        self.cond = threading.Condition()
+        self.start_time = time.time()
+
+
+    def put(self, topic:str, item) -> bool:
+        """queue a frame of a topic, it is dropped if the queue of the topic is full
+
+        Returns:
+            bool: True if the frame is queued
+        """
+        with self.cond:
+            if topic not in self.queues:
+                return False
+            stats = self.stats[topic]
+            stats.received += 1
+            if len(self.queues[topic]) >= self.topics[topic]['max_queue']:
+                stats.dropped += 1
+                return False
+            self.queues[topic].append((time.time(), item))
+            self.cond.notify()
+            return True
+
+
+    def pick(self) -> str:
+        """pick the next topic among the non-empty queues by smooth weighted round-robin"""
+        ready = [t for t,q in self.queues.items() if q]
+        if not ready:
+            return None
+        total = 0
+        for t in ready:
+            self.current[t] += self.topics[t]['weight']
+            total += self.topics[t]['weight']
+        best = max(ready, key=lambda t: self.current[t])
+        self.current[best] -= total
+        return best
+
+
+    def get(self, timeout:float=None) -> tuple:
+        """take the next frame
+
+        Returns:
+            tuple: the topic, the arrival time and the item, or None if no frame arrives before the timeout
+        """
+        with self.cond:
+            topic = self.pick()
+            if topic is None:
+                self.cond.wait(timeout)
+                topic = self.pick()
+                if topic is None:
+                    return None
+            arrival, item = self.queues[topic].popleft()
+            return topic, arrival, item
+
+
+    def report(self) -> dict:
+        elapsed = time.time() - self.start_time
+        with self.cond:
+            return {t: {**s.report(elapsed), 'queue_depth': len(self.queues[t])} for t,s in self.stats.items()}
+
+
+class FanInRunner:
+    """
+    feed the frames of several topics to one pipeline
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, pipeline, configs:dict, topics:dict, decode=decode_frame, on_result=None) -> None:
+        """
+        Args:
+            pipeline (ModelPipeline): a loaded and warmed up pipeline
+            configs (dict): runtime configs
+            topics (dict): a dict of topic to a dict of weight, max_queue and roles
+            decode (callable, optional): the function of the message parts to the inputs. Defaults to decode_frame.
+            on_result (callable, optional): a function of the topic and the results. Defaults to None.
+        """
+        self.pipeline = pipeline
+        self.configs = configs
+        self.scheduler = TopicScheduler(topics)
+        self.decode = decode
+        self.on_result = on_result
+        self.stop_event = threading.Event()
+        self.threads = []
+
+
+    def subscribe(self, address:str) -> None:
+        """receive the topics from the data broker in a background thread"""
+        def receive():
+            import zmq
+
+            socket = zmq.Context.instance().socket(zmq.SUB)
+            socket.connect(address)
+            for topic in self.scheduler.topics:
+                socket.setsockopt(zmq.SUBSCRIBE, topic.encode())
+            while not self.stop_event.is_set():
+                if socket.poll(100):
+                    parts = socket.recv_multipart()
+                    self.scheduler.put(parts[0].decode(errors='replace'), parts)
+            socket.close(linger=0)
+
+        self.start_thread(receive)
+
+
+    def replay(self, recordings:dict, speed:float=1.0) -> None:
+        """feed recordings of the topics at their recorded cadence, one thread per topic"""
+        for topic, path in recordings.items():
+            def feed(topic=topic, path=path):
+                start, t0 = time.time(), None
+                for t, parts in read_recording(path):
+                    t0 = t if t0 is None else t0
+                    delay = start + (t - t0) / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    if self.stop_event.is_set():
+                        return
+                    self.scheduler.put(topic, parts)
+            self.start_thread(feed)
+
+
+    def start_thread(self, target) -> None:
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+
+    def step(self, timeout:float=0.1) -> bool:
+        """process the next frame
+
+        Returns:
+            bool: True if a frame was processed
+        """
+        item = self.scheduler.get(timeout)
+        if item is None:
+            return False
+        topic, arrival, parts = item
+        stats = self.scheduler.stats[topic]
+        stats.delays.append(time.time() - arrival)
+        inputs = self.decode(parts)
+        if inputs is None:
+            stats.errors += 1
+            return True
+        inputs['topic'] = topic
+        roles = self.scheduler.topics[topic]['roles']
+        if roles:
+            inputs['roles'] = roles
+        t1 = time.time()
+        try:
+            results = self.pipeline.predict(self.configs, inputs)
+        except Exception:
+            stats.errors += 1
+            self.logger.exception(f'failed to process a frame of {topic}')
+            return True
+        stats.proc_times.append(time.time() - t1)
+        stats.processed += 1
+        if self.on_result:
+            self.on_result(topic, results)
+        return True
+
+
+    def run(self, duration:float=None, report_every:float=10.0) -> dict:
+        """process the frames until stopped, the feeders finish, or the duration is over
+
+        Returns:
+            dict: the per-topic report
+        """
+        end = time.time() + duration if duration else None
+        last_report = time.time()
+        while not self.stop_event.is_set() and (end is None or time.time() < end):
+            processed = self.step()
+            if not processed and not any(t.is_alive() for t in self.threads):
+                break
+            if time.time() - last_report >= report_every:
+                last_report = time.time()
+                self.logger.info(f'fan-in report: {self.scheduler.report()}')
+        self.stop_event.set()
+        report = self.scheduler.report()
+        self.logger.info(f'fan-in report: {report}')
+        return report
+
+
+
+if __name__ == '__main__':
+    import argparse
+    import importlib
+
+    parser = argparse.ArgumentParser(description='run one pipeline on the frames of several sensor topics')
+    parser.add_argument('--topics', required=True, help='a json file of topic to weight, max_queue and roles')
+    parser.add_argument('--address', default='tcp://localhost:5001', help='the data broker output address')
+    parser.add_argument('--recordings', nargs='*', default=None, help='topic=recording pairs to replay instead')
+    parser.add_argument('--speed', type=float, default=1.0, help='the speed of the recordings')
+    parser.add_argument('--duration', type=float, default=None)
+    parser.add_argument('--pipeline_def', default='./pipeline/pipeline_def.json')
+    parser.add_argument('--manifest', required=True, help='the static models manifest')
+    parser.add_argument('--pipeline_class', default='pipeline_class.ModelPipeline')
+    parser.add_argument('--publish', default=None, help='a zmq address to publish the encoded results, e.g. tcp://*:5561')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    import gadget_utils.pipeline_utils as pipeline_utils
+
+    with open(args.topics) as f:
+        topics = json.load(f)
+    module, cls = args.pipeline_class.rsplit('.', 1)
+    pipeline_cls = getattr(importlib.import_module(module), cls)
+    kwargs = pipeline_utils.load_pipeline_def(args.pipeline_def)
+    manifest = pipeline_utils.get_models_from_static_manifest(args.manifest)
+    kwargs['models'] = manifest
+    pipeline = pipeline_cls(**kwargs)
+    pipeline.load(manifest, kwargs)
+    pipeline.warm_up(kwargs)
+
+    on_result = None
+    if args.publish:
+        import zmq
+        from pipeline_tools import result_codec
+
+        socket = zmq.Context.instance().socket(zmq.PUB)
+        socket.bind(args.publish)
+        def on_result(topic, results):
+            # the arrays are sent out-of-band, without converting or copying them, a consumer calls result_codec.recv
+            result_codec.send(socket, f'{topic}/results', results)
+
+    runner = FanInRunner(pipeline, kwargs, topics, on_result=on_result)
+    if args.recordings:
+        runner.replay(dict(r.split('=', 1) for r in args.recordings), args.speed)
+    else:
+        runner.subscribe(args.address)
+    # the final report is logged by run
+    runner.run(args.duration)
+    pipeline.clean_up()
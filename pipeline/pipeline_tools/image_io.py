@@ -0,0 +1,175 @@
+"""
+Description:
+decode images at the resolution the model needs, and carry the channel order with them instead of converting it.
+
+A jpg can be decoded at 1/2, 1/4 or 1/8 of its size in the DCT domain (cv2.IMREAD_REDUCED_COLOR_*), which is much
+faster than a full decode followed by a resize. read_image picks the largest reduction that keeps the image at least
+as large as the target size of the model role, reading the size from the jpg header. OpenCV rotates the decoded image
+by its EXIF orientation, so the size is swapped for the orientations of a quarter turn.
+
+The decoded images stay in the BGR order of OpenCV. The order is passed to the pipeline in the inputs, e.g.
+    inputs = {'image': {'pixels': bgr, 'channel_order': 'BGR'}}
+and the pipeline only converts the model input to RGB (see to_rgb), the annotated image keeps the order of the inputs.
+upscale maps an image annotated at the reduced resolution back to the size of the source.
+"""
+
+import os
+import glob
+import struct
+import logging
+import numpy as np
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+RGB = 'RGB'
+BGR = 'BGR'
+IMAGE_FORMATS = ('jpg', 'jpeg', 'png', 'bmp')
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# the start of frame markers of the jpg header, which contain the image size
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+APP1_MARKER = 0xE1
+ORIENTATION_TAG = 0x0112
+# the EXIF orientations that rotate the image by a quarter turn
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def exif_orientation(segment:bytes) -> int:
+    """read the orientation tag of an EXIF APP1 segment
+
+    Args:
+        segment (bytes): the payload of the APP1 segment, after its length
+
+    Returns:
+        int: the orientation from 1 to 8, or 1 if it is missing
+    """
+    if segment[:6] != b'Exif\x00\x00':
+        return 1
+    tiff = segment[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None or len(tiff) < 8:
+        return 1
+    offset, = struct.unpack(endian + 'I', tiff[4:8])
+    if offset + 2 > len(tiff):
+        return 1
+    n, = struct.unpack(endian + 'H', tiff[offset:offset+2])
+    for k in range(n):
+        entry = tiff[offset+2+12*k : offset+14+12*k]
+        if len(entry) < 12:
+            break
+        tag, _, _, value = struct.unpack(endian + 'HHIH', entry[:10])
+        if tag == ORIENTATION_TAG:
+            return value
+    return 1
+
+
+def jpeg_size(buf:bytes) -> tuple:
+    """read the [height, width] of a jpg as OpenCV decodes it, from its header and EXIF orientation
+
+    Returns:
+        tuple: the height and width, or None if it is not a jpg
+    """
+    if buf[:2] != b'\xff\xd8':
+        return None
+    orientation = 1
+    i = 2
+    while i + 9 < len(buf):
+        if buf[i] != 0xFF:
+            return None
+        marker = buf[i+1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        length, = struct.unpack('>H', buf[i+2:i+4])
+        if marker == APP1_MARKER:
+            orientation = exif_orientation(bytes(buf[i+4:i+2+length]))
+        elif marker in SOF_MARKERS:
+            h, w = struct.unpack('>HH', buf[i+5:i+9])
+            return (w, h) if orientation in TRANSPOSED_ORIENTATIONS else (h, w)
+        i += 2 + length
+    return None
+
+
+def get_reduce_factor(src_hw:tuple, target_hw:tuple) -> int:
+    """the largest of 8, 4, 2 and 1 that keeps the source at least as large as the target"""
+    for f in (8, 4, 2):
+        if src_hw[0] // f >= target_hw[0] and src_hw[1] // f >= target_hw[1]:
+            return f
+    return 1
+
+
+def decode_image(buf:bytes, target_hw:tuple=None) -> tuple:
+    """decode an encoded image in BGR, reduced in the DCT domain if it is a jpg larger than the target
+
+    Args:
+        buf (bytes): the encoded image
+        target_hw (tuple, optional): the [height, width] the image is resized to afterwards. Defaults to None.
+
+    Returns:
+        tuple: the BGR image, and the reduction factor
+    """
+    factor = 1
+    if target_hw is not None:
+        src_hw = jpeg_size(buf)
+        if src_hw:
+            factor = get_reduce_factor(src_hw, target_hw)
+    im = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), REDUCED_FLAGS[factor])
+    if im is None:
+        raise Exception('failed to decode the image')
+    return im, factor
+
+
+def read_image(path:str, target_hw:tuple=None) -> tuple:
+    """read an image file in BGR, see decode_image"""
+    with open(path, 'rb') as f:
+        return decode_image(f.read(), target_hw)
+
+
+def upscale(image:np.ndarray, factor:int) -> np.ndarray:
+    """resize an image decoded at 1/factor of its size back to the size of the source"""
+    if factor == 1:
+        return image
+    return cv2.resize(image, None, fx=factor, fy=factor, interpolation=cv2.INTER_LINEAR)
+
+
+def list_images(image_dir:str) -> list:
+    """list the image files of a folder, sorted by name"""
+    paths = []
+    for fmt in IMAGE_FORMATS:
+        paths += glob.glob(os.path.join(image_dir, f'*.{fmt}'))
+    return sorted(paths)
+
+
+def load_images(image_dir:str, max_images:int=100) -> list:
+    """load RGB images from a folder
+
+    Args:
+        image_dir (str): the path to the image folder
+        max_images (int, optional): the max number of images. Defaults to 100.
+
+    Returns:
+        list: a list of RGB images
+    """
+    images = []
+    for path in list_images(image_dir)[:max_images]:
+        im_bgr = cv2.imread(path)
+        if im_bgr is not None:
+            images.append(cv2.cvtColor(im_bgr, cv2.COLOR_BGR2RGB))
+    if not images:
+        raise Exception(f'found no images in {image_dir}')
+    return images
+
+
+def to_rgb(image:np.ndarray, channel_order:str=RGB) -> np.ndarray:
+    """convert an image in the channel order of the inputs to RGB, only if it is BGR"""
+    if channel_order not in (RGB, BGR):
+        raise Exception(f'unknown channel order: {channel_order}, must be {RGB} or {BGR}')
+    if channel_order == RGB or image.ndim != 3:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
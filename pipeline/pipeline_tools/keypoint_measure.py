@@ -0,0 +1,158 @@
+"""
+Description:
+vectorized measurements between keypoints, evaluated over all the instances of a frame at once.
+
+The measurements are declared per class name, each one is a distance between a pair of keypoint indices or an angle
+at the middle keypoint of a triple, with optional min/max tolerances:
+    {
+        "person": [
+            {"name": "shoulder_width", "type": "distance", "points": [5, 6], "min": 50, "max": 200},
+            {"name": "left_elbow", "type": "angle", "points": [5, 7, 9], "min": 90, "max": 180}
+        ]
+    }
+Distances are in pixels multiplied by the pixel size, angles are in degrees.
+
+Keypoints with a confidence (the 3rd column of [N,K,3] keypoints) below min_conf are not used: the measurements that
+need them are NaN and out of tolerance. A class with measurements but no detected instance is reported as missing.
+"""
+
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+DISTANCE = 'distance'
+ANGLE = 'angle'
+NUM_POINTS = {DISTANCE: 2, ANGLE: 3}
+
+
+class MeasurementSpec:
+    """
+    the measurements of a class, compiled into index and tolerance arrays
+    """
+
+    def __init__(self, measurements:list) -> None:
+        """
+        Args:
+            measurements (list): a list of dicts with the keys of name, type, points, and optionally min and max
+        """
+        self.names = []
+        self.types = []
+        points = {DISTANCE: [], ANGLE: []}
+        mins, maxs = [], []
+        for m in measurements:
+            t = m.get('type', DISTANCE)
+            if t not in NUM_POINTS:
+                raise Exception(f"unknown measurement type {t} of {m['name']}")
+            if len(m['points']) != NUM_POINTS[t]:
+                raise Exception(f"{t} measurement {m['name']} needs {NUM_POINTS[t]} keypoint indices")
+            self.names.append(m['name'])
+            self.types.append(t)
+            points[t].append(m['points'])
+            mins.append(m.get('min', -np.inf))
+            maxs.append(m.get('max', np.inf))
+
+        types = np.array(self.types)
+        # the column of each measurement type in the values array
+        self.dist_cols = np.flatnonzero(types == DISTANCE)
+        self.angle_cols = np.flatnonzero(types == ANGLE)
+        self.dist_idx = np.array(points[DISTANCE], dtype=int).reshape(-1,2)
+        self.angle_idx = np.array(points[ANGLE], dtype=int).reshape(-1,3)
+        self.mins = np.array(mins, dtype=np.float64)
+        self.maxs = np.array(maxs, dtype=np.float64)
+        max_idx = [self.dist_idx.max(initial=-1), self.angle_idx.max(initial=-1)]
+        self.num_keypoints = max(max_idx) + 1
+
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+    def measure(self, points:np.ndarray, pixel_size:float=1.0, min_conf:float=0.0) -> np.ndarray:
+        """compute the measurements of the instances
+
+        Args:
+            points (np.ndarray): a [N,K,2] or [N,K,3] array of keypoints of N instances
+            pixel_size (float, optional): the size of a pixel for the distances. Defaults to 1.0.
+            min_conf (float, optional): the min confidence of a keypoint in [N,K,3] keypoints. Defaults to 0.0.
+
+        Returns:
+            np.ndarray: a [N,M] array of M measurements, NaN if one of its keypoints is below min_conf
+        """
+        points = np.asarray(points, dtype=np.float64)
+        pts = points[..., :2].copy()
+        if points.shape[-1] > 2:
+            pts[points[..., 2] < min_conf] = np.nan
+        if pts.shape[1] < self.num_keypoints:
+            raise Exception(f'expect {self.num_keypoints} keypoints, got {pts.shape[1]}')
+        values = np.empty((len(pts), len(self.names)), dtype=np.float64)
+        if len(self.dist_cols):
+            diff = pts[:, self.dist_idx[:,0]] - pts[:, self.dist_idx[:,1]]
+            values[:, self.dist_cols] = np.linalg.norm(diff, axis=-1) * pixel_size
+        if len(self.angle_cols):
+            v1 = pts[:, self.angle_idx[:,0]] - pts[:, self.angle_idx[:,1]]
+            v2 = pts[:, self.angle_idx[:,2]] - pts[:, self.angle_idx[:,1]]
+            cross = v1[...,0]*v2[...,1] - v1[...,1]*v2[...,0]
+            dot = np.sum(v1*v2, axis=-1)
+            values[:, self.angle_cols] = np.degrees(np.arctan2(np.abs(cross), dot))
+        return values
+
+
+    def check(self, values:np.ndarray) -> np.ndarray:
+        """check the measurements against the tolerances
+
+        Returns:
+            np.ndarray: a [N,M] boolean array, True if the measurement is within tolerance, False if it is NaN
+        """
+        return (values >= self.mins) & (values <= self.maxs)
+
+
+def compile_specs(specs:dict) -> dict:
+    """compile the measurements of each class
+
+    Args:
+        specs (dict): a dict of class name to a list of measurements
+
+    Returns:
+        dict: a dict of class name to MeasurementSpec
+    """
+    return {name: MeasurementSpec(measurements) for name,measurements in specs.items() if measurements}
+
+
+def measure_instances(points:np.ndarray, classes:list, specs:dict, pixel_size:float=1.0, min_conf:float=0.0) -> dict:
+    """measure all the instances of a frame, grouped by class
+
+    Args:
+        points (np.ndarray): a [N,K,2] or [N,K,3] array of keypoints
+        classes (list): the class names of the N instances
+        specs (dict): a dict of class name to MeasurementSpec
+        pixel_size (float, optional): the size of a pixel for the distances. Defaults to 1.0.
+        min_conf (float, optional): the min confidence of a keypoint in [N,K,3] keypoints. Defaults to 0.0.
+
+    Returns:
+        dict: a dict with keys of
+            values: a dict of class name to a [n,M] array of the measurements of its n instances
+            passed: a [N] boolean array, True if all the measurements of an instance are within tolerance
+            failed: a sorted list of the names of measurements out of tolerance
+            missing: a sorted list of the classes with measurements but no instance
+            ok: True if no class is missing and all the instances passed
+    """
+    classes = np.asarray(classes)
+    passed = np.ones(len(classes), dtype=bool)
+    values = {}
+    failed = set()
+    missing = []
+    for name,spec in specs.items():
+        mask = classes == name
+        if not mask.any():
+            missing.append(name)
+            continue
+        v = spec.measure(np.asarray(points)[mask], pixel_size, min_conf)
+        ok = spec.check(v)
+        values[name] = v
+        passed[mask] = ok.all(axis=1)
+        failed.update(n for n,good in zip(spec.names, ok.all(axis=0)) if not good)
+    missing = sorted(missing)
+    return {'values': values, 'passed': passed, 'failed': sorted(failed), 'missing': missing,
+            'ok': bool(passed.all()) and not missing}
@@ -0,0 +1,34 @@
+"""
+Description:
+compute only the model outputs that are consumed by the pipeline.
+
+The `role_outputs` config selects the outputs of each model role that are uploaded as predictions, e.g.
+    {"od_model": ["boxes"], "seg_model": ["boxes", "segments"]}
+A role missing from the config consumes all the outputs. The detectron2 wrapper only extracts the polygons from the
+masks if it is asked to (return_segments), so a role without "segments" skips the contour extraction. The yolo wrapper
+always returns the polygons, so there only the conversion and the upload are skipped.
+"""
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+ALL_OUTPUTS = ('boxes', 'segments')
+
+
+def get_role_outputs(configs:dict, role:str) -> set:
+    """get the outputs consumed for a model role
+
+    Args:
+        configs (dict): runtime configs
+        role (str): the model role
+
+    Returns:
+        set: a set of the names in ALL_OUTPUTS
+    """
+    outputs = (configs.get('role_outputs') or {}).get(role, ALL_OUTPUTS)
+    unknown = set(outputs) - set(ALL_OUTPUTS)
+    if unknown:
+        raise Exception(f'unknown outputs of {role}: {unknown}, must be in {ALL_OUTPUTS}')
+    return set(outputs)
@@ -0,0 +1,437 @@
+"""
+Description:
+a patch memory bank anomaly model for the cpu, with coreset subsampling and an IVF nearest neighbour index.
+
+The anomaly score of an image patch is the distance from its feature to the nearest patch feature of the good images
+in the memory bank (as in PatchCore). The memory bank is subsampled with a greedy k-center coreset, and searched with
+an inverted file (IVF) index: the bank is clustered into `n_lists` lists by k-means, and each query is only compared
+with the members of its `nprobe` closest lists. Increasing nprobe trades speed for recall, nprobe >= n_lists is an
+exact search. The k-means lists are saved with the bank, so loading it doesn't cluster it again, and the bank is
+memory mapped, so the pipeline replicas share its pages (see shared_weights.py).
+
+The model has the same predict, annotate and warmup methods as the LMI anomaly model wrapper, so it can be used as
+self.models['ad_model']. The backbone weights are a local file, as the edge PCs can be offline, and the bank keeps
+their sha256, so it is only scored with the features it was built with. Build a memory bank from a folder of good
+images with:
+    python -m pipeline_tools.patch_memory --images ./data/good --image_size 224 224 --weights ./resnet18.pth \
+        --output ./memory_bank.npz
+"""
+
+import os
+import time
+import hashlib
+import logging
+import numpy as np
+import cv2
+
+from pipeline_tools import shared_weights
+from pipeline_tools.cpu_backend import annotate_anomaly
+
+
+logger = logging.getLogger(__name__)
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+CHUNK_SIZE = 4096
+
+
+def sq_dists(x:np.ndarray, y:np.ndarray) -> np.ndarray:
+    """the pairwise squared euclidean distances between the rows of x and y"""
+    d = (x*x).sum(1)[:,None] + (y*y).sum(1)[None,:] - 2.0 * (x @ y.T)
+    return np.maximum(d, 0)
+
+
+def min_sq_dists(x:np.ndarray, y:np.ndarray) -> np.ndarray:
+    """the squared distance from each row of x to its nearest row of y, computed in chunks"""
+    out = np.empty(len(x), dtype=np.float32)
+    for i in range(0, len(x), CHUNK_SIZE):
+        out[i:i+CHUNK_SIZE] = sq_dists(x[i:i+CHUNK_SIZE], y).min(axis=1)
+    return out
+
+
+def greedy_coreset(features:np.ndarray, ratio:float, projection_dim:int=128, seed:int=0) -> np.ndarray:
+    """select a coreset of the features with the greedy k-center algorithm on a random projection
+
+    Args:
+        features (np.ndarray): a [N,D] array of features
+        ratio (float): the fraction of the features to keep
+        projection_dim (int, optional): the dimension of the random projection. Defaults to 128.
+        seed (int, optional): the random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: the indices of the selected features
+    """
+    n = len(features)
+    k = max(int(n * ratio), 1)
+    if k >= n:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    x = features
+    if features.shape[1] > projection_dim:
+        proj = rng.normal(size=(features.shape[1], projection_dim)).astype(np.float32) / np.sqrt(projection_dim)
+        x = features @ proj
+    selected = np.empty(k, dtype=np.int64)
+    selected[0] = rng.integers(n)
+    min_d = sq_dists(x, x[selected[:1]])[:,0]
+    for i in range(1, k):
+        selected[i] = int(min_d.argmax())
+        min_d = np.minimum(min_d, sq_dists(x, x[selected[i:i+1]])[:,0])
+    return selected
+
+
+class IVFIndex:
+    """
+    an inverted file index for the nearest neighbour distance search
+    """
+
+    def __init__(self, bank:np.ndarray, n_lists:int=64, iters:int=10, seed:int=0) -> None:
+        """
+        Args:
+            bank (np.ndarray): a [N,D] array of the memory bank features
+            n_lists (int, optional): the number of k-means lists. Defaults to 64.
+            iters (int, optional): the k-means iterations. Defaults to 10.
+            seed (int, optional): the random seed. Defaults to 0.
+        """
+        bank = np.ascontiguousarray(bank, dtype=np.float32)
+        n_lists = max(min(n_lists, len(bank)), 1)
+        rng = np.random.default_rng(seed)
+        centroids = bank[rng.choice(len(bank), n_lists, replace=False)].copy()
+        for _ in range(iters):
+            assign = self.assign(bank, centroids)
+            for l in range(n_lists):
+                members = bank[assign == l]
+                if len(members):
+                    centroids[l] = members.mean(axis=0)
+        assign = self.assign(bank, centroids)
+        order = np.argsort(assign, kind='stable')
+        self.centroids = centroids
+        self.bank = bank[order]
+        self.offsets = np.searchsorted(assign[order], np.arange(n_lists + 1))
+
+
+    @classmethod
+    def from_lists(cls, bank:np.ndarray, centroids:np.ndarray, offsets:np.ndarray) -> 'IVFIndex':
+        """restore an index without k-means
+
+        Args:
+            bank (np.ndarray): a [N,D] array of the memory bank features, sorted by list
+            centroids (np.ndarray): a [L,D] array of the list centroids
+            offsets (np.ndarray): a [L+1] array of the start of each list in the bank
+        """
+        if len(offsets) != len(centroids) + 1 or offsets[-1] != len(bank):
+            raise Exception(f'the lists of {len(centroids)} centroids do not match the bank of {len(bank)} patches')
+        index = cls.__new__(cls)
+        index.bank = np.ascontiguousarray(bank, dtype=np.float32)
+        index.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        index.offsets = np.asarray(offsets, dtype=np.int64)
+        return index
+
+
+    @staticmethod
+    def assign(x:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        out = np.empty(len(x), dtype=np.int64)
+        for i in range(0, len(x), CHUNK_SIZE):
+            out[i:i+CHUNK_SIZE] = sq_dists(x[i:i+CHUNK_SIZE], centroids).argmin(axis=1)
+        return out
+
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+
+    def search(self, queries:np.ndarray, nprobe:int=4) -> np.ndarray:
+        """find the distance from each query to its nearest neighbour in the memory bank
+
+        Args:
+            queries (np.ndarray): a [Q,D] array of features
+            nprobe (int, optional): the number of lists searched per query. Defaults to 4.
+
+        Returns:
+            np.ndarray: a [Q] array of the nearest neighbour distances
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if nprobe >= self.n_lists:
+            return np.sqrt(min_sq_dists(queries, self.bank))
+        probes = np.argpartition(sq_dists(queries, self.centroids), nprobe-1, axis=1)[:, :nprobe]
+        best = np.full(len(queries), np.inf, dtype=np.float32)
+        for l in np.unique(probes):
+            members = self.bank[self.offsets[l]:self.offsets[l+1]]
+            if not len(members):
+                continue
+            qi = np.flatnonzero((probes == l).any(axis=1))
+            best[qi] = np.minimum(best[qi], min_sq_dists(queries[qi], members))
+        return np.sqrt(best)
+
+
+    def evaluate(self, queries:np.ndarray, nprobes:list=(1,2,4,8,16)) -> dict:
+        """measure the recall and the search time of each nprobe against the exact search
+
+        Args:
+            queries (np.ndarray): a [Q,D] array of features
+            nprobes (list, optional): the nprobe values. Defaults to (1,2,4,8,16).
+
+        Returns:
+            dict: a dict of nprobe to the recall (the fraction of queries whose exact nearest distance is found) and time
+        """
+        exact = self.search(queries, self.n_lists)
+        report = {}
+        for nprobe in nprobes:
+            t1 = time.time()
+            d = self.search(queries, nprobe)
+            report[nprobe] = {
+                'recall': float(np.mean(np.isclose(d, exact, rtol=1e-4, atol=1e-5))),
+                'time': time.time() - t1,
+            }
+        return report
+
+
+def file_sha256(path:str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def check_weights(weights:str, expected_sha256:str=None) -> str:
+    """check that the backbone weights file exists, and is the one the bank was built with
+
+    Args:
+        weights (str): the path to the backbone weights
+        expected_sha256 (str, optional): the sha256 saved with the bank. Defaults to None, e.g. a new bank.
+
+    Returns:
+        str: the sha256 of the weights file
+    """
+    if not weights or not os.path.isfile(weights):
+        raise Exception(f'the backbone weights file is not found: {weights}. It is not downloaded, copy the '
+                        'torchvision weights to the model folder and pass their path')
+    sha256 = file_sha256(weights)
+    if expected_sha256 is not None and sha256 != expected_sha256:
+        raise Exception(f'{weights} is not the backbone the memory bank was built with, '
+                        f'sha256: {sha256}, expected: {expected_sha256}')
+    return sha256
+
+
+def load_bank(path:str, n_lists:int=None) -> tuple:
+    """load a memory bank file saved by PatchMemoryModel.save, memory mapped so the pipeline replicas share its pages
+
+    Args:
+        path (str): the path to the npz file
+        n_lists (int, optional): the number of IVF lists. Defaults to None, which reuses the saved lists.
+
+    Returns:
+        tuple: the dict of the arrays of the file, and the IVFIndex of its saved lists, or None if n_lists differs
+    """
+    data = shared_weights.mmap_npz(path)
+    index = None
+    if 'centroids' in data and (n_lists is None or n_lists == len(data['centroids'])):
+        # the bank is float32 and contiguous, so the index keeps the mapped pages
+        index = IVFIndex.from_lists(data['bank'], data['centroids'], data['offsets'])
+    return data, index
+
+
+class FeatureExtractor:
+    """
+    the patch features of a torchvision resnet: layer2 and the upsampled layer3, averaged over 3x3 neighbourhoods
+    """
+
+    def __init__(self, backbone:str='resnet18', weights:str=None, num_threads:int=0) -> None:
+        """
+        Args:
+            backbone (str, optional): a torchvision resnet. Defaults to resnet18.
+            weights (str): the path to the backbone weights, e.g. the torchvision resnet18-f37072fd.pth
+            num_threads (int, optional): the torch threads, 0 keeps the default. Defaults to 0.
+        """
+        if not weights or not os.path.isfile(weights):
+            raise Exception(f'the backbone weights file is not found: {weights}, it is not downloaded')
+        import torch
+        import torchvision
+
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        model = getattr(torchvision.models, backbone)()
+        model.load_state_dict(torch.load(weights, map_location='cpu'))
+        self.model = model.eval()
+        self.torch = torch
+
+
+    def __call__(self, images:np.ndarray) -> np.ndarray:
+        """
+        Args:
+            images (np.ndarray): a [B,H,W,3] array of RGB images
+
+        Returns:
+            np.ndarray: a [B,h,w,D] array of patch features
+        """
+        torch = self.torch
+        F = torch.nn.functional
+        x = (images.astype(np.float32) / 255.0 - IMAGENET_MEAN) / IMAGENET_STD
+        x = torch.from_numpy(np.ascontiguousarray(x.transpose(0,3,1,2)))
+        m = self.model
+        with torch.inference_mode():
+            x = m.maxpool(m.relu(m.bn1(m.conv1(x))))
+            f2 = m.layer2(m.layer1(x))
+            f3 = m.layer3(f2)
+            f2 = F.avg_pool2d(f2, 3, 1, 1)
+            f3 = F.interpolate(F.avg_pool2d(f3, 3, 1, 1), size=f2.shape[-2:], mode='bilinear', align_corners=False)
+            feats = torch.cat([f2, f3], dim=1)
+        return feats.permute(0,2,3,1).numpy()
+
+
+class PatchMemoryModel:
+    """
+    a patch memory bank anomaly model served on the cpu
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, bank:np.ndarray, image_size:list, backbone:str='resnet18', weights:str=None,
+                 n_lists:int=64, nprobe:int=4, num_threads:int=0, blur_sigma:float=4.0, index:IVFIndex=None,
+                 weights_sha256:str=None) -> None:
+        """
+        Args:
+            bank (np.ndarray): a [N,D] array of the memory bank features
+            image_size (list): a list of [height, width]
+            backbone (str, optional): the torchvision resnet of the features. Defaults to resnet18.
+            weights (str): the path to the backbone weights.
+            n_lists (int, optional): the number of IVF lists. Defaults to 64.
+            nprobe (int, optional): the number of IVF lists searched per patch. Defaults to 4.
+            num_threads (int, optional): the torch threads, 0 keeps the default. Defaults to 0.
+            blur_sigma (float, optional): the gaussian blur of the anomaly map. Defaults to 4.0.
+            index (IVFIndex, optional): the index of the bank, e.g. loaded with it. Defaults to None, which builds one.
+            weights_sha256 (str, optional): the sha256 of the weights the bank was built with. Defaults to None.
+        """
+        self.image_size = list(image_size)
+        self.backbone = backbone
+        self.weights = weights
+        self.weights_sha256 = check_weights(weights, weights_sha256)
+        self.extractor = FeatureExtractor(backbone, weights, num_threads)
+        self.index = index if index is not None else IVFIndex(bank, n_lists)
+        self.nprobe = nprobe
+        self.blur_sigma = blur_sigma
+        self.logger.info(f'memory bank: {len(bank)} patches, {self.index.n_lists} lists, nprobe: {nprobe}')
+
+
+    @classmethod
+    def fit(cls, images:list, image_size:list, coreset_ratio:float=0.1, backbone:str='resnet18', **kwargs):
+        """build the memory bank from good images
+
+        Args:
+            images (list): a list of RGB images
+            image_size (list): a list of [height, width]
+            coreset_ratio (float, optional): the fraction of the patches kept in the memory bank. Defaults to 0.1.
+            backbone (str, optional): the torchvision resnet of the features. Defaults to resnet18.
+            kwargs: the other arguments of the constructor
+        """
+        extractor = FeatureExtractor(backbone, kwargs.get('weights'), kwargs.get('num_threads', 0))
+        h,w = image_size
+        feats = []
+        for im in images:
+            f = extractor(cv2.resize(im, (w,h))[None])
+            feats.append(f.reshape(-1, f.shape[-1]))
+        feats = np.concatenate(feats)
+        bank = feats[greedy_coreset(feats, coreset_ratio)]
+        logger.info(f'coreset: {len(bank)} of {len(feats)} patches')
+        return cls(bank, image_size, backbone, **kwargs)
+
+
+    def save(self, path:str) -> None:
+        """save the bank with its IVF lists and its backbone weights, uncompressed so it can be memory mapped"""
+        np.savez(path, bank=self.index.bank, centroids=self.index.centroids, offsets=self.index.offsets,
+                 image_size=np.array(self.image_size), backbone=self.backbone,
+                 weights=os.path.basename(self.weights), weights_sha256=self.weights_sha256)
+
+
+    @classmethod
+    def load(cls, path:str, weights:str=None, **kwargs):
+        """load a bank, its IVF lists are reused unless a different n_lists is given
+
+        Args:
+            path (str): the path to the npz file
+            weights (str, optional): the path to the backbone weights. Defaults to None, which is the file saved
+                with the bank, in the folder of the npz file.
+            kwargs: the other arguments of the constructor
+        """
+        data, index = load_bank(path, kwargs.get('n_lists'))
+        if weights is None and 'weights' in data:
+            weights = os.path.join(os.path.dirname(path), str(data['weights']))
+        sha256 = str(data['weights_sha256']) if 'weights_sha256' in data else None
+        if sha256 is None:
+            logger.warning(f'{path} has no backbone weights hash, {weights} is not checked')
+        return cls(data['bank'], data['image_size'].tolist(), str(data['backbone']), weights, index=index,
+                   weights_sha256=sha256, **kwargs)
+
+
+    @classmethod
+    def from_model_role(cls, model:dict, **kwargs):
+        """load the memory bank artifact of a model role with the format memory_bank.
+        The artifact can set the path to the backbone weights in `weights`."""
+        artifact = model['artifacts']['memory_bank']
+        return cls.load(artifact['model_path'], artifact.get('weights'), **kwargs)
+
+
+    def predict(self, image:np.ndarray) -> np.ndarray:
+        """predict the anomaly map of an image
+
+        Args:
+            image (np.ndarray): a RGB image
+
+        Returns:
+            np.ndarray: the anomaly map in the original image size
+        """
+        h0,w0 = image.shape[:2]
+        h,w = self.image_size
+        feats = self.extractor(cv2.resize(image, (w,h))[None])[0]
+        fh,fw,d = feats.shape
+        scores = self.index.search(feats.reshape(-1,d), self.nprobe).reshape(fh,fw)
+        err_map = cv2.resize(scores, (w0,h0), interpolation=cv2.INTER_LINEAR)
+        if self.blur_sigma > 0:
+            err_map = cv2.GaussianBlur(err_map, (0,0), self.blur_sigma)
+        return err_map
+
+
+    def warmup(self):
+        h,w = self.image_size
+        self.predict(np.zeros((h,w,3), dtype=np.uint8))
+
+
+    def annotate(self, image:np.ndarray, err_map:np.ndarray, err_threshold:float, err_max:float) -> np.ndarray:
+        return annotate_anomaly(image, err_map, err_threshold, err_max)
+
+
+
+if __name__ == '__main__':
+    import argparse
+    from pipeline_tools.image_io import load_images
+
+    parser = argparse.ArgumentParser(description='build a patch memory bank from a folder of good images')
+    parser.add_argument('--images', required=True, help='the folder of good images')
+    parser.add_argument('--image_size', type=int, nargs=2, default=[224,224], help='height and width')
+    parser.add_argument('--coreset_ratio', type=float, default=0.1)
+    parser.add_argument('--backbone', default='resnet18')
+    parser.add_argument('--weights', required=True, help='the local backbone weights, e.g. the torchvision resnet18 .pth file')
+    parser.add_argument('--n_lists', type=int, default=64)
+    parser.add_argument('--max_images', type=int, default=200)
+    parser.add_argument('--holdout', type=float, default=0.1, help='the fraction of the images held out to evaluate the recall')
+    parser.add_argument('--output', required=True, help='the output npz file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    images = load_images(args.images, args.max_images)
+    # the held-out images are not in the bank, as the frames at inference
+    n_holdout = min(max(int(len(images) * args.holdout), 1), len(images) - 1) if args.holdout > 0 else 0
+    train, holdout = images[n_holdout:], images[:n_holdout]
+    model = PatchMemoryModel.fit(train, args.image_size, args.coreset_ratio, args.backbone, weights=args.weights,
+                                 n_lists=args.n_lists)
+    model.save(args.output)
+
+    # report the recall vs speed of the nprobe values on the patches of the held-out images
+    if not holdout:
+        logger.warning('no image is held out, skip the recall report')
+    else:
+        h,w = args.image_size
+        feats = np.concatenate([model.extractor(cv2.resize(im, (w,h))[None]) for im in holdout])
+        for nprobe,r in model.index.evaluate(feats.reshape(-1, feats.shape[-1])).items():
+            logger.info(f"nprobe {nprobe}: recall {r['recall']:.3f}, time {r['time']*1000:.1f}ms")
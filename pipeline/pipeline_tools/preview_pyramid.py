@@ -0,0 +1,209 @@
+"""
+Description:
+emit a small preview of the annotated image, and serve higher resolution tiles of it only when they are requested.
+
+The pyramid is built in one downsampling pass: each level is half the size of the previous one, level 0 is the full
+resolution. The pipeline uploads the preview level as the annotated output, and keeps the pyramids of the last
+`max_frames` frames in memory, within `max_bytes`. The tiles are only encoded when requested from the tile server:
+    http://<host>:<port>/<frame_id>/<level>/<row>/<col>.jpg
+The server port must be published by the pipeline service, and a client builds the tile urls from the frame id and
+the level shapes of `describe`.
+
+Example:
+    store = TileStore(preview_size=1024, tile_size=512, max_frames=20, max_bytes=256*1024**2)
+    store.serve(8090)
+    preview, levels = store.add(frame_id, annotated_image)
+    tiles = store.describe(frame_id, levels)
+"""
+
+import re
+import json
+import logging
+import threading
+import collections
+import numpy as np
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+TILE_PATH = re.compile(r'^/([\w.-]+)/(\d+)/(\d+)/(\d+)\.jpg$')
+
+
+def build_pyramid(image:np.ndarray, min_side:int=256) -> list:
+    """halve the image until its long side is below min_side
+
+    Args:
+        image (np.ndarray): the full resolution image
+        min_side (int, optional): the min long side of the smallest level. Defaults to 256.
+
+    Returns:
+        list: the levels from the full resolution to the smallest
+    """
+    levels = [image]
+    while max(levels[-1].shape[:2]) // 2 >= min_side:
+        h,w = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], (w//2, h//2), interpolation=cv2.INTER_AREA))
+    return levels
+
+
+class PreviewPyramid:
+    """
+    the pyramid of an image, cut into tiles on request
+    """
+
+    def __init__(self, image:np.ndarray, preview_size:int=1024, tile_size:int=512) -> None:
+        """
+        Args:
+            image (np.ndarray): the full resolution image
+            preview_size (int, optional): the max long side of the preview. Defaults to 1024.
+            tile_size (int, optional): the size of the square tiles. Defaults to 512.
+        """
+        self.levels = build_pyramid(image, min(preview_size, tile_size) // 2)
+        self.tile_size = tile_size
+        # the largest level that fits in the preview size
+        self.preview_level = next((i for i,l in enumerate(self.levels) if max(l.shape[:2]) <= preview_size), len(self.levels)-1)
+
+
+    @property
+    def preview(self) -> np.ndarray:
+        return self.levels[self.preview_level]
+
+
+    @property
+    def nbytes(self) -> int:
+        return sum(l.nbytes for l in self.levels)
+
+
+    def shapes(self) -> list:
+        """a list of [height, width] of the levels"""
+        return [list(l.shape[:2]) for l in self.levels]
+
+
+    def tile(self, level:int, row:int, col:int) -> np.ndarray:
+        """get a tile of a level, the tiles at the right and bottom edges can be smaller"""
+        if not 0 <= level < len(self.levels):
+            raise Exception(f'level {level} is out of range')
+        t = self.tile_size
+        im = self.levels[level]
+        if not (0 <= row*t < im.shape[0] and 0 <= col*t < im.shape[1]):
+            raise Exception(f'tile ({row},{col}) is out of range of level {level}')
+        return im[row*t:(row+1)*t, col*t:(col+1)*t]
+
+
+    def encode_tile(self, level:int, row:int, col:int, quality:int=90) -> bytes:
+        """encode a RGB tile as jpg"""
+        tile = self.tile(level, row, col)
+        bgr = cv2.cvtColor(tile, cv2.COLOR_RGB2BGR) if tile.ndim == 3 else tile
+        ok, buf = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise Exception(f'failed to encode the tile ({row},{col}) of level {level}')
+        return buf.tobytes()
+
+
+class TileStore:
+    """
+    the pyramids of the last frames, with an optional http server of the tiles
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, preview_size:int=1024, tile_size:int=512, max_frames:int=20, max_bytes:int=256*1024**2,
+                 quality:int=90) -> None:
+        """
+        Args:
+            preview_size (int, optional): the max long side of the preview. Defaults to 1024.
+            tile_size (int, optional): the size of the square tiles. Defaults to 512.
+            max_frames (int, optional): the max number of frames whose tiles are kept. Defaults to 20.
+            max_bytes (int, optional): the max memory of the kept pyramids, the newest one is always kept. Defaults to 256 MB.
+            quality (int, optional): the jpg quality of the tiles. Defaults to 90.
+        """
+        self.preview_size = preview_size
+        self.tile_size = tile_size
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.pyramids = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+
+    def add(self, frame_id:str, image:np.ndarray) -> tuple:
+        """build the pyramid of a frame, the oldest frames are dropped if the store is full
+
+        Args:
+            frame_id (str): the id of the frame in the tile urls
+            image (np.ndarray): the full resolution image, which must not be modified afterwards
+
+        Returns:
+            tuple: the preview image and a list of [height, width] of the levels
+        """
+        pyramid = PreviewPyramid(image, self.preview_size, self.tile_size)
+        with self.lock:
+            old = self.pyramids.pop(frame_id, None)
+            self.nbytes += pyramid.nbytes - (old.nbytes if old else 0)
+            self.pyramids[frame_id] = pyramid
+            while len(self.pyramids) > 1 and (len(self.pyramids) > self.max_frames or self.nbytes > self.max_bytes):
+                _, dropped = self.pyramids.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+        return pyramid.preview, pyramid.shapes()
+
+
+    def get_tile(self, frame_id:str, level:int, row:int, col:int) -> bytes:
+        """get the encoded tile, or None if the frame is no longer in the store"""
+        with self.lock:
+            pyramid = self.pyramids.get(frame_id)
+        if pyramid is None:
+            return None
+        return pyramid.encode_tile(level, row, col, self.quality)
+
+
+    def describe(self, frame_id:str, levels:list) -> str:
+        """a json string of what a client needs to build the tile urls of a frame
+
+        Args:
+            frame_id (str): the id of the frame
+            levels (list): a list of [height, width] of the levels, returned by add
+
+        Returns:
+            str: the json of the frame id, the level shapes and the tile size
+        """
+        return json.dumps({'frame_id': frame_id, 'levels': levels, 'tile_size': self.tile_size})
+
+
+    def serve(self, port:int=8090) -> None:
+        """serve the tiles over http from a background thread"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        store = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                m = TILE_PATH.match(self.path)
+                try:
+                    data = store.get_tile(m.group(1), *map(int, m.groups()[1:])) if m else None
+                except Exception as e:
+                    store.logger.debug(f'failed to get the tile {self.path}: {e}')
+                    data = None
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                store.logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='tile_server', daemon=True).start()
+        self.logger.info(f'serving the tiles at port {port}')
+
+
+    def close(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,285 @@
+"""
+Description:
+INT8 post-training quantization of the onnx artifact of a model role.
+
+A model role with the format `int8` is quantized from its `onnx` artifact (see cpu_backend.py), calibrated on a folder
+of sample images. The quantized model is only activated after validate_int8_model has compared it with the float
+`onnx` model and saved an accepted report next to it; until then the role falls back to the float `onnx` artifact.
+The validation runs every image through both models, so it is a separate offline step, e.g. in the test harness of
+a pipeline, rather than part of load: load only reads the saved report.
+"""
+
+import os
+import copy
+import json
+import time
+import logging
+import numpy as np
+import cv2
+
+from pipeline_tools import cpu_backend
+from pipeline_tools.image_io import load_images
+
+
+logger = logging.getLogger(__name__)
+
+MAX_CALIB_IMAGES = 100
+
+# the minimum accuracy of the int8 model against the float model for it to be accepted
+DEFAULT_TOLERANCES = {
+    'detection': {'mean_iou': 0.9, 'class_agreement': 0.98},
+    'classification': {'class_agreement': 0.98},
+    'anomaly': {'map_correlation': 0.98},
+}
+
+
+def get_int8_path(onnx_path:str) -> str:
+    return os.path.splitext(onnx_path)[0] + '_int8.onnx'
+
+
+def get_report_path(int8_path:str) -> str:
+    return os.path.splitext(int8_path)[0] + '.json'
+
+
+def get_calibration_reader(onnx_path:str, images:list, hw:list, mean:tuple=None, std:tuple=None):
+    """create an onnxruntime calibration data reader that feeds the images to the model input,
+    preprocessed the same as in inference"""
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class ImageCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+            self.input_name = session.get_inputs()[0].name
+            self.iter = iter(images)
+
+        def get_next(self):
+            image = next(self.iter, None)
+            if image is None:
+                return None
+            return {self.input_name: cpu_backend.to_nchw(image, hw, mean, std)}
+
+    return ImageCalibrationReader()
+
+
+def quantize_onnx(onnx_path:str, image_dir:str, hw:list, max_images:int=MAX_CALIB_IMAGES, mean:tuple=None,
+                  std:tuple=None) -> str:
+    """quantize an onnx model to int8 with static post-training quantization
+
+    Args:
+        onnx_path (str): the path to the float onnx model
+        image_dir (str): the path to the folder of calibration images
+        hw (list): the model input size [height, width]
+        max_images (int, optional): the max number of calibration images. Defaults to MAX_CALIB_IMAGES.
+        mean (tuple, optional): the normalization mean of the model input. Defaults to None.
+        std (tuple, optional): the normalization std of the model input. Defaults to None.
+
+    Returns:
+        str: the path to the int8 onnx model
+    """
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    images = load_images(image_dir, max_images)
+    int8_path = get_int8_path(onnx_path)
+    pre_path = os.path.splitext(onnx_path)[0] + '_pre.onnx'
+    quant_pre_process(onnx_path, pre_path)
+    logger.info(f'calibrating {onnx_path} on {len(images)} images...')
+    quantize_static(
+        pre_path, int8_path, get_calibration_reader(pre_path, images, hw, mean, std),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        weight_type=QuantType.QInt8,
+        activation_type=QuantType.QUInt8,
+    )
+    os.remove(pre_path)
+    return int8_path
+
+
+def get_input_normalization(model:dict) -> dict:
+    """the mean and std of the model input, only the anomalib inputs are normalized"""
+    if not cpu_backend.is_anomalib(model):
+        return {}
+    mean, std = cpu_backend.get_normalization(model)
+    return {'mean': mean, 'std': std}
+
+
+def load_report(int8_path:str) -> dict:
+    path = get_report_path(int8_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def prepare_int8_model(role:str, model:dict, calib_dir:str=None, export_dir:str=None) -> None:
+    """prepare the int8 artifact of a model role.
+    The role falls back to the float onnx artifact if the int8 model has no accepted report.
+
+    Args:
+        role (str): the model role
+        model (dict): the model role in the models dictionary
+        calib_dir (str, optional): the folder of calibration images. Defaults to None.
+        export_dir (str, optional): the writable root folder of the exports, see cpu_backend. Defaults to EXPORT_DIR.
+    """
+    onnx_path = cpu_backend.prepare_artifact(role, model, 'onnx', export_dir)
+    int8_path = get_int8_path(onnx_path)
+    if not os.path.exists(int8_path) or os.path.getmtime(int8_path) < os.path.getmtime(onnx_path):
+        if not calib_dir:
+            logger.warning(f'{role}: no calibration images to quantize {onnx_path}, use the float onnx model')
+            model['format'] = 'onnx'
+            return
+        int8_path = quantize_onnx(onnx_path, calib_dir, model['artifacts']['onnx']['image_size'], **get_input_normalization(model))
+    model['artifacts']['int8'] = {
+        'model_path': int8_path,
+        'image_size': model['artifacts']['onnx']['image_size'],
+    }
+
+    report = load_report(int8_path)
+    if report is None or not report['accepted'] or report['int8_mtime'] != os.path.getmtime(int8_path):
+        logger.warning(f'{role}: {int8_path} is not validated against the float model, use the float onnx model. '
+                       'Run quantization.validate_int8_model offline to accept it.')
+        model['format'] = 'onnx'
+
+
+def box_iou(boxes1:np.ndarray, boxes2:np.ndarray) -> np.ndarray:
+    """compute the pairwise IoU of two sets of [x1,y1,x2,y2] boxes
+
+    Returns:
+        np.ndarray: a [N,M] array of IoUs
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32).reshape(-1,4)
+    boxes2 = np.asarray(boxes2, dtype=np.float32).reshape(-1,4)
+    lt = np.maximum(boxes1[:,None,:2], boxes2[None,:,:2])
+    rb = np.minimum(boxes1[:,None,2:], boxes2[None,:,2:])
+    inter = np.prod(np.clip(rb-lt, 0, None), axis=2)
+    area1 = np.prod(boxes1[:,2:]-boxes1[:,:2], axis=1)
+    area2 = np.prod(boxes2[:,2:]-boxes2[:,:2], axis=1)
+    return inter / np.maximum(area1[:,None] + area2[None,:] - inter, 1e-9)
+
+
+def compare_detections(ref:dict, test:dict) -> dict:
+    """match the test boxes to the reference boxes by IoU
+
+    Args:
+        ref (dict): the result dict of the float model, which has `boxes` and `classes`
+        test (dict): the result dict of the int8 model
+
+    Returns:
+        dict: the mean IoU of the best matches, and the fraction of matches with the same class
+    """
+    if len(ref['boxes']) == 0 and len(test['boxes']) == 0:
+        return {'mean_iou': 1.0, 'class_agreement': 1.0}
+    if len(ref['boxes']) == 0 or len(test['boxes']) == 0:
+        return {'mean_iou': 0.0, 'class_agreement': 0.0}
+    ious = box_iou(ref['boxes'], test['boxes'])
+    best = ious.argmax(axis=1)
+    same = [ref['classes'][i] == test['classes'][j] for i,j in enumerate(best)]
+    # unmatched test boxes are false positives
+    n = max(len(ref['boxes']), len(test['boxes']))
+    return {
+        'mean_iou': float(ious.max(axis=1).sum() / n),
+        'class_agreement': float(np.sum(same) / n),
+    }
+
+
+def compare_classifications(ref:dict, test:dict) -> dict:
+    return {'class_agreement': float(ref['classes'][0] == test['classes'][0])}
+
+
+def compare_anomaly_maps(ref:np.ndarray, test:np.ndarray) -> dict:
+    ref = np.asarray(ref, dtype=np.float64).ravel()
+    test = np.asarray(test, dtype=np.float64).ravel()
+    if ref.std() == 0 or test.std() == 0:
+        return {'map_correlation': float(np.allclose(ref, test))}
+    return {'map_correlation': float(np.corrcoef(ref, test)[0,1])}
+
+
+def get_task(model:dict) -> str:
+    model_type = model.get('model_type', '')
+    if model_type == 'AnomalyDetection':
+        return 'anomaly'
+    if model_type == 'Classification':
+        return 'classification'
+    return 'detection'
+
+
+COMPARE_FUNCS = {
+    'detection': compare_detections,
+    'classification': compare_classifications,
+    'anomaly': compare_anomaly_maps,
+}
+
+
+def validate_int8_model(pipeline, models:dict, configs:dict, role:str, image_dir:str, predict,
+                        tolerances:dict=None, max_images:int=MAX_CALIB_IMAGES, **kwargs) -> dict:
+    """compare the int8 model of a role with the float onnx model, which the role runs if the int8 model isn't
+    accepted, and accept it if the accuracy is within tolerance. The speedup is measured against the same float model.
+    The report is saved next to the int8 model; prepare_int8_model only activates an accepted int8 model.
+    It is an offline step: the models of the role are reloaded, so call it before pipeline.load().
+
+    Args:
+        pipeline (ModelPipeline): a pipeline instance
+        models (dict): model roles
+        configs (dict): runtime configs
+        role (str): the model role with the format int8
+        image_dir (str): the folder of validation images, which also calibrates the int8 model if it is missing
+        predict (callable): a function of (model, image) that returns the result dict, or the anomaly map
+        tolerances (dict, optional): the min value of each accuracy metric. Defaults to DEFAULT_TOLERANCES of the task.
+        max_images (int, optional): the max number of images. Defaults to MAX_CALIB_IMAGES.
+        kwargs: the keyword arguments passed to pipeline.load_models()
+
+    Returns:
+        dict: the report of speedup and accuracy
+    """
+    model = models[role]
+    task = get_task(model)
+    tolerances = tolerances or DEFAULT_TOLERANCES[task]
+    onnx_path = cpu_backend.prepare_artifact(role, model, 'onnx')
+    int8_path = get_int8_path(onnx_path)
+    if not os.path.exists(int8_path) or os.path.getmtime(int8_path) < os.path.getmtime(onnx_path):
+        int8_path = quantize_onnx(onnx_path, image_dir, model['artifacts']['onnx']['image_size'], max_images,
+                                  **get_input_normalization(model))
+    images = load_images(image_dir, max_images)
+
+    def run(fmt):
+        variant = copy.deepcopy(model)
+        variant['format'] = fmt
+        if fmt == 'int8':
+            variant['artifacts']['int8'] = {'model_path': int8_path, 'image_size': model['artifacts']['onnx']['image_size']}
+        if task == 'anomaly':
+            m = cpu_backend.AnomalyCpuModel.from_model_role(variant)
+        else:
+            pipeline.load_models({role: variant}, configs, role, **kwargs)
+            m = pipeline.models[role]
+        m.warmup()
+        outputs = []
+        t1 = time.time()
+        for image in images:
+            outputs.append(predict(m, image))
+        return outputs, (time.time()-t1) / len(images)
+
+    ref_outputs, float_time = run('onnx')
+    test_outputs, int8_time = run('int8')
+    metrics = {}
+    for ref,test in zip(ref_outputs, test_outputs):
+        for k,v in COMPARE_FUNCS[task](ref, test).items():
+            metrics.setdefault(k, []).append(v)
+    metrics = {k:float(np.mean(v)) for k,v in metrics.items()}
+
+    report = {
+        'role': role,
+        'task': task,
+        'num_images': len(images),
+        'float_time': float_time,
+        'int8_time': int8_time,
+        'speedup': float_time / max(int8_time, 1e-9),
+        'metrics': metrics,
+        'tolerances': tolerances,
+        'accepted': all(metrics[k] >= v for k,v in tolerances.items()),
+        'int8_mtime': os.path.getmtime(int8_path),
+    }
+    with open(get_report_path(int8_path), 'w') as f:
+        json.dump(report, f, indent=4)
+    logger.info(f"{role} int8 speedup: {report['speedup']:.2f}x, metrics: {metrics}, accepted: {report['accepted']}")
+    return report
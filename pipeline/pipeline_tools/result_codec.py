@@ -0,0 +1,165 @@
+"""
+Description:
+a binary wire format of the pipeline results, where the numpy arrays and the bytes are sent out-of-band.
+
+The results mix nested dicts, prediction lists and raw image arrays. Converting all of them to json lists costs CPU
+time and grows the message, so encode() walks the results once and splits them into:
+    - a compact json header of the structure, where each array is replaced by {"__nd__": [index, dtype, shape]}
+      and each bytes value by {"__bytes__": index}
+    - a list of buffers, the raw memory of the contiguous arrays, which are not copied
+The header and the buffers are sent as the frames of a zmq multipart message, and decode() rebuilds the arrays with
+np.frombuffer on the received frames, so the image bytes are not copied either. send() and recv() do both on a zmq
+socket, with the topic as the first frame, so the producer and the consumer always agree on the framing.
+Arrays smaller than `min_buffer_bytes` are kept in the header as {"__nd__": [values, dtype, shape]}, since a frame per
+box isn't worth it, and they are decoded with the same dtype and shape, including the empty ones.
+
+The module only imports numpy when an array is decoded, so a process without numpy can decode the other values.
+
+Example:
+    send(socket, topic, results)
+    ...
+    topic, results = recv(socket)
+"""
+
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+ND_KEY = '__nd__'
+BYTES_KEY = '__bytes__'
+
+
+def encode(obj, min_buffer_bytes:int=256) -> tuple:
+    """split an object into a json header and a list of out-of-band buffers
+
+    Args:
+        obj (dict): the results, or any tree of dicts, lists, tuples, scalars, strings, bytes and numpy arrays
+        min_buffer_bytes (int, optional): the arrays smaller than this are kept in the header. Defaults to 256.
+
+    Returns:
+        tuple: the header bytes and a list of buffers (memoryview)
+    """
+    buffers = []
+
+    def walk(v):
+        if v is None or isinstance(v, (str, bool, int, float)):
+            return v
+        if isinstance(v, dict):
+            return {str(k): walk(x) for k,x in v.items()}
+        if isinstance(v, (list, tuple)):
+            return [walk(x) for x in v]
+        if isinstance(v, (bytes, bytearray, memoryview)):
+            buffers.append(memoryview(v).cast('B'))
+            return {BYTES_KEY: len(buffers) - 1}
+        # numpy arrays and scalars, checked by attributes so numpy isn't imported here
+        if hasattr(v, 'dtype') and hasattr(v, 'shape'):
+            if v.shape == () or v.dtype.hasobject:
+                return walk(v.tolist())
+            if v.nbytes < min_buffer_bytes:
+                # flattened, so the shape of an empty array such as (0,4) is kept by the reshape on decode
+                return {ND_KEY: [v.reshape(-1).tolist(), v.dtype.str, list(v.shape)]}
+            if not v.flags.c_contiguous:
+                import numpy as np
+                v = np.ascontiguousarray(v)
+            buffers.append(memoryview(v).cast('B'))
+            return {ND_KEY: [len(buffers) - 1, v.dtype.str, list(v.shape)]}
+        raise Exception(f'cannot encode a value of type {type(v).__name__}')
+
+    header = json.dumps(walk(obj), separators=(',', ':')).encode()
+    return header, buffers
+
+
+def decode(header, buffers:list):
+    """rebuild an object from its header and buffers
+
+    Args:
+        header (bytes): the json header of encode
+        buffers (list): the buffers of encode, as bytes, memoryview or zmq frames
+
+    Returns:
+        dict: the object, the arrays are read-only views of the buffers and the bytes values are copied to bytes
+    """
+    buffers = [memoryview(getattr(b, 'buffer', b)) for b in buffers]
+
+    def walk(v):
+        if isinstance(v, dict):
+            if ND_KEY in v and len(v) == 1:
+                import numpy as np
+                data, dtype, shape = v[ND_KEY]
+                if isinstance(data, list):
+                    # a small array kept in the header
+                    return np.array(data, dtype=np.dtype(dtype)).reshape(shape)
+                return np.frombuffer(buffers[data], dtype=np.dtype(dtype)).reshape(shape)
+            if BYTES_KEY in v and len(v) == 1:
+                return bytes(buffers[v[BYTES_KEY]])
+            return {k: walk(x) for k,x in v.items()}
+        if isinstance(v, list):
+            return [walk(x) for x in v]
+        return v
+
+    return walk(json.loads(bytes(getattr(header, 'buffer', header))))
+
+
+def send(socket, topic:str, obj, min_buffer_bytes:int=256) -> None:
+    """send an object as a multipart message of the topic, the header and the buffers
+
+    Args:
+        socket (zmq.Socket): a zmq socket, such as a PUB socket
+        topic (str): the topic, the first frame
+        obj (dict): the object to encode
+        min_buffer_bytes (int, optional): the arrays smaller than this are kept in the header. Defaults to 256.
+    """
+    header, buffers = encode(obj, min_buffer_bytes)
+    socket.send_multipart([topic.encode(), header, *buffers], copy=False)
+
+
+def recv(socket) -> tuple:
+    """receive a multipart message of send
+
+    Args:
+        socket (zmq.Socket): a zmq socket, such as a SUB socket
+
+    Returns:
+        tuple: the topic and the object, the arrays are read-only views of the received frames
+    """
+    topic, header, *buffers = socket.recv_multipart(copy=False)
+    return bytes(getattr(topic, 'buffer', topic)).decode(), decode(header, buffers)
+
+
+
+if __name__ == '__main__':
+    import time
+    import numpy as np
+
+    # compare with converting the arrays of typical results to json lists
+    rng = np.random.default_rng(0)
+    results = {
+        'outputs': {'annotated': rng.integers(0, 255, (1080, 1440, 3), dtype=np.uint8)},
+        'automation_keys': ['decision'],
+        'decision': 'PASS',
+        'boxes': rng.uniform(0, 1000, (200, 4)).astype(np.float32),
+        'segments': [rng.integers(0, 1000, (300, 2), dtype=np.int32) for _ in range(50)],
+    }
+
+    def to_json(v):
+        if isinstance(v, dict):
+            return {k: to_json(x) for k,x in v.items()}
+        if isinstance(v, list):
+            return [to_json(x) for x in v]
+        return v.tolist() if isinstance(v, np.ndarray) else v
+
+    def encoded():
+        header, buffers = encode(results)
+        return [header, *buffers]
+
+    for name, fn in (('json', lambda: [json.dumps(to_json(results)).encode()]), ('encoded', encoded)):
+        t1 = time.time()
+        for _ in range(5):
+            frames = fn()
+        print(f'{name}: {sum(len(f) for f in frames)/1e6:.2f} MB, {(time.time()-t1)/5*1000:.1f} ms')
+    header, *buffers = encoded()
+    out = decode(header, [bytes(b) for b in buffers])
+    assert all(np.array_equal(a, b) for a,b in zip(out['segments'], results['segments']))
+    assert np.array_equal(out['outputs']['annotated'], results['outputs']['annotated'])
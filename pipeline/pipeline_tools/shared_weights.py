@@ -0,0 +1,142 @@
+"""
+Description:
+memory map the arrays of a model file so that pipeline replicas share the same physical pages, and report the
+unique vs shared memory of each process.
+
+mmap_npz maps the arrays of an uncompressed npz file (np.savez) read-only, so they stay backed by the page cache of
+the file and all the processes that load it share one copy, as long as the arrays are not converted. The patch
+memory bank of the anomalib example is loaded this way (see patch_memory.load_bank), which is the bulk of that model.
+The torch, torchscript, onnx and openvino weights are copied by their runtimes when loaded, so they are not shared.
+Check with memory_report that the replicas share the pages of the model files.
+
+Example:
+    arrays = shared_weights.mmap_npz(path)
+    shared_weights.log_memory_report(os.path.dirname(path))
+"""
+
+import os
+import struct
+import logging
+import zipfile
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# the smaps fields of shared and private pages
+SHARED_FIELDS = ('Shared_Clean', 'Shared_Dirty')
+UNIQUE_FIELDS = ('Private_Clean', 'Private_Dirty')
+# the fixed size of a zip local file header, followed by the file name and the extra field
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+
+
+def mmap_npz(path:str) -> dict:
+    """memory map the arrays of an npz file read-only.
+    The compressed members, the empty and 0-d arrays and the object arrays are read as usual.
+
+    Args:
+        path (str): the path to the npz file
+
+    Returns:
+        dict: a dict of the array names to the arrays
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type == zipfile.ZIP_STORED:
+                # the member data starts after its local header, whose extra field can differ from the central one
+                f.seek(info.header_offset)
+                fields = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+                f.seek(info.header_offset + ZIP_LOCAL_HEADER.size + fields[-2] + fields[-1])
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(f)
+                if shape and np.prod(shape) > 0 and not dtype.hasobject:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                             order='F' if fortran_order else 'C')
+                    continue
+            with zf.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+    return arrays
+
+
+def parse_smaps(pid:int=None) -> list:
+    """parse /proc/<pid>/smaps into a list of mappings
+
+    Args:
+        pid (int, optional): the process id. Defaults to None, which is the current process.
+
+    Returns:
+        list: a list of dicts with the path of the mapping and its fields in kB
+    """
+    path = f"/proc/{pid or 'self'}/smaps"
+    mappings = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if not parts[0].endswith(':'):
+                # a mapping header: address perms offset dev inode [path]
+                mappings.append({'path': parts[5] if len(parts) > 5 else ''})
+            elif len(parts) >= 3 and parts[2] == 'kB' and mappings:
+                mappings[-1][parts[0][:-1]] = int(parts[1])
+    return mappings
+
+
+def memory_report(pid:int=None, weight_dirs:list=None) -> dict:
+    """report the unique and shared memory of a process in MB
+
+    Args:
+        pid (int, optional): the process id. Defaults to None, which is the current process.
+        weight_dirs (list, optional): the folders of the weight files, e.g. MODELS_ROOT. Defaults to None.
+
+    Returns:
+        dict: rss, pss, unique and shared memory of the process, and of the mapped weight files under weight_dirs
+    """
+    weight_dirs = [os.path.abspath(d) for d in (weight_dirs or []) if d]
+    total = {'rss': 0, 'pss': 0, 'unique': 0, 'shared': 0}
+    weights = {}
+    for m in parse_smaps(pid):
+        unique = sum(m.get(k, 0) for k in UNIQUE_FIELDS)
+        shared = sum(m.get(k, 0) for k in SHARED_FIELDS)
+        total['rss'] += m.get('Rss', 0)
+        total['pss'] += m.get('Pss', 0)
+        total['unique'] += unique
+        total['shared'] += shared
+        if any(m['path'].startswith(d + os.sep) for d in weight_dirs):
+            w = weights.setdefault(m['path'], {'rss': 0, 'unique': 0, 'shared': 0})
+            w['rss'] += m.get('Rss', 0)
+            w['unique'] += unique
+            w['shared'] += shared
+
+    to_mb = lambda d: {k: v * 1024 / MB for k,v in d.items()}
+    return {
+        'pid': pid or os.getpid(),
+        **to_mb(total),
+        'weights': {path: to_mb(w) for path,w in weights.items()},
+    }
+
+
+def log_memory_report(weight_dirs:list=None, pid:int=None) -> dict:
+    """log the memory report of a process
+
+    Args:
+        weight_dirs (list, optional): the folders of the weight files. Defaults to None.
+        pid (int, optional): the process id. Defaults to None, which is the current process.
+
+    Returns:
+        dict: the memory report
+    """
+    if isinstance(weight_dirs, str):
+        weight_dirs = [weight_dirs]
+    report = memory_report(pid, weight_dirs)
+    logger.info(
+        f"pid {report['pid']} memory: rss {report['rss']:.1f}MB, pss {report['pss']:.1f}MB, "
+        f"unique {report['unique']:.1f}MB, shared {report['shared']:.1f}MB"
+    )
+    for path,w in report['weights'].items():
+        logger.info(f"  {path}: rss {w['rss']:.1f}MB, unique {w['unique']:.1f}MB, shared {w['shared']:.1f}MB")
+    return report
@@ -0,0 +1,357 @@
+"""
+Description:
+record the frames of a sensor topic with their arrival times, and replay them to a pipeline at the recorded cadence.
+
+A recording is a single append-only file. After a magic header, each message is stored as:
+    [float64 arrival time][uint32 number of parts]([uint32 part length][part bytes])...
+The parts are the raw zmq multipart message, so nothing is lost. The sensors usually send the path of the image in the
+inline storage rather than its pixels, so record_topic appends the bytes of the image files named in a json part to
+the message, and the recording can be replayed where the storage isn't mounted. decode_frame turns a message into the
+pipeline inputs: it decodes the first part that is an encoded image, or loads the image file named in a json part.
+
+The replayer streams the recording and feeds the frames to a ModelPipeline from a producer thread into a bounded
+queue, as the pipeline server does, at one of the cadences:
+    original: the recorded arrival times
+    scaled: the recorded arrival times divided by `speed`
+    burst: groups of `burst_size` frames arrive together, at the scaled time of the first frame of each group
+Frames arriving at a full queue are dropped. The report includes the queueing delay (from arrival to the start of
+predict), the processing time and the dropped frames.
+
+Usage:
+    python -m pipeline_tools.stream_replay record --address tcp://localhost:5001 --topic sensor/profiler --output ./profiler.rec --duration 60
+    python -m pipeline_tools.stream_replay record --image_dir ./test_images --fps 5 --output ./test.rec
+    python -m pipeline_tools.stream_replay play --recording ./profiler.rec --mode scaled --speed 2 \\
+        --pipeline_def ./pipeline/pipeline_def.json --manifest /app/models/static/manifest.json
+"""
+
+import os
+import json
+import time
+import queue
+import struct
+import logging
+import threading
+import numpy as np
+import cv2
+
+from pipeline_tools.image_io import IMAGE_FORMATS, list_images
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'GADGETREC1'
+MODES = ('original', 'scaled', 'burst')
+HEADER = struct.Struct('<dI')
+PART = struct.Struct('<I')
+
+
+class RecordingWriter:
+    """
+    append messages and their arrival times to a recording file
+    """
+
+    def __init__(self, path:str) -> None:
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.count = 0
+
+
+    def write(self, t:float, parts:list) -> None:
+        """
+        Args:
+            t (float): the arrival time in seconds
+            parts (list): a list of bytes of the multipart message
+        """
+        self.f.write(HEADER.pack(t, len(parts)))
+        for p in parts:
+            self.f.write(PART.pack(len(p)))
+            self.f.write(p)
+        self.count += 1
+
+
+    def close(self) -> None:
+        self.f.close()
+
+
+def read_recording(path:str, skip_parts:bool=False):
+    """iterate over the (arrival time, parts) of a recording
+
+    Args:
+        path (str): the recording file
+        skip_parts (bool, optional): seek over the parts and yield None instead, to read the times only. Defaults to False.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception(f'{path} is not a recording')
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            t, n = HEADER.unpack(header)
+            parts = None if skip_parts else []
+            for _ in range(n):
+                size, = PART.unpack(f.read(PART.size))
+                if skip_parts:
+                    f.seek(size, os.SEEK_CUR)
+                else:
+                    parts.append(f.read(size))
+            yield t, parts
+
+
+def find_image_paths(msg) -> list:
+    """find the paths to the existing image files in a parsed json message"""
+    if isinstance(msg, dict):
+        return [p for v in msg.values() for p in find_image_paths(v)]
+    if isinstance(msg, list):
+        return [p for v in msg for p in find_image_paths(v)]
+    if isinstance(msg, str) and msg.lower().endswith(IMAGE_FORMATS) and os.path.isfile(msg):
+        return [msg]
+    return []
+
+
+def embed_images(parts:list) -> list:
+    """append the bytes of the image files named in the json parts of a message
+
+    Args:
+        parts (list): a list of bytes of the multipart message
+
+    Returns:
+        list: the parts followed by the bytes of each image file
+    """
+    files = []
+    for p in parts:
+        try:
+            files += find_image_paths(json.loads(p))
+        except ValueError:
+            continue
+    out = list(parts)
+    for path in files:
+        with open(path, 'rb') as f:
+            out.append(f.read())
+    return out
+
+
+def record_topic(address:str, topic:str, output:str, duration:float=None, max_frames:int=None) -> int:
+    """record the messages of a zmq topic
+
+    Args:
+        address (str): the zmq address of the data broker output, e.g. tcp://localhost:5001
+        topic (str): the topic, e.g. sensor/profiler
+        output (str): the recording file
+        duration (float, optional): the seconds to record. Defaults to None, which records until interrupted.
+        max_frames (int, optional): the max number of messages. Defaults to None.
+
+    Returns:
+        int: the number of recorded messages
+    """
+    import zmq
+
+    socket = zmq.Context.instance().socket(zmq.SUB)
+    socket.connect(address)
+    socket.setsockopt(zmq.SUBSCRIBE, topic.encode())
+    writer = RecordingWriter(output)
+    end = time.time() + duration if duration else None
+    try:
+        while (end is None or time.time() < end) and (max_frames is None or writer.count < max_frames):
+            if not socket.poll(100):
+                continue
+            t = time.time()
+            # embed the pixels, the files in the inline storage may be gone by the time of the replay
+            writer.write(t, embed_images(socket.recv_multipart()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        socket.close(linger=0)
+    logger.info(f'recorded {writer.count} messages of {topic} to {output}')
+    return writer.count
+
+
+def record_folder(image_dir:str, output:str, fps:float=None) -> int:
+    """create a recording from a folder of images, at a fixed fps or at the file modification times
+
+    Returns:
+        int: the number of recorded images
+    """
+    paths = list_images(image_dir)
+    if not fps:
+        paths.sort(key=os.path.getmtime)
+    writer = RecordingWriter(output)
+    for i,path in enumerate(paths):
+        t = i / fps if fps else os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            writer.write(t, [b'file', f.read()])
+    writer.close()
+    return len(paths)
+
+
+def decode_frame(parts:list) -> dict:
+    """decode a recorded message into the pipeline inputs
+
+    Args:
+        parts (list): a list of bytes of the multipart message
+
+    Returns:
+        dict: the inputs of predict, or None if no image is found
+    """
+    for p in parts:
+        buf = np.frombuffer(p, dtype=np.uint8)
+        im = cv2.imdecode(buf, cv2.IMREAD_COLOR) if len(buf) > 16 else None
+        if im is not None:
+            return {'image': {'pixels': cv2.cvtColor(im, cv2.COLOR_BGR2RGB)}}
+        try:
+            paths = find_image_paths(json.loads(p))
+        except ValueError:
+            continue
+        if paths:
+            return {'image': {'pixels': cv2.cvtColor(cv2.imread(paths[0]), cv2.COLOR_BGR2RGB)}}
+    return None
+
+
+def get_schedule(times:list, mode:str='original', speed:float=1.0, burst_size:int=10) -> np.ndarray:
+    """get the replay time of each frame relative to the start
+
+    Args:
+        times (list): the recorded arrival times
+        mode (str, optional): original, scaled or burst. Defaults to original.
+        speed (float, optional): the speed of scaled and burst. Defaults to 1.0.
+        burst_size (int, optional): the number of frames per burst. Defaults to 10.
+
+    Returns:
+        np.ndarray: the replay times in seconds
+    """
+    if mode not in MODES:
+        raise Exception(f'unknown mode: {mode}, must be one of {MODES}')
+    t = np.asarray(times, dtype=np.float64)
+    t = t - t[0] if len(t) else t
+    if mode == 'original':
+        return t
+    t = t / speed
+    if mode == 'burst':
+        t = t[(np.arange(len(t)) // burst_size) * burst_size]
+    return t
+
+
+def percentiles(values:list) -> dict:
+    if not values:
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99]) * 1000
+    return {'p50': round(float(p50), 2), 'p90': round(float(p90), 2), 'p99': round(float(p99), 2), 'max': round(max(values)*1000, 2)}
+
+
+def replay(pipeline, configs:dict, recording:str, mode:str='original', speed:float=1.0, burst_size:int=10,
+           max_queue:int=1, decode=decode_frame) -> dict:
+    """replay a recording to a pipeline
+
+    Args:
+        pipeline (ModelPipeline): a loaded and warmed up pipeline
+        configs (dict): runtime configs
+        recording (str): the recording file
+        mode (str, optional): original, scaled or burst. Defaults to original.
+        speed (float, optional): the speed of scaled and burst. Defaults to 1.0.
+        burst_size (int, optional): the number of frames per burst. Defaults to 10.
+        max_queue (int, optional): the max number of frames waiting for predict. Defaults to 1.
+        decode (callable, optional): the function of the parts to the inputs. Defaults to decode_frame.
+
+    Returns:
+        dict: the report with the number of frames, the dropped frames, the queueing delay and processing time in ms
+    """
+    # only the times are read up front, the frames are streamed from the file
+    schedule = get_schedule([t for t,_ in read_recording(recording, skip_parts=True)], mode, speed, burst_size)
+    frames = queue.Queue(maxsize=max_queue)
+    dropped = []
+    done = object()
+
+    def produce():
+        start = time.time()
+        for i,(t,(_,parts)) in enumerate(zip(schedule, read_recording(recording))):
+            delay = start + t - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                frames.put_nowait((i, time.time(), parts))
+            except queue.Full:
+                dropped.append(i)
+        frames.put(done)
+
+    producer = threading.Thread(target=produce, name='replay', daemon=True)
+    producer.start()
+    delays, proc_times, failed = [], [], 0
+    while True:
+        item = frames.get()
+        if item is done:
+            break
+        i, arrival, parts = item
+        delays.append(time.time() - arrival)
+        inputs = decode(parts)
+        if inputs is None:
+            failed += 1
+            continue
+        t1 = time.time()
+        pipeline.predict(configs, inputs)
+        proc_times.append(time.time() - t1)
+    producer.join()
+
+    duration = schedule[-1] if len(schedule) else 0
+    report = {
+        'mode': mode,
+        'speed': speed,
+        'frames': len(schedule),
+        'processed': len(proc_times),
+        'dropped': len(dropped),
+        'undecoded': failed,
+        'input_fps': round(len(schedule) / float(duration), 2) if duration else None,
+        'queue_delay_ms': percentiles(delays),
+        'proc_time_ms': percentiles(proc_times),
+    }
+    logger.info(f'replay report: {report}')
+    return report
+
+
+
+if __name__ == '__main__':
+    import argparse
+    import importlib
+
+    parser = argparse.ArgumentParser(description='record and replay a sensor frame stream')
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record')
+    rec.add_argument('--output', required=True, help='the recording file')
+    rec.add_argument('--address', default='tcp://localhost:5001', help='the data broker output address')
+    rec.add_argument('--topic', default='sensor/profiler')
+    rec.add_argument('--duration', type=float, default=None, help='the seconds to record')
+    rec.add_argument('--max_frames', type=int, default=None)
+    rec.add_argument('--image_dir', default=None, help='record a folder of images instead of a topic')
+    rec.add_argument('--fps', type=float, default=None, help='the fps of the folder, defaults to the file times')
+    play = sub.add_parser('play')
+    play.add_argument('--recording', required=True)
+    play.add_argument('--pipeline_def', default='./pipeline/pipeline_def.json')
+    play.add_argument('--manifest', required=True, help='the static models manifest')
+    play.add_argument('--pipeline_class', default='pipeline_class.ModelPipeline')
+    play.add_argument('--mode', default='original', choices=MODES)
+    play.add_argument('--speed', type=float, default=1.0)
+    play.add_argument('--burst_size', type=int, default=10)
+    play.add_argument('--max_queue', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'record':
+        if args.image_dir:
+            n = record_folder(args.image_dir, args.output, args.fps)
+            logger.info(f'recorded {n} images to {args.output}')
+        else:
+            record_topic(args.address, args.topic, args.output, args.duration, args.max_frames)
+    else:
+        import gadget_utils.pipeline_utils as pipeline_utils
+
+        module, cls = args.pipeline_class.rsplit('.', 1)
+        pipeline_cls = getattr(importlib.import_module(module), cls)
+        kwargs = pipeline_utils.load_pipeline_def(args.pipeline_def)
+        manifest = pipeline_utils.get_models_from_static_manifest(args.manifest)
+        kwargs['models'] = manifest
+        pipeline = pipeline_cls(**kwargs)
+        pipeline.load(manifest, kwargs)
+        pipeline.warm_up(kwargs)
+        report = replay(pipeline, kwargs, args.recording, args.mode, args.speed, args.burst_size, args.max_queue)
+        print(json.dumps(report, indent=4))
+        pipeline.clean_up()
@@ -0,0 +1,235 @@
+"""
+Description:
+a minimal tracer that follows a frame across the gadget services, with no dependencies. The automation examples keep
+their own copy of the part they need (automation/examples/modbus/trace_context.py).
+
+The trace context is a W3C traceparent string, "00-<32 hex trace id>-<16 hex span id>-01", passed from service to
+service in the messages:
+    - the pipeline continues the trace of the sensor if the inputs carry a `traceparent`, otherwise it starts one.
+    - the pipeline adds the `traceparent` of its predict span to the results sent to automation.
+    - the automation class continues it in decision_mapping and send_action.
+The finished spans are appended to a file in the OpenTelemetry OTLP/JSON format, one ExportTraceServiceRequest per
+line, which can be loaded by the OpenTelemetry collector (otlpjsonfile receiver) or merged across services by trace id.
+The file is set by `export_path` or the TRACE_EXPORT_PATH env variable, spans are not exported if neither is set.
+
+Example:
+    tracer = Tracer('pipeline')
+    with tracer.span('predict', parent=extract(inputs)) as root:
+        with tracer.span('model'):
+            ...
+    update_results('traceparent', root.traceparent, to_automation=True)
+A method can also run in a span with the traced decorator, which finds the traceparent in its arguments.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import functools
+import contextlib
+
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT = 'traceparent'
+
+
+def new_id(num_bytes:int) -> str:
+    return os.urandom(num_bytes).hex()
+
+
+def parse_traceparent(traceparent:str) -> tuple:
+    """parse a traceparent into the trace id and the span id, or None if it is invalid"""
+    parts = traceparent.split('-') if isinstance(traceparent, str) else []
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+def extract(carrier:dict) -> tuple:
+    """find the traceparent in a message, at its top level or in one of its dicts
+
+    Args:
+        carrier (dict): the inputs of predict, or the results of a pipeline message
+
+    Returns:
+        tuple: the trace id and the parent span id, or None
+    """
+    if not isinstance(carrier, dict):
+        return None
+    if TRACEPARENT in carrier:
+        return parse_traceparent(carrier[TRACEPARENT])
+    for v in carrier.values():
+        if isinstance(v, dict) and TRACEPARENT in v:
+            return parse_traceparent(v[TRACEPARENT])
+    return None
+
+
+def traced(name:str, tracer_attr:str='tracer'):
+    """decorate a method to run it in a span of the Tracer attribute of its object. The span continues the trace of
+    the first argument that carries a traceparent, e.g. the inputs of predict, and is the current span of the tracer
+    while the method runs.
+
+    Args:
+        name (str): the span name
+        tracer_attr (str, optional): the attribute of the Tracer. Defaults to 'tracer'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            parent = next((p for p in map(extract, [*args, *kwargs.values()]) if p), None)
+            with getattr(obj, tracer_attr).span(name, parent=parent):
+                return func(obj, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Span:
+    """
+    a timed operation of a trace
+    """
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name:str, trace_id:str, parent_id:str=None, attributes:dict=None) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+
+    @property
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+
+    @property
+    def context(self) -> tuple:
+        return self.trace_id, self.span_id
+
+
+    def set_attribute(self, key:str, value) -> None:
+        self.attributes[key] = value
+
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [to_otlp_attribute(k, v) for k,v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def to_otlp_attribute(key:str, value) -> dict:
+    if isinstance(value, bool):
+        v = {'boolValue': value}
+    elif isinstance(value, int):
+        v = {'intValue': str(value)}
+    elif isinstance(value, float):
+        v = {'doubleValue': value}
+    else:
+        v = {'stringValue': str(value)}
+    return {'key': key, 'value': v}
+
+
+class Tracer:
+    """
+    creates the spans of a service and appends them to the export file
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, service_name:str, export_path:str=None, batch_size:int=64) -> None:
+        """
+        Args:
+            service_name (str): the service name of the spans
+            export_path (str, optional): the OTLP/JSON lines file. Defaults to the TRACE_EXPORT_PATH env variable.
+            batch_size (int, optional): the number of spans written per line. Defaults to 64.
+        """
+        self.service_name = service_name
+        self.export_path = export_path or os.environ.get('TRACE_EXPORT_PATH')
+        self.batch_size = batch_size
+        self.finished = []
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        if self.export_path:
+            os.makedirs(os.path.dirname(self.export_path) or '.', exist_ok=True)
+            self.logger.info(f'exporting the spans of {service_name} to {self.export_path}')
+
+
+    def current(self) -> Span:
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+
+    @contextlib.contextmanager
+    def span(self, name:str, parent:tuple=None, attributes:dict=None):
+        """time a block as a span
+
+        Args:
+            name (str): the span name
+            parent (tuple, optional): the trace id and the parent span id. Defaults to the current span of the
+                thread, or a new trace if there is none.
+            attributes (dict, optional): the span attributes. Defaults to None.
+        """
+        if parent is None and self.current() is not None:
+            parent = self.current().context
+        trace_id, parent_id = parent if parent else (new_id(16), None)
+        span = Span(name, trace_id, parent_id, attributes)
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = repr(e)
+            raise
+        finally:
+            self.local.stack.pop()
+            span.end_ns = time.time_ns()
+            self.finish(span)
+
+
+    def finish(self, span:Span) -> None:
+        if not self.export_path:
+            return
+        with self.lock:
+            self.finished.append(span)
+            # write when a trace of this service is complete, or the batch is full
+            if self.current() is None or len(self.finished) >= self.batch_size:
+                self.flush()
+
+
+    def flush(self) -> None:
+        """append the finished spans to the export file as one OTLP/JSON line"""
+        with self.lock:
+            spans, self.finished = self.finished, []
+        if not spans:
+            return
+        request = {
+            'resourceSpans': [{
+                'resource': {'attributes': [to_otlp_attribute('service.name', self.service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': 'gadget'},
+                    'spans': [s.to_otlp() for s in spans],
+                }],
+            }]
+        }
+        try:
+            with open(self.export_path, 'a') as f:
+                f.write(json.dumps(request) + '\n')
+        except OSError:
+            self.logger.exception('failed to export the spans')
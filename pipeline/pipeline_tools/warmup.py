@@ -0,0 +1,165 @@
+"""
+Description:
+shape-aware warm-up and automatic tuning of the cpu threads.
+
+The default warmup() of a model runs once on a dummy input, so the first frames at the real shapes still pay for the
+memory allocation and the kernel selection. warm_up_role runs a model role on the sample images (e.g. test_images)
+resized to the role's image_size, one image per call as predict takes them. tune_threads benchmarks the thread counts
+on the same inputs and applies the fastest one with a set_threads function:
+    - torch models: cpu_backend.set_cpu_threads (the default), which sets the torch intra-op threads.
+    - onnxruntime and openvino sessions: a function that recreates the session with the thread count, such as
+      AnomalyCpuModel.load_session. The torch threads have no effect on these sessions.
+
+The chosen settings are cached in a json file keyed by the model files, the cpu count and the image size, so the next
+start only applies them.
+
+Example:
+    inputs = get_warmup_inputs(image_size, image_dir='/home/gadget/test_images')
+    settings = warm_up_role('od_model', model.predict, inputs, model_paths=[...], tune=True)
+    settings = warm_up_role('ad_model', model.predict, inputs, model_paths=[...], tune=True, set_threads=model.load_session)
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+import cv2
+
+from pipeline_tools import cpu_backend
+from pipeline_tools.image_io import load_images
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.path.join(os.environ.get('DATA_STORAGE_ROOT', '/app/data'), 'pipeline_warmup.json')
+
+
+def get_warmup_inputs(image_size:list, image_dir:str=None, max_images:int=4) -> list:
+    """create the warm-up inputs from sample images, or random images if no folder is given
+
+    Args:
+        image_size (list): a list of [height, width] of the model input
+        image_dir (str, optional): the folder of sample images. Defaults to None.
+        max_images (int, optional): the max number of sample images. Defaults to 4.
+
+    Returns:
+        list: a list of RGB images of image_size
+    """
+    h,w = image_size
+    if image_dir and os.path.isdir(image_dir):
+        return [cv2.resize(im, (w,h)) for im in load_images(image_dir, max_images)]
+    return [np.random.randint(0, 255, (h,w,3), dtype=np.uint8) for _ in range(max_images)]
+
+
+def get_signature(model_paths:list, image_size:list) -> str:
+    """the cache key of the model files (and their modification times), the cpu count and the input size"""
+    items = [[p, os.path.getmtime(p) if os.path.exists(p) else None] for p in sorted(model_paths)]
+    items += [os.cpu_count(), list(image_size)]
+    return hashlib.sha1(json.dumps(items).encode()).hexdigest()
+
+
+def load_cache(cache_file:str) -> dict:
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as f:
+        return json.load(f)
+
+
+def save_cache(cache_file:str, cache:dict) -> None:
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    tmp = cache_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp, cache_file)
+
+
+def time_inputs(run, inputs:list, repeats:int=3) -> float:
+    """the median time in seconds of running all the inputs"""
+    times = []
+    for _ in range(repeats):
+        t1 = time.time()
+        for x in inputs:
+            run(x)
+        times.append(time.time() - t1)
+    return float(np.median(times))
+
+
+def get_thread_candidates(max_threads:int=None) -> list:
+    """the powers of two up to the cpu count, and the cpu count"""
+    max_threads = max_threads or os.cpu_count() or 1
+    candidates = [1]
+    while candidates[-1] * 2 < max_threads:
+        candidates.append(candidates[-1] * 2)
+    if candidates[-1] != max_threads:
+        candidates.append(max_threads)
+    return candidates
+
+
+def tune_threads(run, inputs:list, candidates:list=None, repeats:int=3, set_threads=None) -> tuple:
+    """benchmark the thread counts and apply the fastest one
+
+    Args:
+        run (callable): a function that runs the model on an input
+        inputs (list): the warm-up inputs
+        candidates (list, optional): the thread counts. Defaults to get_thread_candidates().
+        repeats (int, optional): the number of timed runs per thread count. Defaults to 3.
+        set_threads (callable, optional): a function that applies a thread count. Defaults to cpu_backend.set_cpu_threads.
+
+    Returns:
+        tuple: the fastest thread count, and a dict of thread count to time in seconds
+    """
+    set_threads = set_threads or cpu_backend.set_cpu_threads
+    timings = {}
+    for n in candidates or get_thread_candidates():
+        set_threads(n)
+        run(inputs[0])
+        timings[n] = time_inputs(run, inputs, repeats)
+        logger.info(f'threads {n}: {timings[n]*1000:.1f}ms')
+    best = min(timings, key=timings.get)
+    set_threads(best)
+    return best, timings
+
+
+def warm_up_role(role:str, run, inputs:list, model_paths:list=(), tune:bool=False, cache_file:str=None,
+                 set_threads=None) -> dict:
+    """warm up a model role on its real input shapes, and optionally tune the cpu threads
+
+    Args:
+        role (str): the model role
+        run (callable): a function that runs the model on an input
+        inputs (list): the warm-up inputs, see get_warmup_inputs
+        model_paths (list, optional): the model files, for the cache key. Defaults to ().
+        tune (bool, optional): whether to tune the cpu threads. Defaults to False.
+        cache_file (str, optional): the json cache of the tuned settings. Defaults to DEFAULT_CACHE_FILE.
+        set_threads (callable, optional): a function that applies a thread count to the role, see tune_threads.
+            Defaults to cpu_backend.set_cpu_threads.
+
+    Returns:
+        dict: the settings of the role, with the keys of threads (if tuned) and warmup_time
+    """
+    cache_file = cache_file or DEFAULT_CACHE_FILE
+    set_threads = set_threads or cpu_backend.set_cpu_threads
+    shapes = sorted({tuple(np.shape(x)) for x in inputs})
+    settings = {}
+    if tune:
+        signature = get_signature(model_paths, shapes[0][:2])
+        cache = load_cache(cache_file)
+        cached = cache.get(role, {})
+        if cached.get('signature') == signature:
+            set_threads(cached['threads'])
+            settings['threads'] = cached['threads']
+            logger.info(f'{role}: use the cached cpu threads: {cached["threads"]}')
+        else:
+            best, timings = tune_threads(run, inputs, set_threads=set_threads)
+            settings['threads'] = best
+            cache[role] = {'signature': signature, 'threads': best, 'timings': {str(k):v for k,v in timings.items()}}
+            save_cache(cache_file, cache)
+
+    t1 = time.time()
+    for x in inputs:
+        run(x)
+    settings['warmup_time'] = time.time() - t1
+    logger.info(f'{role}: warmed up on the shapes {shapes}, settings: {settings}')
+    return settings
@@ -0,0 +1,326 @@
+"""
+Description:
+run several replicas of a pipeline class in separate processes, and deliver their results in frame order.
+
+Each worker process creates its own pipeline, loads and warms up the models, then runs predict on the frames it is
+given. Frames are dispatched round-robin or to the least loaded worker, and the results are re-sequenced so they
+come out in the same order as the frames went in. The finished results are drained before each dispatch, so the
+least loaded policy sees the current loads. Each worker sends its results on a pipe of its own, so a worker that
+dies in the middle of a send can't block the others. A worker waits on the send of a large result until the pool
+collects it, which submit and get do. A worker that dies is detected while waiting for a result: its
+frames in flight are delivered as failed (None) and no more frames are dispatched to it.
+
+Example:
+    pool = PipelineWorkerPool(ModelPipeline, kwargs, manifest, num_workers=4, torch_threads=2)
+    for results in pool.map(configs, inputs_iter):
+        ...
+    pool.close()
+"""
+
+import os
+import time
+import logging
+import traceback
+import multiprocessing as mp
+from multiprocessing import connection
+
+
+logger = logging.getLogger(__name__)
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LOADED = 'least_loaded'
+# the seconds between two checks of the workers while waiting for a result
+POLL_INTERVAL = 0.5
+
+
+def get_cpu_sets(num_workers:int, cpus:list=None) -> list:
+    """split the cpus into equal disjoint sets, one per worker
+
+    Args:
+        num_workers (int): the number of workers
+        cpus (list, optional): the cpu ids to use. Defaults to None, which uses the cpus available to this process.
+
+    Returns:
+        list: a list of cpu id lists
+    """
+    if cpus is None:
+        cpus = sorted(os.sched_getaffinity(0))
+    n = max(len(cpus) // num_workers, 1)
+    return [cpus[(i*n) % len(cpus):(i*n) % len(cpus) + n] for i in range(num_workers)]
+
+
+def worker_main(worker_id, pipeline_cls, pipeline_kwargs, models, configs, cpus, torch_threads, in_queue, out_conn):
+    """the loop of a worker process.
+    It sends (seq, worker_id, results, error) on the out_conn for each (seq, configs, inputs) on the in_queue.
+    """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+
+    try:
+        pipeline = pipeline_cls(**pipeline_kwargs)
+        pipeline.load(models, configs)
+        pipeline.warm_up(configs)
+    except Exception:
+        out_conn.send((None, worker_id, None, traceback.format_exc()))
+        return
+    out_conn.send((None, worker_id, None, None))
+
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        seq, frame_configs, inputs = item
+        try:
+            results = pipeline.predict(frame_configs, inputs)
+            out_conn.send((seq, worker_id, results, None))
+        except Exception:
+            out_conn.send((seq, worker_id, None, traceback.format_exc()))
+    pipeline.clean_up()
+
+
+class PipelineWorkerPool:
+    """
+    a pool of pipeline replicas in separate processes with ordered result delivery
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, pipeline_cls, pipeline_kwargs:dict, models:dict, configs:dict=None, num_workers:int=2,
+                 dispatch:str=ROUND_ROBIN, cpu_sets:list=None, pin_cpus:bool=False, torch_threads:int=1,
+                 max_pending:int=8, start_method:str='spawn') -> None:
+        """
+        Args:
+            pipeline_cls (type): the pipeline class, e.g. ModelPipeline
+            pipeline_kwargs (dict): the kwargs to create the pipeline, defined in pipeline_def.json
+            models (dict): model roles
+            configs (dict, optional): runtime configs for load and warm up. Defaults to pipeline_kwargs.
+            num_workers (int, optional): the number of replicas. Defaults to 2.
+            dispatch (str, optional): round_robin or least_loaded. Defaults to round_robin.
+            cpu_sets (list, optional): a list of cpu id lists to pin each worker to. Defaults to None.
+            pin_cpus (bool, optional): pin the workers to equal disjoint cpu sets if cpu_sets is not given. Defaults to False.
+            torch_threads (int, optional): the torch intra-op threads per worker, 0 keeps the default. Defaults to 1.
+            max_pending (int, optional): the max number of frames in flight per worker. Defaults to 8.
+            start_method (str, optional): the multiprocessing start method. Defaults to spawn.
+        """
+        if dispatch not in (ROUND_ROBIN, LEAST_LOADED):
+            raise Exception(f'unknown dispatch policy: {dispatch}')
+        if cpu_sets is None and pin_cpus:
+            cpu_sets = get_cpu_sets(num_workers)
+        if cpu_sets is not None and len(cpu_sets) != num_workers:
+            raise Exception(f'got {len(cpu_sets)} cpu sets for {num_workers} workers')
+
+        configs = pipeline_kwargs if configs is None else configs
+        ctx = mp.get_context(start_method)
+        self.num_workers = num_workers
+        self.dispatch = dispatch
+        self.max_pending = max_pending
+        self.in_queues = [ctx.Queue() for _ in range(num_workers)]
+        self.out_conns = []     # the result pipe of each worker
+        self.in_flight = [0] * num_workers
+        self.assigned = {}      # the worker of each frame in flight
+        self.alive = [True] * num_workers
+        self.closed = set()     # the workers whose result pipe is closed
+        self.next_worker = 0
+        self.next_seq = 0       # the seq of the next submitted frame
+        self.next_out = 0       # the seq of the next delivered result
+        self.done = {}          # results waiting for the frames before them
+        self.workers = []
+        # the OpenMP threads are read when the runtimes are imported, which happens in a spawned worker while its
+        # arguments are unpickled, so they are set in the environment the workers inherit
+        env_threads = os.environ.get('OMP_NUM_THREADS')
+        if torch_threads:
+            os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+        try:
+            for i in range(num_workers):
+                cpus = cpu_sets[i] if cpu_sets else None
+                reader, writer = ctx.Pipe(duplex=False)
+                p = ctx.Process(
+                    target=worker_main,
+                    args=(i, pipeline_cls, pipeline_kwargs, models, configs, cpus, torch_threads, self.in_queues[i], writer),
+                    daemon=True,
+                )
+                p.start()
+                # only the worker holds the writer, so the reader gets EOF when the worker exits
+                writer.close()
+                self.workers.append(p)
+                self.out_conns.append(reader)
+                self.logger.info(f'started worker {i} (pid: {p.pid}, cpus: {cpus}, torch threads: {torch_threads})')
+        finally:
+            if env_threads is None:
+                os.environ.pop('OMP_NUM_THREADS', None)
+            else:
+                os.environ['OMP_NUM_THREADS'] = env_threads
+
+        # wait until all the workers are loaded and warmed up
+        ready = set()
+        while len(ready) < num_workers:
+            waiting = [self.out_conns[i] for i in range(num_workers) if i not in ready]
+            for conn in connection.wait(waiting, timeout=POLL_INTERVAL):
+                i = self.out_conns.index(conn)
+                try:
+                    _, worker_id, _, error = conn.recv()
+                except EOFError:
+                    self.close()
+                    raise Exception(f'worker {i} exited while loading')
+                if error:
+                    self.close()
+                    raise Exception(f'worker {worker_id} failed to load:\n{error}')
+                ready.add(worker_id)
+        self.logger.info(f'{num_workers} workers are ready')
+
+
+    @property
+    def pending(self) -> int:
+        """the number of submitted frames whose results are not delivered yet"""
+        return self.next_seq - self.next_out
+
+
+    def pick_worker(self) -> int:
+        alive = [i for i in range(self.num_workers) if self.alive[i]]
+        if not alive:
+            raise Exception('all the workers have exited')
+        if self.dispatch == LEAST_LOADED:
+            return min(alive, key=lambda i: self.in_flight[i])
+        while not self.alive[self.next_worker]:
+            self.next_worker = (self.next_worker + 1) % self.num_workers
+        worker_id = self.next_worker
+        self.next_worker = (self.next_worker + 1) % self.num_workers
+        return worker_id
+
+
+    def submit(self, configs:dict, inputs:dict) -> int:
+        """dispatch a frame to a worker
+
+        Args:
+            configs (dict): runtime configs
+            inputs (dict): the pipeline inputs
+
+        Returns:
+            int: the sequence number of the frame
+        """
+        # drain the finished results, so the loads are up to date
+        while self.collect(0):
+            pass
+        self.check_workers()
+        worker_id = self.pick_worker()
+        seq = self.next_seq
+        self.in_queues[worker_id].put((seq, configs, inputs))
+        self.in_flight[worker_id] += 1
+        self.assigned[seq] = worker_id
+        self.next_seq += 1
+        return seq
+
+
+    def collect(self, timeout:float=None) -> bool:
+        """move a finished result from the workers into the reorder buffer
+
+        Returns:
+            bool: False if no result arrived before the timeout
+        """
+        conns = [c for i,c in enumerate(self.out_conns) if self.alive[i] and i not in self.closed]
+        ready = connection.wait(conns, timeout=timeout)
+        if not ready:
+            return False
+        i = self.out_conns.index(ready[0])
+        try:
+            seq, worker_id, results, error = ready[0].recv()
+        except EOFError:
+            # the worker exited
+            self.closed.add(i)
+            self.check_workers()
+            return True
+        if self.assigned.pop(seq, None) is None:
+            # the frame was already failed when its worker was found dead
+            return True
+        self.in_flight[worker_id] -= 1
+        if error:
+            self.logger.error(f'worker {worker_id} failed on frame {seq}:\n{error}')
+        self.done[seq] = (results, error)
+        return True
+
+
+    def check_workers(self) -> list:
+        """fail the frames in flight of the workers that have exited
+
+        Returns:
+            list: the ids of the workers found dead
+        """
+        dead = [i for i,p in enumerate(self.workers) if self.alive[i] and (i in self.closed or not p.is_alive())]
+        for i in dead:
+            self.alive[i] = False
+            lost = [seq for seq,w in self.assigned.items() if w == i]
+            for seq in lost:
+                del self.assigned[seq]
+                self.done[seq] = (None, f'worker {i} exited')
+            self.in_flight[i] = 0
+            self.logger.error(f'worker {i} exited with code {self.workers[i].exitcode}, failed the frames: {lost}')
+        return dead
+
+
+    def get(self, timeout:float=None) -> dict:
+        """get the results of the next frame in submission order, blocking until it is done
+
+        Args:
+            timeout (float, optional): the max seconds to wait. Defaults to None, which waits until the frame is
+                done or its worker exits.
+
+        Returns:
+            dict: the pipeline results, or None if the frame failed
+        """
+        if self.next_out >= self.next_seq:
+            raise Exception('no frame is pending')
+        end = time.time() + timeout if timeout is not None else None
+        while self.next_out not in self.done:
+            wait = POLL_INTERVAL if end is None else min(POLL_INTERVAL, max(end - time.time(), 0))
+            if not self.collect(wait):
+                self.check_workers()
+                if end is not None and time.time() >= end and self.next_out not in self.done:
+                    raise TimeoutError(f'frame {self.next_out} is not done after {timeout}s')
+        results, _ = self.done.pop(self.next_out)
+        self.next_out += 1
+        return results
+
+
+    def map(self, configs:dict, inputs_iter):
+        """run the frames through the pool and yield their results in order
+
+        Args:
+            configs (dict): runtime configs
+            inputs_iter (iterable): the pipeline inputs of each frame
+        """
+        for inputs in inputs_iter:
+            if self.pending >= self.max_pending * self.num_workers:
+                yield self.get()
+            self.submit(configs, inputs)
+        while self.pending:
+            yield self.get()
+
+
+    def memory_report(self, weight_dirs:list=None) -> dict:
+        """report the unique and shared memory of each worker, see shared_weights.memory_report
+
+        Args:
+            weight_dirs (list, optional): the folders of the weight files, e.g. MODELS_ROOT. Defaults to None.
+
+        Returns:
+            dict: the memory report of each worker id
+        """
+        from pipeline_tools import shared_weights
+        return {i: shared_weights.memory_report(p.pid, weight_dirs) for i,p in enumerate(self.workers)}
+
+
+    def close(self, timeout:float=10) -> None:
+        """stop the workers"""
+        for q in self.in_queues:
+            q.put(None)
+        for p in self.workers:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        for conn in self.out_conns:
+            conn.close()
+        self.workers = []
+        self.out_conns = []
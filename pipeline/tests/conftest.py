@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the pipeline tools are imported as in the pipeline container, from the pipeline folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
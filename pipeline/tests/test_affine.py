@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+import pytest
+
+from pipeline_tools.affine import AffineChain
+
+
+def test_crop_resize_round_trip():
+    chain = AffineChain(640, 480).crop(100, 50, 420, 290).resize(160, 120)
+    assert chain.size == (160, 120)
+    points = np.array([[100, 50], [420, 290], [260, 170]], dtype=np.float64)
+    out = chain.apply_points(points)
+    assert np.allclose(out, [[0, 0], [160, 120], [80, 60]])
+    assert np.allclose(chain.inverse.apply_points(out), points)
+
+
+def test_points_keep_extra_columns():
+    chain = AffineChain(100, 100).resize(50, 50)
+    points = np.array([[[10, 20, 0.9], [30, 40, 0.1]]])
+    out = chain.apply_points(points)
+    assert out.shape == (1, 2, 3)
+    assert np.allclose(out[..., :2], points[..., :2] / 2)
+    assert np.allclose(out[..., 2], points[..., 2])
+
+
+def test_rotated_boxes_are_bounds_of_corners():
+    chain = AffineChain(100, 100).rotate(90)
+    out = chain.apply_boxes(np.array([[10, 20, 30, 60]]))
+    # counter-clockwise around the center: (x,y) -> (y, 100-x)
+    assert np.allclose(out, [[20, 70, 60, 90]])
+
+
+def test_from_operators_matches_the_chain():
+    ops = [{'crop': [10, 10, 210, 110]}, {'resize': [100, 50, 200, 100]}, {'pad': [0, 0, 25, 25]}]
+    chain = AffineChain.from_operators(ops, 300, 200)
+    expected = AffineChain(300, 200).crop(10, 10, 210, 110).resize(100, 50).pad(0, 0, 25, 25)
+    assert np.allclose(chain.matrix, expected.matrix) and chain.size == expected.size == (100, 100)
+    with pytest.raises(Exception):
+        AffineChain.from_operators([{'flip': []}], 300, 200)
+
+
+def test_warp_without_rotation_is_a_crop_and_resize():
+    image = np.arange(200 * 300 * 3, dtype=np.uint8).reshape(200, 300, 3)
+    chain = AffineChain(300, 200).crop(50, 40, 250, 140).resize(100, 50)
+    expected = cv2.resize(image[40:140, 50:250], (100, 50))
+    assert np.array_equal(chain.warp(image), expected)
+
+
+def test_no_detections():
+    chain = AffineChain(640, 480).resize(320, 240).inverse
+    assert chain.apply_boxes(np.array([])).shape == (0, 4)
+    assert chain.apply_boxes(np.zeros((0, 4))).shape == (0, 4)
+    assert chain.apply_points(np.array([])).shape == (0, 2)
+    assert chain.apply_points(np.zeros((0, 17, 3))).shape == (0, 17, 3)
+    assert chain.apply_polygons([]) == []
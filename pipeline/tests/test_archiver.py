@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+
+from pipeline_tools.archiver import AsyncArchiver, parse_capacity
+
+
+def test_parse_capacity():
+    assert parse_capacity('0.5 GB') == 512 * 1024**2
+    assert parse_capacity('100') == 100
+
+
+def test_pass_frames_are_sampled_once_per_frame(tmp_path):
+    archiver = AsyncArchiver(root_dir=str(tmp_path), pass_every_n=10)
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    sampled = [archiver.submit({f'{i}': image, f'{i}_annotated': image}, 'PASS') for i in range(20)]
+    archiver.close()
+    assert [i for i,s in enumerate(sampled) if s] == [0, 10]
+    files = sorted(os.listdir(archiver.out_dir))
+    assert files == ['0.jpg', '0_annotated.jpg', '10.jpg', '10_annotated.jpg']
+
+
+def test_fail_frames_are_always_archived(tmp_path):
+    archiver = AsyncArchiver(root_dir=str(tmp_path), pass_every_n=0)
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    assert not archiver.submit({'pass': image}, 'PASS')
+    assert archiver.submit({'fail': image, 'fail_annotated': image}, 'FAIL')
+    archiver.close()
+    assert sorted(os.listdir(archiver.out_dir)) == ['fail.jpg', 'fail_annotated.jpg']
+
+
+def test_capacity_evicts_the_oldest_files(tmp_path):
+    image = np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+    archiver = AsyncArchiver(root_dir=str(tmp_path), lossless=True, capacity='20 KB', batch_size=1)
+    for i in range(5):
+        archiver.submit({f'{i}': image})
+    archiver.close()
+    files = os.listdir(archiver.out_dir)
+    assert archiver.total_size <= 20 * 1024 and '4.png' in files and '0.png' not in files
+
+
+def test_a_frame_is_queued_whole(tmp_path):
+    archiver = AsyncArchiver(root_dir=str(tmp_path), max_queue=1)
+    # stop the writer, so the queue stays full
+    archiver.stop_event.set()
+    archiver.thread.join()
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    assert archiver.submit({'0': image, '0_annotated': image})
+    assert archiver.submit({'1': image, '1_annotated': image})
+    assert archiver.counts['queued'] == 2 and archiver.counts['dropped'] == 2
+    archiver.run()
+    assert sorted(os.listdir(archiver.out_dir)) == ['0.jpg', '0_annotated.jpg']
+
+
+def test_an_image_that_fails_to_encode_is_skipped(tmp_path):
+    archiver = AsyncArchiver(root_dir=str(tmp_path))
+    archiver.submit({'bad': np.zeros((8, 8, 2), dtype=np.uint8), 'good': np.zeros((8, 8, 3), dtype=np.uint8)})
+    archiver.close()
+    assert os.listdir(archiver.out_dir) == ['good.jpg']
+    assert archiver.counts['failed'] == 1 and archiver.counts['written'] == 1
@@ -0,0 +1,32 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from pipeline_tools import cascade
+
+
+def test_is_suspicious():
+    assert not cascade.is_suspicious('good', 0.95, ['good'], 0.9)
+    assert cascade.is_suspicious('good', 0.85, ['good'], 0.9)
+    assert cascade.is_suspicious('scratch', 0.99, ['good'], 0.9)
+
+
+def test_check_pass_classes():
+    cascade.check_pass_classes(['Samoyed'], ['Samoyed', 'beagle'])
+    with pytest.raises(Exception, match='good'):
+        cascade.check_pass_classes(['good'], ['Samoyed', 'beagle'])
+
+
+def test_evaluate_gate(tmp_path):
+    # the gate reads its class from the red channel and its score from the green one
+    for label, values in [('good', [(0, 95), (0, 80)]), ('scratch', [(1, 99), (0, 92)])]:
+        os.makedirs(tmp_path / label)
+        for i, (cls, score) in enumerate(values):
+            cv2.imwrite(str(tmp_path / label / f'{i}.png'), np.full((4, 4, 3), (0, score, cls), dtype=np.uint8))
+    run_gate = lambda im: (['good', 'scratch'][im[0, 0, 0]], im[0, 0, 1] / 100)
+    report = cascade.evaluate_gate(run_gate, str(tmp_path), ['good'], thresholds=[0.9, 0.93])
+    # at 0.9 the good 0.95 and the scratch frame classified good at 0.92 are cleared
+    assert report[0.9] == {'miss_rate': 0.5, 'screen_rate': 0.5, 'false_alarm_rate': 0.5}
+    assert report[0.93] == {'miss_rate': 0.0, 'screen_rate': 0.75, 'false_alarm_rate': 0.5}
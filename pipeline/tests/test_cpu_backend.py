@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pytest
+
+from pipeline_tools import cpu_backend
+
+
+def get_role(pt_path, fmt='onnx', package='anomalib'):
+    return {
+        'format': fmt,
+        'details': {'training_package': package},
+        'artifacts': {'pt': {'model_path': str(pt_path), 'image_size': [64, 64]}},
+    }
+
+
+@pytest.fixture
+def pt_file(tmp_path, monkeypatch):
+    # the torch threads are not under test
+    monkeypatch.setattr(cpu_backend, 'set_cpu_threads', lambda num_threads=0: num_threads)
+    model_dir = tmp_path / 'models' / 'ad'
+    model_dir.mkdir(parents=True)
+    pt_path = model_dir / 'best.pt'
+    pt_path.write_bytes(b'pt')
+    return pt_path
+
+
+def test_exports_into_the_export_dir(tmp_path, pt_file, monkeypatch):
+    exported = []
+    def export_model(model, fmt, export_dir=None):
+        path = cpu_backend.get_export_path(model['artifacts']['pt']['model_path'], fmt, export_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+        exported.append(path)
+        return path
+    monkeypatch.setattr(cpu_backend, 'export_model', export_model)
+
+    export_dir = str(tmp_path / 'exports')
+    models = {'ad_model': get_role(pt_file), 'cls_model': {'format': 'pt', 'artifacts': {}}}
+    out = cpu_backend.prepare_cpu_models(models, export_dir=export_dir)
+    path = out['ad_model']['artifacts']['onnx']['model_path']
+    assert path.startswith(export_dir) and path.endswith('best.onnx')
+    assert os.listdir(pt_file.parent) == ['best.pt']
+    assert 'onnx' not in out['cls_model']['artifacts']
+
+    # the export is reused until the pt file is newer
+    cpu_backend.prepare_cpu_models({'ad_model': get_role(pt_file)}, export_dir=export_dir)
+    assert len(exported) == 1
+    os.utime(pt_file, (os.path.getmtime(path) + 10,) * 2)
+    cpu_backend.prepare_cpu_models({'ad_model': get_role(pt_file)}, export_dir=export_dir)
+    assert len(exported) == 2
+
+
+def test_export_paths_are_per_pt_file(tmp_path):
+    a = cpu_backend.get_export_path(str(tmp_path / 'a' / 'best.pt'), 'onnx', str(tmp_path))
+    b = cpu_backend.get_export_path(str(tmp_path / 'b' / 'best.pt'), 'openvino', str(tmp_path))
+    assert os.path.dirname(a) != os.path.dirname(b)
+    assert b.endswith('best_openvino_model')
+    with pytest.raises(Exception):
+        cpu_backend.get_export_path('best.pt', 'tensorrt')
+
+
+def test_existing_artifact_is_used(pt_file):
+    model = get_role(pt_file)
+    model['artifacts']['onnx'] = {'model_path': str(pt_file), 'image_size': [64, 64]}
+    assert cpu_backend.prepare_artifact('ad_model', model, 'onnx') == str(pt_file)
+
+
+def test_input_normalization():
+    assert cpu_backend.get_normalization({'normalization': 'none'}) == (None, None)
+    mean, std = cpu_backend.get_normalization({})
+    x = cpu_backend.to_nchw(np.full((10, 20, 3), 255, dtype=np.uint8), [32, 16], mean, std)
+    assert x.shape == (1, 3, 32, 16) and x.dtype == np.float32
+    assert np.allclose(x[0, :, 0, 0], (1 - np.array(mean)) / np.array(std))
@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+from pipeline_tools.dataset_collector import DatasetCollector
+
+
+def random_images(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 255, (32, 32, 3), dtype=np.uint8) for _ in range(n)]
+
+
+def test_incremental_nearest_neighbours_match_a_full_refresh(tmp_path):
+    collector = DatasetCollector(str(tmp_path), min_dataset_size=8, dataset_increment=4, max_iterations=2)
+    for image in random_images(40):
+        collector.add(image)
+    assert len(collector) == collector.capacity == 12
+    assert collector.counts['replaced'] > 0
+    nn_idx, nn_dist = collector.nn_idx.copy(), collector.nn_dist.copy()
+    collector.refresh_nn()
+    np.testing.assert_allclose(nn_dist, collector.nn_dist, atol=1e-5)
+    assert (nn_idx == collector.nn_idx).all()
+    collector.close()
+
+
+def test_offered_frames_are_added_in_the_background_and_saved_on_close(tmp_path):
+    collector = DatasetCollector(str(tmp_path), min_dataset_size=4, dataset_increment=2, max_iterations=1)
+    images = random_images(3)
+    assert all(collector.offer(image) for image in images + [images[0]])
+    collector.close()
+    assert collector.counts['added'] == 3 and collector.counts['duplicates'] == 1
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.png')]) == 3
+
+    restored = DatasetCollector(str(tmp_path), min_dataset_size=4, dataset_increment=2, max_iterations=1)
+    assert restored.names == collector.names
+    np.testing.assert_allclose(restored.nn_dist, collector.nn_dist, atol=1e-5)
+    restored.close()
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from pipeline_tools import deadline
+from pipeline_tools.deadline import DeadlineMonitor
+
+
+def test_single_outlier_is_ignored():
+    monitor = DeadlineMonitor(100)
+    for ms in [10] * 19 + [500]:
+        monitor.add_sample('model', ms)
+    assert monitor.estimate('model') == pytest.approx(10)
+    assert monitor.affords(monitor.start(), 'model')
+
+
+def test_slow_stage_falls_back():
+    monitor = DeadlineMonitor(100)
+    for _ in range(20):
+        monitor.add_sample('model', 150)
+    frame = monitor.start()
+    assert not monitor.affords(frame, 'model')
+
+
+def test_skipped_stage_is_retried(tmp_path):
+    events_file = str(tmp_path / 'events.jsonl')
+    monitor = DeadlineMonitor(100, history=5, events_file=events_file)
+    for _ in range(5):
+        monitor.add_sample('annotate', 200)
+    skipped = 0
+    while not monitor.affords(monitor.start(), 'annotate'):
+        monitor.record(monitor.start(), 'annotate', deadline.SKIP_ANNOTATION)
+        skipped += 1
+    assert skipped == 5
+    assert monitor.counts[deadline.SKIP_ANNOTATION] == 5
+    with open(events_file) as f:
+        assert [json.loads(line)['fallback'] for line in f] == [deadline.SKIP_ANNOTATION] * 5
+
+
+def test_overrun_and_default_fallbacks():
+    monitor = DeadlineMonitor(10)
+    assert not monitor.allows(deadline.PASS_THROUGH)
+    frame = monitor.start(start=0)
+    assert frame.expired()
+    assert monitor.finish(frame) == ['overrun']
+    with pytest.raises(Exception):
+        DeadlineMonitor(10, ['unknown'])
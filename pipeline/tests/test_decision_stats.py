@@ -0,0 +1,22 @@
+from pipeline_tools.decision_stats import DecisionStats, get_broker_address
+
+
+def test_snapshot_counts_and_windows():
+    stats = DecisionStats(windows=[60, 600])
+    for i in range(100):
+        stats.add('PASS' if i % 4 else 'FAIL', 0.01 * (i % 10 + 1), t=1000.0 + i * 10)
+    msg = stats.snapshot(now=1990.0)
+    assert msg['frames'] == 100
+    assert msg['decision_counts'] == [[25, 'FAIL', 'red'], [75, 'PASS', 'green']]
+    assert msg['yield'] == 75.0
+    # the frames at 1930s to 1990s, and at 1390s to 1990s
+    assert msg['frames_60s'] == 7 and msg['frames_600s'] == 61
+    assert 10 <= msg['latency_p50_600s'] <= 100
+
+
+def test_broker_address(monkeypatch):
+    monkeypatch.delenv('DATA_BROKER_HOST', raising=False)
+    monkeypatch.delenv('DATA_BROKER_PUB_PORT', raising=False)
+    assert get_broker_address() == 'tcp://data-broker:5000'
+    monkeypatch.setenv('DATA_BROKER_HOST', 'localhost')
+    assert get_broker_address() == 'tcp://localhost:5000'
@@ -0,0 +1,40 @@
+from pipeline_tools.fan_in import TopicScheduler, get_topic_roles
+
+
+def test_weighted_round_robin():
+    scheduler = TopicScheduler({'a': {'weight': 2, 'max_queue': 10}, 'b': {'weight': 1, 'max_queue': 10}})
+    for i in range(6):
+        scheduler.put('a', i)
+        scheduler.put('b', i)
+    order = [scheduler.get(0)[0] for _ in range(6)]
+    assert order == ['a', 'b', 'a', 'a', 'b', 'a']
+    # the rest of b is served alone once a is empty
+    assert [scheduler.get(0)[0] for _ in range(6)] == ['a', 'b', 'a', 'b', 'b', 'b']
+
+
+def test_frames_come_out_in_order_per_topic():
+    scheduler = TopicScheduler({'a': {'weight': 1, 'max_queue': 10}, 'b': {'weight': 1, 'max_queue': 10}})
+    for i in range(3):
+        scheduler.put('a', i)
+        scheduler.put('b', i)
+    items = [scheduler.get(0) for _ in range(6)]
+    assert [item for topic,_,item in items if topic == 'a'] == [0, 1, 2]
+    assert [item for topic,_,item in items if topic == 'b'] == [0, 1, 2]
+    assert scheduler.get(0.01) is None
+
+
+def test_full_queue_drops_only_its_topic():
+    scheduler = TopicScheduler({'fast': {'max_queue': 2}, 'slow': {'max_queue': 2}})
+    assert [scheduler.put('fast', i) for i in range(5)] == [True, True, False, False, False]
+    assert scheduler.put('slow', 0)
+    assert not scheduler.put('unknown', 0)
+    report = scheduler.report()
+    assert report['fast']['received'] == 5 and report['fast']['dropped'] == 3 and report['fast']['queue_depth'] == 2
+    assert report['slow']['dropped'] == 0 and report['slow']['queue_depth'] == 1
+
+
+def test_topic_roles():
+    configs = {'topic_roles': {'cam1': ['cls_model']}}
+    assert get_topic_roles(configs, {'topic': 'cam1'}, ['cls_model', 'seg_model']) == ['cls_model']
+    assert get_topic_roles(configs, {'topic': 'cam2'}, ['cls_model', 'seg_model']) == ['cls_model', 'seg_model']
+    assert get_topic_roles(configs, {'topic': 'cam1', 'roles': ['seg_model']}, []) == ['seg_model']
@@ -0,0 +1,45 @@
+import struct
+
+import numpy as np
+import cv2
+
+from pipeline_tools import image_io
+
+
+def encode(h, w, orientation=None):
+    ok, buf = cv2.imencode('.jpg', np.zeros((h, w, 3), dtype=np.uint8))
+    buf = buf.tobytes()
+    if orientation is None:
+        return buf
+    entry = struct.pack('<HHIHH', image_io.ORIENTATION_TAG, 3, 1, orientation, 0)
+    tiff = b'II*\x00' + struct.pack('<IH', 8, 1) + entry + struct.pack('<I', 0)
+    app1 = b'Exif\x00\x00' + tiff
+    return buf[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + buf[2:]
+
+
+def test_jpeg_size_follows_the_exif_orientation():
+    assert image_io.jpeg_size(encode(40, 80)) == (40, 80)
+    assert image_io.jpeg_size(encode(40, 80, orientation=1)) == (40, 80)
+    assert image_io.jpeg_size(encode(40, 80, orientation=6)) == (80, 40)
+    assert image_io.jpeg_size(b'\x89PNG') is None
+
+
+def test_reduced_decode_of_a_rotated_jpg():
+    # decoded as 800x400, which can't be reduced to a width of 300
+    im, factor = image_io.decode_image(encode(400, 800, orientation=6), target_hw=(100, 300))
+    assert factor == 1 and im.shape == (800, 400, 3)
+    im, factor = image_io.decode_image(encode(400, 800, orientation=6), target_hw=(200, 100))
+    assert factor == 4 and im.shape == (200, 100, 3)
+
+
+def test_to_rgb():
+    bgr = np.zeros((2, 2, 3), dtype=np.uint8)
+    bgr[..., 0] = 255
+    assert image_io.to_rgb(bgr, image_io.BGR)[0, 0].tolist() == [0, 0, 255]
+    assert image_io.to_rgb(bgr) is bgr
+
+
+def test_upscale():
+    im = np.zeros((30, 40, 3), dtype=np.uint8)
+    assert image_io.upscale(im, 1) is im
+    assert image_io.upscale(im, 4).shape == (120, 160, 3)
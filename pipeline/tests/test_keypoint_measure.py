@@ -0,0 +1,49 @@
+import numpy as np
+
+from pipeline_tools import keypoint_measure
+
+
+SPECS = keypoint_measure.compile_specs({
+    'part': [
+        {'name': 'width', 'type': 'distance', 'points': [0, 1], 'min': 5, 'max': 15},
+        {'name': 'corner', 'type': 'angle', 'points': [0, 2, 1], 'min': 80, 'max': 100},
+    ],
+})
+
+
+def test_distance_and_angle():
+    pts = np.array([[[0, 10], [10, 0], [0, 0]]], dtype=float)
+    values = SPECS['part'].measure(pts, pixel_size=0.5)
+    np.testing.assert_allclose(values, [[np.hypot(10, 10) * 0.5, 90.0]])
+
+
+def test_all_within_tolerance_passes():
+    pts = np.array([[[0, 10, 1], [10, 0, 1], [0, 0, 1]]], dtype=float)
+    out = keypoint_measure.measure_instances(pts, ['part'], SPECS)
+    assert out['ok'] and out['failed'] == [] and out['missing'] == []
+
+
+def test_empty_frame_fails():
+    out = keypoint_measure.measure_instances(np.zeros((0, 3, 3)), [], SPECS)
+    assert not out['ok']
+    assert out['missing'] == ['part']
+
+
+def test_other_classes_only_fails():
+    out = keypoint_measure.measure_instances(np.zeros((1, 3, 3)), ['other'], SPECS)
+    assert not out['ok'] and out['missing'] == ['part']
+
+
+def test_low_confidence_keypoints_are_not_measured():
+    pts = np.array([[[0, 10, 0.1], [10, 0, 1], [0, 0, 1]]], dtype=float)
+    out = keypoint_measure.measure_instances(pts, ['part'], SPECS, min_conf=0.5)
+    assert np.isnan(out['values']['part']).all()
+    assert not out['ok']
+    assert out['failed'] == ['corner', 'width']
+
+
+def test_out_of_tolerance_instance_fails():
+    pts = np.array([[[0, 10, 1], [10, 0, 1], [0, 0, 1]], [[0, 100, 1], [100, 0, 1], [0, 0, 1]]], dtype=float)
+    out = keypoint_measure.measure_instances(pts, ['part', 'part'], SPECS)
+    assert out['passed'].tolist() == [True, False]
+    assert out['failed'] == ['width'] and not out['ok']
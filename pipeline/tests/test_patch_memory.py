@@ -0,0 +1,44 @@
+import pytest
+import numpy as np
+
+from pipeline_tools.patch_memory import FeatureExtractor, IVFIndex, check_weights, greedy_coreset
+
+
+def test_restored_lists_search_the_same():
+    rng = np.random.default_rng(0)
+    bank = rng.normal(size=(500, 16)).astype(np.float32)
+    queries = rng.normal(size=(50, 16)).astype(np.float32)
+    index = IVFIndex(bank, n_lists=8)
+    restored = IVFIndex.from_lists(index.bank, index.centroids, index.offsets)
+    for nprobe in (1, 2, 8):
+        np.testing.assert_array_equal(index.search(queries, nprobe), restored.search(queries, nprobe))
+
+
+def test_exact_search_and_recall():
+    rng = np.random.default_rng(1)
+    bank = rng.normal(size=(300, 8)).astype(np.float32)
+    queries = rng.normal(size=(40, 8)).astype(np.float32)
+    index = IVFIndex(bank, n_lists=4)
+    exact = np.sqrt(((queries[:,None] - bank[None]) ** 2).sum(-1).min(1))
+    np.testing.assert_allclose(index.search(queries, 4), exact, rtol=1e-4, atol=1e-4)
+    report = index.evaluate(queries, nprobes=(1, 4))
+    assert report[4]['recall'] == 1.0 and report[1]['recall'] <= 1.0
+
+
+def test_coreset_size():
+    features = np.random.default_rng(2).normal(size=(200, 4)).astype(np.float32)
+    selected = greedy_coreset(features, 0.1)
+    assert len(selected) == 20 and len(set(selected.tolist())) == 20
+
+
+def test_check_weights(tmp_path):
+    weights = tmp_path / 'resnet18.pth'
+    weights.write_bytes(b'weights')
+    sha256 = check_weights(str(weights))
+    assert check_weights(str(weights), sha256) == sha256
+    with pytest.raises(Exception, match='not the backbone'):
+        check_weights(str(weights), '0' * 64)
+    with pytest.raises(Exception, match='not found'):
+        check_weights(str(tmp_path / 'missing.pth'))
+    with pytest.raises(Exception, match='not found'):
+        FeatureExtractor('resnet18', None)
@@ -0,0 +1,35 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from pipeline_tools.preview_pyramid import PreviewPyramid, TileStore
+
+
+def test_preview_and_tiles():
+    image = np.zeros((2000, 3000, 3), dtype=np.uint8)
+    pyramid = PreviewPyramid(image, preview_size=1024, tile_size=512)
+    assert pyramid.shapes()[:3] == [[2000, 3000], [1000, 1500], [500, 750]]
+    assert pyramid.preview.shape[:2] == (500, 750)
+    assert pyramid.tile(0, 3, 5).shape[:2] == (2000 - 3*512, 3000 - 5*512)
+
+
+def test_store_is_bounded_by_bytes():
+    image = np.zeros((1000, 1000, 3), dtype=np.uint8)
+    size = PreviewPyramid(image).nbytes
+    store = TileStore(max_frames=20, max_bytes=int(size * 2.5))
+    for i in range(5):
+        store.add(str(i), image)
+    assert list(store.pyramids) == ['3', '4'] and store.nbytes == 2 * size
+    assert store.get_tile('0', 0, 0, 0) is None
+    assert store.get_tile('4', 0, 0, 0)[:2] == b'\xff\xd8'
+
+
+def test_describe_and_failed_encode(monkeypatch):
+    store = TileStore(tile_size=256)
+    _, levels = store.add('1', np.zeros((600, 800, 3), dtype=np.uint8))
+    assert json.loads(store.describe('1', levels)) == {'frame_id': '1', 'levels': [[600, 800], [300, 400], [150, 200]], 'tile_size': 256}
+    monkeypatch.setattr(cv2, 'imencode', lambda *args: (False, None))
+    with pytest.raises(Exception, match='failed to encode'):
+        store.get_tile('1', 0, 0, 0)
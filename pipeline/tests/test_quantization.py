@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from pipeline_tools import quantization
+
+
+def test_box_iou():
+    boxes1 = np.array([[0, 0, 10, 10], [20, 20, 30, 30]])
+    boxes2 = np.array([[0, 0, 10, 10], [5, 0, 15, 10], [100, 100, 110, 110]])
+    ious = quantization.box_iou(boxes1, boxes2)
+    assert ious.shape == (2, 3)
+    assert ious[0] == pytest.approx([1, 50 / 150, 0])
+    assert ious[1] == pytest.approx([0, 0, 0])
+    assert quantization.box_iou(np.zeros((0, 4)), boxes2).shape == (0, 3)
+
+
+def test_compare_detections():
+    ref = {'boxes': np.array([[0, 0, 10, 10], [20, 20, 30, 30]]), 'classes': ['a', 'b']}
+    assert quantization.compare_detections(ref, ref) == {'mean_iou': pytest.approx(1), 'class_agreement': 1.0}
+    # a wrong class and an extra box
+    test = {'boxes': np.array([[0, 0, 10, 10], [20, 20, 30, 30], [50, 50, 60, 60]]), 'classes': ['a', 'a', 'b']}
+    metrics = quantization.compare_detections(ref, test)
+    assert metrics['mean_iou'] == pytest.approx(2 / 3)
+    assert metrics['class_agreement'] == pytest.approx(1 / 3)
+    empty = {'boxes': np.zeros((0, 4)), 'classes': []}
+    assert quantization.compare_detections(empty, empty) == {'mean_iou': 1.0, 'class_agreement': 1.0}
+    assert quantization.compare_detections(ref, empty) == {'mean_iou': 0.0, 'class_agreement': 0.0}
+
+
+def test_compare_anomaly_maps():
+    rng = np.random.default_rng(0)
+    ref = rng.random((32, 32))
+    assert quantization.compare_anomaly_maps(ref, ref * 2 + 1)['map_correlation'] == pytest.approx(1)
+    assert quantization.compare_anomaly_maps(ref, -ref)['map_correlation'] == pytest.approx(-1)
+    flat = np.zeros((32, 32))
+    assert quantization.compare_anomaly_maps(flat, flat)['map_correlation'] == 1.0
+    assert quantization.compare_anomaly_maps(flat, ref)['map_correlation'] == 0.0
+
+
+def test_get_task():
+    assert quantization.get_task({'model_type': 'AnomalyDetection'}) == 'anomaly'
+    assert quantization.get_task({'model_type': 'Classification'}) == 'classification'
+    assert quantization.get_task({}) == 'detection'
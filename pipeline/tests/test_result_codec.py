@@ -0,0 +1,57 @@
+import json
+
+import numpy as np
+import pytest
+
+from pipeline_tools import result_codec
+
+
+class FakeSocket:
+    """a stand-in zmq socket that keeps the sent frames"""
+
+    def __init__(self):
+        self.frames = None
+
+    def send_multipart(self, frames, copy=True):
+        self.frames = [bytes(f) for f in frames]
+
+    def recv_multipart(self, copy=True):
+        return self.frames
+
+
+def test_round_trip_over_a_socket():
+    results = {
+        'decision': 'PASS',
+        'score': np.float32(0.5),
+        'outputs': {'annotated': np.arange(60 * 80 * 3, dtype=np.uint8).reshape(60, 80, 3)},
+        'boxes': np.array([[1, 2, 3, 4]], dtype=np.float32),
+        'points': np.arange(2 * 17 * 3, dtype=np.float64).reshape(2, 17, 3)[:, :, :2],
+        'raw': b'\x00\x01',
+    }
+    socket = FakeSocket()
+    result_codec.send(socket, 'cam1/results', results)
+    topic, out = result_codec.recv(socket)
+    assert topic == 'cam1/results'
+    assert out['decision'] == 'PASS' and out['score'] == 0.5
+    for key in ('boxes', 'points'):
+        assert out[key].dtype == results[key].dtype and np.array_equal(out[key], results[key])
+    assert np.array_equal(out['outputs']['annotated'], results['outputs']['annotated'])
+    assert out['raw'] == b'\x00\x01' and isinstance(out['raw'], bytes)
+    # the image and the points are out-of-band, the small boxes stay in the header
+    header = json.loads(socket.frames[1])
+    assert isinstance(header['outputs']['annotated'][result_codec.ND_KEY][0], int)
+    assert header['boxes'][result_codec.ND_KEY][0] == [1.0, 2.0, 3.0, 4.0]
+    assert len(socket.frames) == 5
+
+
+def test_empty_arrays_keep_dtype_and_shape():
+    header, buffers = result_codec.encode({'boxes': np.zeros((0, 4), dtype=np.float32), 'classes': []})
+    assert not buffers
+    out = result_codec.decode(header, buffers)
+    assert out['boxes'].shape == (0, 4) and out['boxes'].dtype == np.float32
+    assert out['classes'] == []
+
+
+def test_unknown_type_is_rejected():
+    with pytest.raises(Exception):
+        result_codec.encode({'x': object()})
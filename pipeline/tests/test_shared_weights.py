@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+from pipeline_tools import shared_weights
+from pipeline_tools.patch_memory import IVFIndex, load_bank
+
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='reads /proc/<pid>/smaps')
+
+
+def save_bank(path, bank, n_lists=4):
+    # the same arrays as PatchMemoryModel.save
+    index = IVFIndex(bank, n_lists, iters=1)
+    np.savez(path, bank=index.bank, centroids=index.centroids, offsets=index.offsets,
+             image_size=np.array([224, 224]), backbone='resnet18')
+    return index
+
+
+def test_mmap_npz(tmp_path):
+    path = str(tmp_path / 'arrays.npz')
+    arrays = {'a': np.arange(12, dtype=np.float32).reshape(3, 4), 'f': np.asfortranarray(np.ones((2, 3))),
+              'empty': np.zeros((0, 4)), 'name': np.array('resnet18')}
+    np.savez(path, **arrays)
+    out = shared_weights.mmap_npz(path)
+    assert isinstance(out['a'], np.memmap) and not out['a'].flags.writeable
+    for k,v in arrays.items():
+        assert out[k].dtype == v.dtype and np.array_equal(out[k], v)
+    assert str(out['name']) == 'resnet18'
+    # compressed members are read as usual
+    np.savez_compressed(path, **arrays)
+    assert np.array_equal(shared_weights.mmap_npz(path)['a'], arrays['a'])
+
+
+def test_load_bank_keeps_the_mapped_pages(tmp_path):
+    path = str(tmp_path / 'bank.npz')
+    saved = save_bank(path, np.random.default_rng(0).normal(size=(200, 8)).astype(np.float32))
+    data, index = load_bank(path)
+    assert np.shares_memory(index.bank, data['bank']) and isinstance(data['bank'], np.memmap)
+    np.testing.assert_array_equal(index.search(saved.bank[:5], 4), saved.search(saved.bank[:5], 4))
+    assert load_bank(path, n_lists=8)[1] is None
+
+
+def hold_mapped(path, ready, done):
+    _, index = load_bank(path)
+    index.search(np.zeros((1, index.bank.shape[1]), dtype=np.float32), index.n_lists)   # fault all the pages in
+    ready.set()
+    done.wait(10)
+
+
+def hold_copied(path, ready, done):
+    w = np.load(path)['bank']
+    w += 1    # private pages, as a model converted after loading
+    ready.set()
+    done.wait(10)
+
+
+@linux_only
+@pytest.mark.parametrize('target, shared', [(hold_mapped, True), (hold_copied, False)])
+def test_replicas_share_mapped_weights(tmp_path, target, shared):
+    path = str(tmp_path / 'bank.npz')
+    save_bank(path, np.random.rand(1024 * 1024, 4).astype(np.float32))   # 16MB
+    ctx = mp.get_context('spawn')
+    done = ctx.Event()
+    procs, events = [], []
+    for _ in range(2):
+        ready = ctx.Event()
+        p = ctx.Process(target=target, args=(path, ready, done))
+        p.start()
+        procs.append(p)
+        events.append(ready)
+    try:
+        for e in events:
+            assert e.wait(30)
+        reports = [shared_weights.memory_report(p.pid, [str(tmp_path)]) for p in procs]
+    finally:
+        done.set()
+        for p in procs:
+            p.join(10)
+    for r in reports:
+        w = r['weights'].get(path, {'rss': 0, 'shared': 0})
+        if shared:
+            # the pages of the file are resident once and shared by both replicas
+            assert w['rss'] >= 15.9 and w['shared'] >= 15.9
+        else:
+            assert w['shared'] < 0.1
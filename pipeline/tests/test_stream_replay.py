@@ -0,0 +1,46 @@
+import json
+
+import numpy as np
+import cv2
+
+from pipeline_tools import stream_replay
+
+
+class CountingPipeline:
+    def __init__(self):
+        self.shapes = []
+
+    def predict(self, configs, inputs):
+        self.shapes.append(inputs['image']['pixels'].shape)
+
+
+def write_images(folder, n):
+    paths = []
+    for i in range(n):
+        path = str(folder / f'{i}.png')
+        cv2.imwrite(path, np.full((20, 30, 3), i, dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+
+def test_replay_streams_a_folder_recording(tmp_path):
+    write_images(tmp_path, 5)
+    rec = str(tmp_path / 'test.rec')
+    assert stream_replay.record_folder(str(tmp_path), rec, fps=100) == 5
+    times = [t for t,parts in stream_replay.read_recording(rec, skip_parts=True)]
+    assert times == [i / 100 for i in range(5)]
+    pipeline = CountingPipeline()
+    report = stream_replay.replay(pipeline, {}, rec, mode='scaled', speed=10, max_queue=10)
+    assert report['frames'] == report['processed'] == 5 and report['dropped'] == 0
+    assert pipeline.shapes == [(20, 30, 3)] * 5
+
+
+def test_recorded_paths_are_embedded(tmp_path):
+    path, = write_images(tmp_path, 1)
+    msg = [b'sensor/profiler', json.dumps({'image': {'path': path}, 'id': 1}).encode()]
+    parts = stream_replay.embed_images(msg)
+    assert parts[:2] == msg and len(parts) == 3
+    # the file is gone by the time of the replay
+    (tmp_path / '0.png').unlink()
+    inputs = stream_replay.decode_frame(parts)
+    assert inputs['image']['pixels'].shape == (20, 30, 3)
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from pipeline_tools import tracing
+
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_ID = '00f067aa0ba902b7'
+TRACEPARENT = f'00-{TRACE_ID}-{SPAN_ID}-01'
+
+
+def read_spans(path):
+    spans = []
+    with open(path) as f:
+        for line in f:
+            for resource in json.loads(line)['resourceSpans']:
+                for scope in resource['scopeSpans']:
+                    spans += scope['spans']
+    return spans
+
+
+def test_parse_and_extract():
+    assert tracing.parse_traceparent(TRACEPARENT) == (TRACE_ID, SPAN_ID)
+    for invalid in ('', None, '00-abc-def-01', f'00-{TRACE_ID}-{SPAN_ID}'):
+        assert tracing.parse_traceparent(invalid) is None
+    assert tracing.extract({'traceparent': TRACEPARENT}) == (TRACE_ID, SPAN_ID)
+    assert tracing.extract({'image': {'pixels': None, 'traceparent': TRACEPARENT}}) == (TRACE_ID, SPAN_ID)
+    assert tracing.extract({'image': {'pixels': None}}) is None
+    assert tracing.extract('not a dict') is None
+
+
+def test_nested_spans_are_exported_as_otlp(tmp_path):
+    path = tmp_path / 'traces.jsonl'
+    tracer = tracing.Tracer('pipeline', str(path))
+    with tracer.span('predict', parent=(TRACE_ID, SPAN_ID)) as root:
+        with tracer.span('model', attributes={'batch': 1, 'score': 0.5, 'ok': True}) as child:
+            assert tracer.current() is child
+        root.set_attribute('decision', 'PASS')
+    assert tracer.current() is None
+
+    # the trace is written once the root span of the service is finished
+    lines = path.read_text().splitlines()
+    assert len(lines) == 1
+    resource = json.loads(lines[0])['resourceSpans'][0]
+    assert resource['resource']['attributes'] == [{'key': 'service.name', 'value': {'stringValue': 'pipeline'}}]
+    model, predict = read_spans(path)
+    assert predict['traceId'] == model['traceId'] == TRACE_ID
+    assert predict['parentSpanId'] == SPAN_ID and model['parentSpanId'] == predict['spanId']
+    assert model['attributes'] == [
+        {'key': 'batch', 'value': {'intValue': '1'}},
+        {'key': 'score', 'value': {'doubleValue': 0.5}},
+        {'key': 'ok', 'value': {'boolValue': True}},
+    ]
+    assert predict['attributes'] == [{'key': 'decision', 'value': {'stringValue': 'PASS'}}]
+    assert int(predict['startTimeUnixNano']) <= int(model['startTimeUnixNano']) <= int(model['endTimeUnixNano'])
+    assert root.traceparent == f'00-{TRACE_ID}-{predict["spanId"]}-01'
+
+
+def test_traced_method_records_the_error(tmp_path):
+    path = tmp_path / 'traces.jsonl'
+
+    class Pipeline:
+        tracer = tracing.Tracer('pipeline', str(path))
+
+        @tracing.traced('predict')
+        def predict(self, configs, inputs):
+            with self.tracer.span('model'):
+                raise ValueError('bad frame')
+
+    with pytest.raises(ValueError):
+        Pipeline().predict({}, {'image': {'traceparent': TRACEPARENT}})
+    model, predict = read_spans(path)
+    assert predict['name'] == 'predict' and predict['parentSpanId'] == SPAN_ID
+    assert model['status']['code'] == predict['status']['code'] == 2
+    assert 'bad frame' in predict['status']['message']
+
+
+def test_no_export_without_a_path(monkeypatch, tmp_path):
+    monkeypatch.delenv('TRACE_EXPORT_PATH', raising=False)
+    tracer = tracing.Tracer('pipeline')
+    with tracer.span('predict') as span:
+        assert tracing.parse_traceparent(span.traceparent)[0] == span.trace_id
+    assert tracer.finished == []
@@ -0,0 +1,27 @@
+import numpy as np
+import cv2
+
+from pipeline_tools import warmup
+
+
+def test_inputs_are_single_images_of_the_model_size(tmp_path):
+    for i in range(2):
+        cv2.imwrite(str(tmp_path / f'{i}.png'), np.zeros((100, 80, 3), dtype=np.uint8))
+    inputs = warmup.get_warmup_inputs([32, 48], image_dir=str(tmp_path), max_images=3)
+    assert [x.shape for x in inputs] == [(32, 48, 3)] * 2
+    assert [x.shape for x in warmup.get_warmup_inputs([32, 48], max_images=3)] == [(32, 48, 3)] * 3
+
+
+def test_tuned_threads_are_applied_and_cached(tmp_path):
+    applied = []
+    cache_file = str(tmp_path / 'warmup.json')
+    inputs = warmup.get_warmup_inputs([8, 8], max_images=1)
+    # pretend that 2 threads are the fastest
+    run = lambda x: sum(range(1000 * (1 + abs(applied[-1] - 2))))
+    settings = warmup.warm_up_role('role', run, inputs, tune=True, cache_file=cache_file, set_threads=applied.append)
+    assert settings['threads'] == applied[-1]
+    assert set(applied[:-1]) == set(warmup.get_thread_candidates())
+
+    applied.clear()
+    cached = warmup.warm_up_role('role', run, inputs, tune=True, cache_file=cache_file, set_threads=applied.append)
+    assert applied == [settings['threads']] and cached['threads'] == settings['threads']
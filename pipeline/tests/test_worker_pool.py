@@ -0,0 +1,59 @@
+import os
+import time
+from multiprocessing import connection
+
+import pytest
+
+from pipeline_tools.worker_pool import PipelineWorkerPool, LEAST_LOADED
+
+
+class EchoPipeline:
+    """a stand-in pipeline that echoes its inputs, sleeps or exits on request"""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def load(self, models, configs):
+        pass
+
+    def warm_up(self, configs):
+        pass
+
+    def predict(self, configs, inputs):
+        if inputs.get('exit'):
+            os._exit(1)
+        time.sleep(inputs.get('sleep', 0))
+        return {'i': inputs['i'], 'pid': os.getpid()}
+
+    def clean_up(self):
+        pass
+
+
+@pytest.fixture
+def pool():
+    pool = PipelineWorkerPool(EchoPipeline, {}, {}, num_workers=2, dispatch=LEAST_LOADED, torch_threads=0)
+    yield pool
+    pool.close()
+
+
+def test_results_are_in_order(pool):
+    inputs = [{'i': i, 'sleep': 0.05 if i % 3 == 0 else 0} for i in range(10)]
+    assert [r['i'] for r in pool.map({}, inputs)] == list(range(10))
+
+
+def test_finished_results_are_drained_before_dispatch(pool):
+    pool.submit({}, {'i': 0})
+    # wait for the result of the first frame, without collecting it
+    assert connection.wait(pool.out_conns, timeout=10)
+    pool.submit({}, {'i': 1})
+    assert sum(pool.in_flight) == 1
+    assert [pool.get(5)['i'], pool.get(5)['i']] == [0, 1]
+
+
+def test_dead_worker_fails_its_frames(pool):
+    pool.submit({}, {'i': 0, 'exit': True})
+    assert pool.get(timeout=10) is None
+    # the frames go to the remaining worker
+    pool.submit({}, {'i': 1})
+    assert pool.get(timeout=10)['i'] == 1
+    assert pool.alive.count(False) == 1